@@ -0,0 +1,110 @@
+from itertools import islice
+
+from zope.interface import implements, Interface
+from zope.component import adapts, queryUtility
+
+from collective.subscribe.interfaces import (
+    ISubscriptionCatalog,
+    ISubscribersOf,
+    IItemsFor,
+    IItemSubscriber,
+    IUIDStrategy,
+    )
+
+
+def prefetch(objects):
+    """
+    Given a sequence of (possibly persistent) objects, ask the ZODB
+    connection of the first to load states of any ghosts among them in
+    bulk, where the connection (and its storage) supports prefetch
+    (ZODB >= 5); otherwise, objects are loaded one at a time on access.
+    """
+    ghosts = [o for o in objects
+              if o is not None and getattr(o, '_p_changed', 0) is None]
+    if not ghosts:
+        return
+    jar = getattr(ghosts[0], '_p_jar', None)
+    if jar is not None and hasattr(jar, 'prefetch'):
+        jar.prefetch(ghosts)
+
+
+def resolve_batches(keys, resolve_many, batch_size):
+    """
+    Generator: resolve keys (iterable, e.g. lazy search result) to
+    objects, batch_size keys at a time, via resolve_many function (which
+    returns a list of objects or None for a list of keys), prefetching
+    each batch; yields resolved objects, skipping those not found.
+    """
+    keys = iter(keys)
+    while True:
+        batch = list(islice(keys, batch_size))
+        if not batch:
+            return
+        objects = resolve_many(batch)
+        prefetch(objects)
+        for obj in objects:
+            if obj is not None:
+                yield obj
+
+
+class CatalogAdapterBase(object):
+    """
+    Base for query adapters; the subscription catalog (utility) is
+    looked up once per adapter, and objects are resolved in batches.
+    """
+
+    batch_size = 100
+
+    def __init__(self, context, catalog=None):
+        self.context = context
+        self._catalog = catalog
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = queryUtility(ISubscriptionCatalog)
+            if self._catalog is None:
+                raise LookupError('no subscription catalog utility found')
+        return self._catalog
+
+    def _search(self, name, value):
+        name = str(name)
+        if name not in self.catalog.indexes:
+            raise ValueError('unknown relationship name: %s' % name)
+        return self.catalog.search({name: value}, lazy=True)
+
+
+class SubscribersOf(CatalogAdapterBase):
+    """
+    Adapts an item (for which a UID is available via an IUIDStrategy
+    adapter) to find its subscribers.
+    """
+
+    implements(ISubscribersOf)
+    adapts(Interface)
+
+    @property
+    def uid(self):
+        return str(IUIDStrategy(self.context)())
+
+    def find(self, name):
+        signatures = self._search(name, self.uid)
+        return resolve_batches(signatures, self.catalog.get_subscribers,
+                               self.batch_size)
+
+    def subscriptions_for(self, subscriber):
+        return self.catalog.names_for(subscriber, self.uid)
+
+
+class ItemsFor(CatalogAdapterBase):
+    """Adapts an IItemSubscriber to find items it is subscribed to"""
+
+    implements(IItemsFor)
+    adapts(IItemSubscriber)
+
+    def find(self, name):
+        uids = self._search(name, self.context.signature())
+        return resolve_batches(uids, self.catalog.get_items, self.batch_size)
+
+    def subscriptions_for(self, uids):
+        return self.catalog.names_for_items(self.context, uids)
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """
+    Bounded LRU cache of search results, for use as a volatile (per
+    connection) attribute of a catalog.  Each entry is stored with a
+    stamp (e.g. generation counters of the indexes searched); a lookup
+    with a different stamp is a miss, so stale entries are never served.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()   # key -> (stamp, value)
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, stamp, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] != stamp:
+            self.misses += 1
+            return default
+        self._entries[key] = entry  # most recently used
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, stamp, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (stamp, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)  # least recently used
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return dict of hits, misses, evictions, size, maxsize."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self),
+            'maxsize': self.maxsize,
+            }
@@ -1,25 +1,73 @@
+import time
+from itertools import islice
+
 from persistent import Persistent
 from zope.interface import implements
 from zope.component import queryUtility
 from BTrees.OOBTree import OOBTree
+from BTrees.LLBTree import LLSet, intersection, multiunion
 
+from collective.subscribe.cache import ResultCache
 from collective.subscribe.index import SubscriptionIndex
-from collective.subscribe.utils import valid_signature
+from collective.subscribe.interned import InternTable
+from collective.subscribe.lazy import LazyResult
+from collective.subscribe.metadata import AssociationMetadata
+from collective.subscribe.pairs import PairNames
+from collective.subscribe.query import Query, Related, And, Or
+from collective.subscribe.utils import checkpoint, valid_signature
+from collective.subscribe.utils import TreeAttributesMixin
 
 from interfaces import (
     ISubscriptionCatalog,
     ISubscriptionIndex,
+    IAssociationMetadata,
     IItemResolver,
+    IBulkItemResolver,
     IItemSubscriber,
-    ISubscribers
+    ISubscribers,
+    ISubscriptionKeys
     )
 
 
-class SubscriptionIndexCollection(OOBTree):
+def _intersect(sets):
+    """
+    Intersect integer id sets, smallest first; stops as soon as the
+    running intersection is empty.  Returns an empty set if no sets given,
+    and one set as is, without len(), which walks a stored tree set.
+    """
+    if not sets:
+        return LLSet()
+    if len(sets) == 1:
+        return sets[0]
+    sets = sorted(sets, key=len)
+    result = sets[0]
+    for ids in sets[1:]:
+        if not result:
+            break
+        result = intersection(result, ids)
+    return result
+
+
+class SubscriptionIndexCollection(TreeAttributesMixin, OOBTree):
+    """
+    Mapping of names to indexes; indexes added are bound to the intern
+    tables of the collection, if any, such that all indexes in a catalog
+    share the same integer ids for signatures and UIDs.
+    """
+
+    signature_ids = uid_ids = None
+
+    def __init__(self, signature_ids=None, uid_ids=None):
+        super(SubscriptionIndexCollection, self).__init__()
+        self.signature_ids = signature_ids
+        self.uid_ids = uid_ids
+
     def __setitem__(self, key, value):
         key = str(key)
         if not ISubscriptionIndex.providedBy(value):
             raise ValueError('indexes colllection value must be index')
+        if self.signature_ids is not None and hasattr(value, 'rebind'):
+            value.rebind(self.signature_ids, self.uid_ids)
         super(SubscriptionIndexCollection, self).__setitem__(key, value)
 
 
@@ -28,94 +76,571 @@ class SubscriptionCatalog(Persistent):
 
     implements(ISubscriptionCatalog)
 
+    # maximum number of search results cached per connection; 0 disables
+    cache_size = 0
+
+    # record time subscribed of new associations in metadata; off by
+    # default, as it adds a write (of a popular item's records) to each
+    # index(), and the timeline of an index may record times instead
+    record_subscribed = False
+
     def __init__(self):
-        self.metadata = OOBTree()
-        self.indexes = SubscriptionIndexCollection()
+        self.signature_ids = InternTable()
+        self.uid_ids = InternTable()
+        self.metadata = AssociationMetadata(self.signature_ids, self.uid_ids)
+        self.pair_names = PairNames(self.signature_ids, self.uid_ids)
+        self.indexes = SubscriptionIndexCollection(self.signature_ids,
+                                                   self.uid_ids)
     
-    def _search_for_items(self, query):
-        result = None
+    def _signature(self, value):
+        if IItemSubscriber.providedBy(value):
+            return value.signature()
+        if isinstance(value, tuple) and len(value) == 2:
+            return value
+        raise ValueError('unable to obtain subscriber signature')
+
+    def _item_ids(self, query):
+        """
+        Given query for items, return set of integer ids of item UIDs;
+        result may be a set stored by an index, and must not be modified.
+        """
         if IItemSubscriber.providedBy(query) or valid_signature(query):
-            sresult = set()
-            if not isinstance(query, tuple):
-                query = query.signature()
-            for idx in self.indexes:
-                sresult = sresult | set(
-                    self._search_for_items({idx: query}))
-            return sorted(tuple(sresult))
-        # search for specific subscription relationship name:
+            # unnamed: union of item ids for subscriber from all indexes
+            signature = self._signature(query)
+            return multiunion([idx.item_ids_for(signature)
+                               for idx in self.indexes.values()])
+        # search for specific subscription relationship name(s):
+        sets = []
         for (k, v) in query.items():
             if str(k) in self.indexes:
                 idx = self.indexes[str(k)]
-                if IItemSubscriber.providedBy(v):
-                    signature = v.signature()
-                elif isinstance(v, tuple) and len(v) == 2:
-                    signature = v
-                else:
-                    raise ValueError('unable to obtain subscriber signature')
-                if result is None:
-                    result = set(idx.item_uids_for(signature))
-                else:
-                    result = result & set(idx.item_uids_for(signature))
-        if not result:
-            return ()
-        return tuple(result)
-    
-    def _search_for_subscribers(self, query):
-        result = None
+                sets.append(idx.item_ids_for(self._signature(v)))
+        return _intersect(sets)
+
+    def _subscriber_ids(self, query):
+        """
+        Given query for subscribers, return set of integer ids of
+        subscriber signatures; result may be a set stored by an index, and
+        must not be modified.
+        """
         if isinstance(query, basestring):
-            #unnamed, UID: query all indexes for subscribers of any sort
-            sresult = set()
-            for idx in self.indexes:
-                sresult = sresult | set(
-                    self._search_for_subscribers({idx: query}))
-            return sorted(tuple(sresult))
+            # unnamed, UID: union of subscribers of any sort from all indexes
+            return multiunion([idx.subscriber_ids_for(query)
+                               for idx in self.indexes.values()])
+        sets = []
         for (k, v) in query.items():
             if str(k) in self.indexes:
                 idx = self.indexes[str(k)]
-                uid = str(v)
-                if result is None:
-                    result = set(idx.subscribers_for(uid))
-                else:
-                    result = result & set(idx.subscribers_for(uid))
-        if not result:
-            return ()
-        return tuple(result)
-        
-    def search(self, query):
+                sets.append(idx.subscriber_ids_for(str(v)))
+        return _intersect(sets)
+
+    def _query_ids(self, query):
+        """
+        Return tuple of (intern table, set of integer ids) for query; ids
+        resolve to values in result via the intern table.
+        """
+        if isinstance(query, Query):
+            return query.ids(self)
         if isinstance(query, basestring):
-            return self._search_for_subscribers(query)  # query: UID
+            return self.signature_ids, self._subscriber_ids(query)  # UID
         if IItemSubscriber.providedBy(query) or valid_signature(query):
-            return self._search_for_items(query)  # query: sub or sig
+            return self.uid_ids, self._item_ids(query)  # sub or sig
         # query for named subscription relationships:
         k, v = query.items()[0]
         if IItemSubscriber.providedBy(v) or isinstance(v, tuple):
-            return self._search_for_items(query)  # tuple of uids
-        return self._search_for_subscribers(query)
-    
-    def index(self, subscriber, uid, names):
-        if isinstance(names, basestring):
-            names = (str(names),)
+            return self.uid_ids, self._item_ids(query)  # tuple of uids
+        return self.signature_ids, self._subscriber_ids(query)
+
+    def _query_key(self, query):
+        """normalized, hashable key for query (for result cache)"""
+        if isinstance(query, Query):
+            return query.key()
+        if isinstance(query, basestring):
+            return str(query)
+        if IItemSubscriber.providedBy(query) or valid_signature(query):
+            return self._signature(query)
+        return ('names',) + tuple(sorted(
+            (str(k), self._query_key(v)) for k, v in query.items()))
+
+    def _query_stamp(self, query):
+        """
+        Return stamp of generations of indexes searched by query, or None
+        if results for query cannot be cached (index without generation).
+        """
+        if isinstance(query, basestring) or valid_signature(query) or (
+                IItemSubscriber.providedBy(query)):
+            names = self.indexes.keys()  # unnamed: all indexes
+        elif isinstance(query, Query):
+            names = query.names()
+        else:
+            names = sorted(str(k) for k in query)
+        stamp = []
         for name in names:
             if name not in self.indexes:
-                self.indexes[name] = SubscriptionIndex(name)
-            idx = self.indexes[name]
-            idx.index(subscriber, uid)
-    
-    def unindex(self, subscriber, uid, names):
+                stamp.append((name, None))  # invalid once index is added
+                continue
+            generation = getattr(self.indexes[name], 'generation', None)
+            if generation is None:
+                return None
+            stamp.append((name, generation()))
+        return tuple(stamp)
+
+    def _result_cache(self):
+        """Return per-connection result cache, or None if disabled"""
+        if not self.cache_size:
+            return None
+        cache = getattr(self, '_v_result_cache', None)
+        if cache is None or cache.maxsize != self.cache_size:
+            cache = self._v_result_cache = ResultCache(self.cache_size)
+        return cache
+
+    def _cached_ids(self, query):
+        """
+        Return tuple of (cache, key, stamp, cached result or None) for
+        query; cache is None if disabled, or query cannot be cached.
+        """
+        cache = self._result_cache()
+        stamp = self._query_stamp(query) if cache is not None else None
+        if stamp is None:
+            return None, None, None, None
+        key = self._query_key(query)
+        return cache, key, stamp, cache.get(key, stamp)
+
+    def _search_ids(self, query):
+        """
+        Like _query_ids(), using cached ids if cache enabled, and cached
+        result is for the current generations of indexes searched.
+        """
+        cache, key, stamp, result = self._cached_ids(query)
+        if cache is None:
+            return self._query_ids(query)
+        if result is None:
+            table, ids = self._query_ids(query)
+            if not isinstance(ids, LLSet):
+                ids = LLSet(ids)  # do not keep reference to stored set
+            result = (table, ids)
+            cache.set(key, stamp, result)
+        return result
+
+    def cache_stats(self):
+        """
+        Return dict of statistics (hits, misses, evictions, size,
+        maxsize) of the result cache of this connection.
+        """
+        cache = self._result_cache()
+        if cache is None:
+            return {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0,
+                    'maxsize': 0}
+        return cache.stats()
+
+    def _as_query(self, query):
+        """
+        Return query as an equivalent IQuery, or None if it relates
+        nothing (names no index of this catalog).
+        """
+        if isinstance(query, Query):
+            return query
+        if isinstance(query, basestring) or valid_signature(query) or (
+                IItemSubscriber.providedBy(query)):
+            terms = [Related(name, query) for name in self.indexes.keys()]
+            return Or(*terms) if terms else None
+        terms = [Related(k, v) for k, v in query.items()
+                 if str(k) in self.indexes]
+        return And(*terms) if terms else None
+
+    def _stream_ids(self, query, limit=None):
+        """
+        Return tuple of (intern table, iterator over ids of result in
+        order, at most limit), from cache if cached, otherwise streamed.
+        """
+        cache, key, stamp, result = self._cached_ids(query)
+        if result is not None:
+            table, ids = result
+            stream = iter(ids)
+        else:
+            as_query = self._as_query(query)
+            if as_query is None:
+                return self.uid_ids, iter(())
+            table, stream = as_query.stream(self)
+        if limit is not None:
+            stream = islice(stream, limit)
+        return table, stream
+
+    def isearch(self, query, limit=None):
+        table, stream = self._stream_ids(query, limit)
+        get_value = table.get_value
+        for intid in stream:
+            yield get_value(intid)
+
+    def search(self, query, lazy=False, limit=None):
+        if limit is not None:
+            table, ids = self._stream_ids(query, limit)
+            ids = list(ids)
+        else:
+            table, ids = self._search_ids(query)
+        if lazy:
+            length = self._stored_size(query) if limit is None else None
+            return LazyResult(ids, table.get_value, length)
+        return tuple(table.resolve(ids))
+
+    def _stored_size(self, query):
+        """
+        Return size of result of query from an index counter, if the
+        result is the set stored by one index, else None (the result
+        is computed in memory, and its len() is cheap).
+        """
+        as_query = self._as_query(query)
+        if isinstance(as_query, (And, Or)) and len(as_query.queries) == 1:
+            as_query = as_query.queries[0]
+        if isinstance(as_query, Related):
+            return as_query.count(self)
+        return None
+
+    def explain(self, query):
+        as_query = self._as_query(query)
+        if as_query is None:
+            return []  # relates nothing: no steps
+        return as_query.explain(self)
+
+    def _names(self, names):
         if isinstance(names, basestring):
             names = (str(names),)
-        for name in names:
+        return names
+
+    def _get_or_create_index(self, name):
+        if name not in self.indexes:
+            self.indexes[name] = SubscriptionIndex(name,
+                                                   self.signature_ids,
+                                                   self.uid_ids)
+        return self.indexes[name]
+
+    def index(self, subscriber, uid, names):
+        now = time.time()
+        for name in self._names(names):
+            idx = self._get_or_create_index(name)
+            idx.index(subscriber, uid, timestamp=now)
+            if self.record_subscribed:
+                self.metadata.add_many(name, ((subscriber, uid),),
+                                       subscribed=now)
+            self.pair_names.add_many(name, ((subscriber, uid),))
+
+    def unindex(self, subscriber, uid, names):
+        for name in self._names(names):
             if name in self.indexes:
                 idx = self.indexes[name]
                 idx.unindex(subscriber, uid)
-    
-    def get_item(self, uid):
+                self.metadata.remove(name, subscriber, uid)
+                self.pair_names.remove_many(name, ((subscriber, uid),))
+
+    def _pairs(self, pairs, uids):
+        """normalize bulk arguments to list of (subscriber, uid) pairs"""
+        if uids is not None:
+            return [(pairs, uid) for uid in uids]
+        return list(pairs)
+
+    def index_many(self, pairs, names, uids=None):
+        pairs = self._pairs(pairs, uids)
+        added = 0
+        now = time.time()
+        for name in self._names(names):
+            idx = self._get_or_create_index(name)
+            added += idx.index_many(pairs, timestamp=now)
+            if self.record_subscribed:
+                self.metadata.add_many(name, pairs, subscribed=now)
+            self.pair_names.add_many(name, pairs)
+        return added
+
+    def unindex_many(self, pairs, names, uids=None):
+        pairs = self._pairs(pairs, uids)
+        removed = 0
+        for name in self._names(names):
+            if name in self.indexes:
+                removed += self.indexes[name].unindex_many(pairs)
+                self.metadata.remove_many(name, pairs)
+                self.pair_names.remove_many(name, pairs)
+        return removed
+
+    def load(self, triples, batch_size=10000, commit=False):
+        """
+        Bulk load associations from an iterable of (name, signature, uid)
+        triples (e.g. SubscriptionKeys.values(), or rows of an external
+        source), consumed in batches of batch_size.  Each batch is
+        indexed in sorted order, then followed by a transaction savepoint
+        (or if commit is True, a commit) and garbage collection of the
+        connection cache, such that memory use is bounded by batch size,
+        not by the size of the source.  Returns number of associations
+        added.
+        """
+        triples = iter(triples)
+        added = 0
+        while True:
+            batch = list(islice(triples, batch_size))
+            if not batch:
+                break
+            by_name = {}
+            for name, signature, uid in batch:
+                by_name.setdefault(str(name), []).append((signature, uid))
+            for name in sorted(by_name):
+                added += self.index_many(by_name[name], name)
+            checkpoint(self, commit)
+        return added
+
+    def _purge(self, triples, batch_size, commit):
+        """
+        Unindex (name, signature, uid) triples in batches, with a
+        checkpoint after each; return report of associations (and
+        metadata records) removed.
+        """
+        report = {'associations': 0, 'names': {}, 'metadata': 0,
+                  'keys': 0, 'pruned': False}
+        before = len(self.metadata)
+        triples = iter(triples)
+        while True:
+            batch = list(islice(triples, batch_size))
+            if not batch:
+                break
+            by_name = {}
+            for name, signature, uid in batch:
+                by_name.setdefault(name, []).append((signature, uid))
+            for name in sorted(by_name):
+                removed = self.unindex_many(by_name[name], name)
+                report['names'][name] = report['names'].get(name, 0) + removed
+                report['associations'] += removed
+            checkpoint(self, commit)
+        report['metadata'] = before - len(self.metadata)
+        return report
+
+    def _keys(self, keys):
+        if keys is None:
+            keys = queryUtility(ISubscriptionKeys)
+        return keys
+
+    def _revoke(self, keys, found, batch_size, commit):
+        """
+        Remove found (list of keys) from keys, in batches of batch_size,
+        each followed by a savepoint (or commit) of the transaction of
+        keys; returns number removed.
+        """
+        for start in xrange(0, len(found), batch_size):
+            for key in found[start:start + batch_size]:
+                del keys[key]
+            checkpoint(keys, commit)
+        return len(found)
+
+    def purge_item(self, uid, keys=None, prune_id=False, batch_size=10000,
+                   commit=False):
+        """
+        Remove all associations of item uid, by any name, found via the
+        forward set of each index (cost is in proportion to subscribers
+        of the item, not to size of the catalog), with their metadata,
+        in batches of batch_size, each followed by a savepoint (or commit,
+        if commit is True).  Subscription keys for the item are revoked
+        from keys (default: ISubscriptionKeys utility, if any), also in
+        batches.  If prune_id is True, remove uid from the intern table
+        (see caveat of compact() on concurrent indexing).  Returns report
+        dict.
+        """
+        uid = str(uid)
+        existing = list(self.indexes.items())
+        report = self._purge(((name, signature, uid)
+                              for name, idx in existing
+                              for signature in idx.subscribers_for(uid)),
+                             batch_size, commit)
+        keys = self._keys(keys)
+        if keys is not None:
+            report['keys'] = self._revoke(keys, keys.keys_for_item(uid),
+                                          batch_size, commit)
+        if prune_id and uid in self.uid_ids and not any(
+                idx.count_subscribers(uid) for name, idx in existing):
+            self.uid_ids.remove(uid)
+            report['pruned'] = True
+        return report
+
+    def purge_subscriber(self, subscriber, keys=None, prune_id=False,
+                         batch_size=10000, commit=False):
+        """
+        Remove all associations of subscriber (object or signature), by
+        any name, found via the reverse set of each index; otherwise
+        like purge_item().  Returns report dict.
+        """
+        signature = self._signature(subscriber)
+        existing = list(self.indexes.items())
+        report = self._purge(((name, signature, uid)
+                              for name, idx in existing
+                              for uid in idx.item_uids_for(signature)),
+                             batch_size, commit)
+        keys = self._keys(keys)
+        if keys is not None:
+            report['keys'] = self._revoke(
+                keys, keys.keys_for_subscriber(signature), batch_size, commit)
+        if prune_id and signature in self.signature_ids and not any(
+                idx.count_items(signature) for name, idx in existing):
+            self.signature_ids.remove(signature)
+            report['pruned'] = True
+        return report
+
+    def rebuild(self, triples=None, batch_size=10000, commit=False):
+        """
+        Clear all indexes, and reload from triples (see load()); if
+        triples is None, reload from the associations of existing indexes
+        (which may be used to migrate indexes persisted by an older
+        version of this package, and compacts intern tables).  Returns
+        number of associations loaded.
+        """
+        if triples is None:
+            existing = list(self.indexes.items())
+            triples = ((name, signature, uid)
+                       for name, idx in existing
+                       for signature, uid in idx.associations())
+        # metadata and timelines are keyed by interned ids: re-keyed after
+        # loading, read from the replaced objects (which stay readable)
+        metadata = self.metadata
+        if not IAssociationMetadata.providedBy(metadata):
+            metadata = None
+        timelines = [(name, idx) for name, idx in self.indexes.items()
+                     if getattr(idx, 'timeline', None) is not None]
+        for name in list(self.indexes.keys()):
+            del self.indexes[name]
+        self.signature_ids = InternTable()
+        self.uid_ids = InternTable()
+        self.indexes.signature_ids = self.signature_ids
+        self.indexes.uid_ids = self.uid_ids
+        self.metadata = AssociationMetadata(self.signature_ids, self.uid_ids)
+        self.pair_names = PairNames(self.signature_ids, self.uid_ids)
+        loaded = self.load(triples, batch_size, commit)
+        if metadata is not None:
+            self._copy_metadata(metadata, batch_size, commit)
+        for name, previous in timelines:
+            if name in self.indexes:
+                self.indexes[name].enable_timeline(
+                    self._subscribed(name, previous))
+        return loaded
+
+    def _copy_metadata(self, metadata, batch_size, commit):
+        """
+        Copy records of (replaced) metadata for associations in indexes,
+        in batches of batch_size, each followed by a checkpoint.
+        """
+        records = metadata.records()
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            for name, signature, uid, values in batch:
+                if signature in self.signature_ids and uid in self.uid_ids:
+                    self.metadata.update(name, signature, uid, **values)
+            checkpoint(self, commit)
+
+    def _subscribed(self, name, previous=None):
+        """
+        Return function of (signature, uid) returning time subscribed by
+        name: from the timeline of previous index (keyed by its own intern
+        tables), if given, else from metadata (see record_subscribed), or
+        None if not known.
+        """
+        metadata = self.metadata
+
+        def subscribed(signature, uid):
+            if previous is not None:
+                timestamp = previous.timeline.timestamp(
+                    previous.uid_ids.get_id(uid),
+                    previous.signature_ids.get_id(signature))
+                if timestamp is not None:
+                    return timestamp
+            record = metadata.get(name, signature, uid) or {}
+            return record.get('subscribed')
+
+        return subscribed
+
+    def enable_timeline(self, names=None):
+        """
+        Enable time-ordered secondary index for indexes named (default:
+        all indexes, creating those named that do not yet exist);
+        existing associations are added at times subscribed as recorded
+        in metadata, if recorded, or else now.
+        """
+        if names is None:
+            names = self.indexes.keys()
+        for name in self._names(names):
+            self._get_or_create_index(name).enable_timeline(
+                self._subscribed(name))
+
+    def names_for(self, subscriber, uid):
+        return list(self.pair_names.names(subscriber, uid))
+
+    def names_for_items(self, subscriber, uids):
+        names = self.pair_names.names_for_items(subscriber, uids)
+        return dict((uid, list(found)) for uid, found in names.items())
+
+    def _is_subscribed(self, signature, uid, name):
+        if name is not None:
+            idx = self.indexes.get(str(name), None)
+            return idx is not None and idx.is_subscribed(signature, uid)
+        return bool(self.pair_names.names(signature, uid))  # one probe
+
+    def is_subscribed(self, subscriber, uid, name=None, negative=None):
+        signature = self._signature(subscriber)
+        uid = str(uid)
+        key = (signature, uid, name)
+        if negative is not None and key in negative:
+            return False
+        found = self._is_subscribed(signature, uid, name)
+        if not found and negative is not None:
+            negative.add(key)
+        return found
+
+    def compact(self, prune_ids=False):
+        """
+        Maintenance: remove empty sets from all indexes, and remove empty
+        indexes.  If prune_ids is True, also remove values from intern
+        tables that are no longer referenced by any index; this should
+        not be run concurrently with indexing, which may re-use ids of
+        values being pruned.
+
+        Returns a report dict of what was freed: number of empty sets,
+        list of names of indexes removed, and number of signatures and
+        uids removed from intern tables.
+        """
+        report = {'sets': 0, 'indexes': [], 'signatures': 0, 'uids': 0}
+        for name, idx in list(self.indexes.items()):
+            report['sets'] += idx.compact()
+            if not len(idx):
+                del self.indexes[name]
+                report['indexes'].append(name)
+        if prune_ids:
+            referenced = [idx.referenced_ids()
+                          for idx in self.indexes.values()]
+            report['signatures'] = self.signature_ids.retain(
+                multiunion([sids for sids, uids in referenced]))
+            report['uids'] = self.uid_ids.retain(
+                multiunion([uids for sids, uids in referenced]))
+        return report
+
+    def _resolver(self):
         if not hasattr(self, '_v_resolver'):
             self._v_resolver = queryUtility(IItemResolver)
-        return self._v_resolver.get(uid)
-    
-    def get_subscriber(self, signature):
+        return self._v_resolver
+
+    def _container(self):
         if not hasattr(self, '_v_container'):
             self._v_container = queryUtility(ISubscribers)
-        return self._v_container.get(signature, None)
+        return self._v_container
+
+    def get_item(self, uid):
+        return self._resolver().get(uid)
+
+    def get_items(self, uids):
+        resolver = self._resolver()
+        if IBulkItemResolver.providedBy(resolver):
+            return list(resolver.get_many(list(uids)))
+        return [resolver.get(uid) for uid in uids]
+
+    def get_subscriber(self, signature):
+        return self._container().get(signature, None)
+
+    def get_subscribers(self, signatures):
+        container = self._container()
+        if hasattr(container, 'get_many'):
+            return container.get_many(signatures)
+        return [container.get(signature, None) for signature in signatures]
 
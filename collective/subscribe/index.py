@@ -1,9 +1,20 @@
+import random
+import time
+
 from persistent import Persistent
 from zope.interface import implements
 from zope.schema.fieldproperty import FieldProperty
-from BTrees.OOBTree import OOBTree, OOSet
+from BTrees.OOBTree import OOBTree
+from BTrees.LLBTree import LLSet
+from BTrees.Length import Length
 
 from collective.subscribe.interfaces import ISubscriptionIndex, IItemSubscriber
+from collective.subscribe.interned import InternTable
+from collective.subscribe.timeline import Timeline
+from collective.subscribe.utils import IdMapping, IdTreeSet
+
+
+GENERATION_STEP = 2 ** 31
 
 
 def _validate_signature(sig):
@@ -16,6 +27,67 @@ def _validate_signature(sig):
         raise ValueError('subscriber signature elements must be strings')
 
 
+def _insert(mapping, counts, key, values, size=None):
+    """
+    Insert values into set stored in mapping for key, creating the set
+    (and its Length counter, stored in counts, unless counts is None)
+    as needed; if given, size is a Length counting keys of mapping.
+    Return number of values added (not already members).
+    """
+    members = mapping.get(key, None)
+    if members is None:
+        members = mapping[key] = IdTreeSet()
+        if counts is not None:
+            counts[key] = Length()
+        if size is not None:
+            size.change(1)
+    added = members.update(values)
+    if added and counts is not None:
+        counts[key].change(added)
+    return added
+
+
+def _remove(mapping, counts, key, values, size=None):
+    """
+    Remove values from set stored in mapping for key, if found there,
+    removing the set (and its counter, if counts is not None) if it
+    becomes empty.  Return number of values removed.
+    """
+    members = mapping.get(key, None)
+    if members is None:
+        return 0
+    removed = 0
+    for value in values:
+        if value in members:
+            members.remove(value)
+            removed += 1
+    if removed and counts is not None:
+        counts[key].change(-removed)
+    if not members:
+        del mapping[key]  # prune empty set
+        if counts is not None:
+            del counts[key]
+        if size is not None:
+            size.change(-1)
+    return removed
+
+
+def _group(pairs):
+    """
+    Given iterable of (key, value) pairs, return list of (key, values)
+    sorted by key, with each list of values sorted, for bulk operations
+    with good bucket locality.
+    """
+    groups = {}
+    for key, value in pairs:
+        groups.setdefault(key, []).append(value)
+    return sorted((k, sorted(v)) for k, v in groups.iteritems())
+
+
+# Note: the two mapping classes below were used for the forward/reverse
+# mappings prior to integer interning of keys, and are retained only such
+# that indexes pickled by collective.subscribe 0.1 remain loadable.
+
 class ItemUIDToSignatureMapping(OOBTree):
     """
     OOBTree that validates keys as uid strings.
@@ -47,17 +119,83 @@ class SubscriptionIndex(Persistent):
     """
     Subscription index maintains forward/reverse index mappings between
     item UID strings and subscriber signature tuples.
+
+    Signatures and UIDs are interned as 64-bit integers (via intern
+    tables, which may be shared between indexes of a catalog), and the
+    forward/reverse mappings are LOBTree mappings of integer id to
+    LLTreeSet of integer ids.  Each forward set (subscribers of an
+    item, which may be large) has a (conflict-resolving) Length counter,
+    such that counts are available without loading sets; reverse sets
+    (items of a subscriber) are usually a single bucket, and are counted
+    by len(), saving an object per subscriber.
+
+    Concurrent index/unindex of different subscribers for the same item
+    (or different items for the same subscriber) modify the same set,
+    and are merged by BTrees conflict resolution; the trees used (see
+    utils.IdTreeSet, utils.IdMapping) have large leaf buckets, to make
+    unresolvable conflicts (bucket splits) rare.
     """
     implements(ISubscriptionIndex)
 
     name = FieldProperty(ISubscriptionIndex['name'])
 
-    def __init__(self, name):
+    timeline = None     # optional Timeline, see enable_timeline()
+
+    def __init__(self, name, signature_ids=None, uid_ids=None):
         if isinstance(name, unicode):
             name = name.encode('utf-8')
         self.name = name
-        self._forward = ItemUIDToSignatureMapping()
-        self._reverse = SignatureToItemUIDMapping()
+        if signature_ids is None:
+            signature_ids = InternTable()
+        if uid_ids is None:
+            uid_ids = InternTable()
+        self.signature_ids = signature_ids
+        self.uid_ids = uid_ids
+        self._clear()
+
+    def _clear(self):
+        self._forward = IdMapping()     # uid id -> IdTreeSet of signature ids
+        self._reverse = IdMapping()     # signature id -> IdTreeSet of uid ids
+        self._forward_counts = IdMapping()  # uid id -> Length
+        self._size = Length()   # number of items (keys of forward mapping)
+        # generation: bumped on each change to associations, such that
+        # cached search results can be validated; never reset, so that a
+        # generation value is never re-used for different contents.
+        if '_generation' not in self.__dict__:
+            self._generation = Length()
+        if self.timeline is not None:
+            self.timeline = Timeline()
+        self._bump()
+
+    def _bump(self):
+        """
+        Increase generation by a random amount: generations seen by
+        transactions later aborted are (almost certainly) never re-used
+        by committed changes.
+        """
+        self._generation.change(random.randint(1, GENERATION_STEP))
+
+    def _add(self, uid, sids):
+        """add signature ids to forward set for uid; return number added"""
+        added = _insert(self._forward, self._forward_counts, uid, sids,
+                        self._size)
+        if added:
+            self._bump()
+        return added
+
+    def _discard(self, uid, sids):
+        """remove signature ids from forward set for uid; return number"""
+        removed = _remove(self._forward, self._forward_counts, uid, sids,
+                          self._size)
+        if removed:
+            self._bump()
+        return removed
+
+    def _add_reverse(self, sid, uids):
+        return _insert(self._reverse, None, sid, uids)
+
+    def _discard_reverse(self, sid, uids):
+        return _remove(self._reverse, None, sid, uids)
 
     def _normalize_subscriber(self, sub):
         """normalize subscriber or signature to signature"""
@@ -66,7 +204,7 @@ class SubscriptionIndex(Persistent):
         _validate_signature(sub)
         return sub
 
-    def index(self, subscriber, item_uid):
+    def index(self, subscriber, item_uid, timestamp=None):
         """
         Given an subscriber and and item_uid, associate for this index in
         both (subscriber to items) and (item to subscribers) mappings.
@@ -74,24 +212,18 @@ class SubscriptionIndex(Persistent):
         The subscriber argument can be either a two-item tuple key or
         an IItemSubsriber object, in which case the key will be extracted
         by calling the signature() method of the subscriber.
+
+        If the timeline is enabled, a new association is added to it at
+        timestamp (default: now).
         """
-        # normalize key/value
+        # normalize key/value, then intern each:
         signature = self._normalize_subscriber(subscriber)
-        item_uid = str(item_uid)
-
-        # forward index
-        if item_uid not in self._forward:
-            self._forward[item_uid] = OOSet()
-        subscribers_for_item = self._forward[item_uid]
-        if signature not in subscribers_for_item:
-            subscribers_for_item.insert(signature)
-
-        # reverse index
-        if signature not in self._reverse:
-            self._reverse[signature] = OOSet()
-        items_for_subscriber = self._reverse[signature]
-        if item_uid not in items_for_subscriber:
-            items_for_subscriber.insert(item_uid)
+        sid = self.signature_ids.intern(signature)
+        uid = self.uid_ids.intern(str(item_uid))
+        self._add(uid, (sid,))  # forward index
+        self._add_reverse(sid, (uid,))  # reverse index
+        if self.timeline is not None:
+            self.timeline.add(uid, sid, timestamp or time.time())
 
     def unindex(self, subscriber, item_uid):
         """
@@ -102,21 +234,91 @@ class SubscriptionIndex(Persistent):
         an IItemSubsriber object, in which case the key will be extracted
         by calling the signature() method of the subscriber.
         """
-        # normalize key/value
+        # normalize key/value; ids unknown to intern tables are not indexed
         signature = self._normalize_subscriber(subscriber)
-        item_uid = str(item_uid)
+        sid = self.signature_ids.get_id(signature)
+        uid = self.uid_ids.get_id(str(item_uid))
+        if sid is None or uid is None:
+            return
+        self._discard(uid, (sid,))  # forward index, if found
+        self._discard_reverse(sid, (uid,))  # reverse index, if found
+        if self.timeline is not None:
+            self.timeline.remove(uid, sid)
+
+    def _bulk_ids(self, pairs, uids, create):
+        """
+        Normalize bulk input -- either iterable of (subscriber, uid) pairs,
+        or (if uids is not None) a single subscriber and iterable of uids
+        -- to a list of (signature id, uid id) pairs.  Each distinct
+        subscriber is normalized and validated only once, and ids are
+        looked up (or if create is True, interned) in bulk.  If create is
+        False, pairs with values not already interned are omitted (they
+        cannot be indexed).
+        """
+        if uids is not None:
+            signature = self._normalize_subscriber(pairs)
+            normalized = [(signature, str(uid)) for uid in uids]
+        else:
+            subscribers, normalized = {}, []
+            for subscriber, item_uid in pairs:
+                # subscriber objects first: SubscriberRecord is a tuple
+                if not IItemSubscriber.providedBy(subscriber):
+                    _validate_signature(subscriber)
+                    normalized.append((subscriber, str(item_uid)))
+                    continue
+                # memoize by identity: avoids repeated signature() calls
+                key = id(subscriber)
+                if key not in subscribers:
+                    subscribers[key] = (subscriber,
+                                        self._normalize_subscriber(subscriber))
+                normalized.append((subscribers[key][1], str(item_uid)))
+        if create:
+            sids = self.signature_ids.intern_many([p[0] for p in normalized])
+            item_ids = self.uid_ids.intern_many([p[1] for p in normalized])
+        else:
+            sids = self.signature_ids.get_ids([p[0] for p in normalized])
+            item_ids = self.uid_ids.get_ids([p[1] for p in normalized])
+        return [(sids[sig], item_ids[uid]) for sig, uid in normalized
+                if sig in sids and uid in item_ids]
 
-        # remove any association from forward index, if found
-        if item_uid in self._forward:
-            subscribers_for_item = self._forward[item_uid]
-            if signature in subscribers_for_item:
-                subscribers_for_item.remove(signature)
+    def index_many(self, pairs, uids=None, timestamp=None):
+        """
+        Bulk index: given an iterable of (subscriber, item_uid) pairs, or
+        a single subscriber and an iterable of uids (as uids argument),
+        associate each in this index.  Keys are grouped and sorted so that
+        each set is updated once, in key order.  New associations are
+        added to the timeline (if enabled) at timestamp (default: now).
+        Returns the number of new associations.
+        """
+        ids = self._bulk_ids(pairs, uids, create=True)
+        added = 0
+        for uid, sids in _group((uid, sid) for sid, uid in ids):
+            added += self._add(uid, sids)
+        for sid, item_ids in _group(ids):
+            self._add_reverse(sid, item_ids)
+        if self.timeline is not None:
+            timestamp = timestamp or time.time()
+            for sid, uid in ids:
+                self.timeline.add(uid, sid, timestamp)
+        return added
 
-        # remove from reverse index, if found:
-        if signature in self._reverse:
-            items_for_subscriber = self._reverse[signature]
-            if item_uid in items_for_subscriber:
-                items_for_subscriber.remove(item_uid)
+    def unindex_many(self, pairs, uids=None):
+        """
+        Bulk unindex: given an iterable of (subscriber, item_uid) pairs,
+        or a single subscriber and an iterable of uids (as uids argument),
+        remove any association of each from this index.  Returns the
+        number of associations removed.
+        """
+        ids = self._bulk_ids(pairs, uids, create=False)
+        removed = 0
+        for uid, sids in _group((uid, sid) for sid, uid in ids):
+            removed += self._discard(uid, sids)
+        for sid, item_ids in _group(ids):
+            self._discard_reverse(sid, item_ids)
+        if self.timeline is not None:
+            for sid, uid in ids:
+                self.timeline.remove(uid, sid)
+        return removed
 
     def item_uids_for(self, subscriber):
         """
@@ -126,19 +328,208 @@ class SubscriptionIndex(Persistent):
         an IItemSubsriber object, in which case the key will be extracted
         by calling the signature() method of the subscriber.
         """
-        signature = self._normalize_subscriber(subscriber)
-        if signature not in self._reverse:
-            return ()
-        return tuple(self._reverse[signature])  # iterate items/sub -> tuple
+        return tuple(self.uid_ids.resolve(self.item_ids_for(subscriber)))
 
     def subscribers_for(self, item_uid):
         """
         Given an item UID, find and return a tuple of subscriber signatures
         (composed keys) for subscribers an item in this index.
         """
-        item_uid = str(item_uid)
-        if item_uid not in self._forward:
-            return ()
-        return tuple(self._forward[item_uid])  # iterate subs/item -> tuple
+        ids = self.subscriber_ids_for(item_uid)
+        return tuple(self.signature_ids.resolve(ids))
 
+    def count_subscribers(self, item_uid):
+        """Return number of subscribers for item UID in this index."""
+        uid = self.uid_ids.get_id(str(item_uid))
+        counter = self._forward_counts.get(uid, None)
+        return counter() if counter is not None else 0
 
+    def count_items(self, subscriber):
+        """
+        Return number of items for subscriber in this index: len() of
+        the reverse set, usually a single bucket.
+        """
+        signature = self._normalize_subscriber(subscriber)
+        sid = self.signature_ids.get_id(signature)
+        if sid is None:
+            return 0
+        return len(self._reverse.get(sid, None) or ())
+
+    def is_subscribed(self, subscriber, item_uid):
+        """
+        Return True if subscriber (object or signature) is associated
+        with item UID in this index, without loading either set whole.
+        """
+        signature = self._normalize_subscriber(subscriber)
+        sid = self.signature_ids.get_id(signature)
+        uid = self.uid_ids.get_id(str(item_uid))
+        if sid is None or uid is None:
+            return False
+        return self._associated(sid, uid)
+
+    def _associated(self, sid, uid):
+        """
+        Membership test for (signature id, uid id): probes the reverse
+        set for the subscriber, usually a single bucket, rather than the
+        forward set for the item, which for a popular item is large.
+        """
+        items = self._reverse.get(sid, None)
+        return items is not None and uid in items
+
+    def __len__(self):
+        """Return number of items (UIDs) with subscribers in this index."""
+        return self._size()
+
+    def generation(self):
+        """
+        Return generation counter of this index, which increases with
+        every change to its associations.
+        """
+        return self._generation()
+
+    def item_ids_for(self, subscriber):
+        """
+        Return (stored, not copied) set of integer ids of item UIDs for
+        subscriber; callers must not modify the result.  Ids resolve to
+        UIDs via self.uid_ids.
+        """
+        signature = self._normalize_subscriber(subscriber)
+        sid = self.signature_ids.get_id(signature)
+        if sid is None:
+            return LLSet()
+        return self._reverse.get(sid, None) or LLSet()
+
+    def subscriber_ids_for(self, item_uid):
+        """
+        Return (stored, not copied) set of integer ids of subscriber
+        signatures for an item UID; callers must not modify the result.
+        Ids resolve to signatures via self.signature_ids.
+        """
+        uid = self.uid_ids.get_id(str(item_uid))
+        if uid is None:
+            return LLSet()
+        return self._forward.get(uid, None) or LLSet()
+
+    def associations(self):
+        """
+        Iterate over all (signature, item uid) pairs in this index, in
+        forward index order.
+        """
+        if isinstance(self._forward, ItemUIDToSignatureMapping):
+            # legacy (0.1) index, values not interned: see rebuild() of
+            # SubscriptionCatalog for migration.
+            for item_uid, signatures in self._forward.items():
+                for signature in signatures:
+                    yield (signature, item_uid)
+            return
+        get_signature = self.signature_ids.get_value
+        for uid, sids in self._forward.items():
+            item_uid = self.uid_ids.get_value(uid)
+            for sid in sids:
+                yield (get_signature(sid), item_uid)
+
+    def referenced_ids(self):
+        """
+        Return two-item tuple of sets of (signature ids, uid ids) of all
+        interned values referenced by this index.
+        """
+        return LLSet(self._reverse.keys()), LLSet(self._forward.keys())
+
+    def compact(self):
+        """
+        Remove any empty sets from forward/reverse mappings (unindex
+        removes sets as they become empty, but indexes created by older
+        versions may contain empty sets).  Returns number removed.
+        """
+        removed = 0
+        for mapping, counts in ((self._forward, self._forward_counts),
+                                (self._reverse, None)):
+            empty = [key for key, members in mapping.items() if not members]
+            for key in empty:
+                del mapping[key]
+                if counts is not None:
+                    counts.pop(key, None)
+            removed += len(empty)
+        self._size.set(len(self._forward))
+        return removed
+
+    def rebind(self, signature_ids, uid_ids):
+        """
+        Use the given intern tables for this index, re-keying existing
+        associations as needed (e.g. when an index created on its own is
+        added to a catalog using shared intern tables).
+        """
+        if signature_ids is self.signature_ids and uid_ids is self.uid_ids:
+            return
+        existing = list(self.associations())
+        times = {}
+        if self.timeline is not None:
+            get_signature = self.signature_ids.get_value
+            get_uid = self.uid_ids.get_value
+            for uid, sid, timestamp in self.timeline.entries():
+                times[(get_signature(sid), get_uid(uid))] = timestamp
+        self.signature_ids = signature_ids
+        self.uid_ids = uid_ids
+        self._clear()
+        for signature, item_uid in existing:
+            self.index(signature, item_uid, times.get((signature, item_uid)))
+
+    def enable_timeline(self, timestamps=None):
+        """
+        Enable time-ordered secondary index of associations (no-op if
+        already enabled).  Existing associations are added to it, at a
+        time given by optional timestamps function (of signature and item
+        uid, returning a timestamp or None), or else now.
+        """
+        if self.timeline is not None:
+            return
+        self.timeline = Timeline()
+        now = time.time()
+        get_signature = self.signature_ids.get_value
+        for uid, sids in self._forward.items():
+            item_uid = self.uid_ids.get_value(uid)
+            for sid in sids:
+                timestamp = None
+                if timestamps is not None:
+                    timestamp = timestamps(get_signature(sid), item_uid)
+                self.timeline.add(uid, sid, timestamp or now)
+
+    def disable_timeline(self):
+        self.timeline = None
+
+    def _check_timeline(self):
+        if self.timeline is None:
+            raise ValueError('timeline not enabled for index %s' % self.name)
+
+    def subscribers_between(self, item_uid, start=None, end=None,
+                            newest_first=False, limit=None):
+        """
+        Return list of (timestamp, signature) for subscribers of item
+        added at timestamps in [start, end) (either may be None, for an
+        open range), in time order, oldest or newest first, at most limit.
+        Requires timeline.
+        """
+        self._check_timeline()
+        uid = self.uid_ids.get_id(str(item_uid))
+        if uid is None:
+            return []
+        found = self.timeline.subscribers(uid, start, end, newest_first,
+                                          limit)
+        get_signature = self.signature_ids.get_value
+        return [(timestamp, get_signature(sid)) for timestamp, sid in found]
+
+    def items_between(self, subscriber, start=None, end=None,
+                      newest_first=False, limit=None):
+        """
+        Return list of (timestamp, item uid) for items subscriber was
+        associated with at timestamps in [start, end), like
+        subscribers_between().  Requires timeline.
+        """
+        self._check_timeline()
+        signature = self._normalize_subscriber(subscriber)
+        sid = self.signature_ids.get_id(signature)
+        if sid is None:
+            return []
+        found = self.timeline.items(sid, start, end, newest_first, limit)
+        get_uid = self.uid_ids.get_value
+        return [(timestamp, get_uid(uid)) for timestamp, uid in found]
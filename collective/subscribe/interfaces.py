@@ -1,4 +1,4 @@
-from zope.interface import Interface
+from zope.interface import Interface, Attribute
 from zope.interface import invariant, Invalid
 from zope.interface.common.mapping import IFullMapping
 from zope import schema
@@ -128,12 +128,70 @@ class ISubscribers(Interface):
         On an invalid key passed to add, raise a KeyError.
         """
 
+    inline = Attribute(
+        'Storage mode: if True, add() stores (copies values into)'
+        ' immutable, non-persistent records providing IItemSubscriber,'
+        ' inline in the container, such that many are loaded in one'
+        ' database read; records are modified by replacing them.')
+
+    def set_inline(inline=True, batch_size=1000, commit=False):
+        """
+        Set storage mode, converting stored subscribers to the storage
+        of the mode in batches of batch_size, each followed by a
+        transaction savepoint (or if commit is True, a commit); return
+        number of subscribers converted.
+        """
+
+    def keys_for_email(email):
+        """
+        Return list of keys of all records with email address (compared
+        without regard to case), regardless of how the records are keyed,
+        without inspecting every record in the container.
+        """
+
+    def keys_for_emails(emails):
+        """
+        Bulk form of keys_for_email(): given a sequence of email
+        addresses, return a dict of each to its list of keys.
+        """
+
+    def get_by_email(email):
+        """Return list of records with email address (see keys_for_email)"""
+
+    def iter_namespace(namespace, start=None, batch_size=1000):
+        """
+        Iterate over (key, subscriber) items with keys in namespace, in
+        order of identifier, optionally starting at identifier start
+        (inclusive, e.g. to resume an export), reading batch_size items
+        at a time; only items of namespace are read.
+        """
+
+    def count_namespace(namespace):
+        """Return number of subscribers in namespace, without iterating"""
+
+    def namespace_counts():
+        """Return dict of namespace to (non-zero) number of subscribers"""
+
+    def reindex_email(subscriber):
+        """
+        Update the email index for a stored subscriber (key or object),
+        needed only after the email of a stored (persistent) subscriber
+        object is changed in place.
+        """
+
     def get(key, default=None):
         """
         Given a subscriber key as either tuple of (namespace, userid) or
         as string email address, return record or default.
         """
 
+    def get_many(keys, default=None):
+        """
+        Bulk form of get(): given an iterable of subscriber keys (or
+        objects providing IItemSubscriber), return a list of the record
+        (or default) for each key, in the order given.
+        """
+
     def __getitem__(key):
         """
         Given a subscriber key as either tuple of (namespace, userid) or
@@ -220,9 +278,186 @@ class IItemsFor(Interface):
         ValueError complaining about such.
         """
 
+    def subscriptions_for(uids):
+        """
+        Given a sequence of item UIDs (e.g. for a page of a listing),
+        return dict of each UID to list of relationship names for which
+        the subscriber context is subscribed to that item.
+        """
+
 
 # utility and index interfaces:
 
+class IInternTable(Interface):
+    """
+    Two-way mapping of values (subscriber signature tuples or item UID
+    strings) to 64-bit integer ids.  Indexes store only these integer ids,
+    such that each distinct signature or UID is stored once per table,
+    and set operations compare integers rather than tuples/strings.
+
+    Ids are never re-used for another value while the value remains in
+    the table.
+    """
+
+    def intern(value):
+        """
+        Return the integer id for value, allocating and storing a new
+        id if the value is not yet known.
+        """
+
+    def get_id(value, default=None):
+        """Return integer id for value, or default if value is unknown."""
+
+    def get_value(intid, default=None):
+        """Return value for integer id, or default if id is unknown."""
+
+    def resolve(ids):
+        """
+        Given an iterable of integer ids, return an iterator of the
+        respective values, in the same order.
+        """
+
+    def remove(value):
+        """Remove value and its id from table; raise KeyError if unknown."""
+
+    def retain(ids):
+        """
+        Remove all values except those with ids in the given set of
+        integer ids.  Returns number of values removed.
+        """
+
+    def __contains__(value):
+        """Return True if value has an id in this table."""
+
+    def __len__():
+        """Return number of values interned."""
+
+
+class IAssociationMetadata(Interface):
+    """
+    Store of metadata for associations (relationships) of subscriber and
+    item by name: each record is a dict of schemaless name/value pairs
+    (e.g. 'subscribed' timestamp, delivery preferences, last notified
+    time), with values that must be pickleable.
+
+    Subscriber arguments may be objects providing IItemSubscriber or
+    signature tuples.  Records returned are copies; use update() to
+    modify a record.
+    """
+
+    def get(name, subscriber, uid, default=None):
+        """Return record (dict) for association, or default."""
+
+    def update(name, subscriber, uid, **values):
+        """
+        Set values on record for association, creating the record if
+        needed; returns the record.  Raises KeyError if subscriber or uid
+        are unknown to the catalog (never indexed).
+        """
+
+    def update_many(name, pairs, **values):
+        """
+        Bulk form of update() for iterable of (subscriber, uid) pairs,
+        e.g. to record last notified time for all recipients of a
+        notification; returns number of records updated.
+        """
+
+    def add_many(name, pairs, **values):
+        """
+        Create records with values for those (subscriber, uid) pairs
+        without a record; returns number of records added.
+        """
+
+    def remove(name, subscriber, uid):
+        """Remove record for association, if any."""
+
+    def remove_many(name, pairs):
+        """Bulk form of remove(); returns number of records removed."""
+
+    def for_item(uid, name=None):
+        """
+        Iterate over (name, signature, record) for all records for item
+        uid, or if name is given, for item uid and name, in one pass.
+        """
+
+    def records():
+        """Iterate over all (name, signature, uid, record) records."""
+
+    def __len__():
+        """Return number of records."""
+
+
+class IPairNames(Interface):
+    """
+    Index of relationship names by (subscriber, item) pair, answering
+    which names link a subscriber to an item without probing every
+    index of a catalog.  Subscriber arguments may be objects providing
+    IItemSubscriber or signature tuples.
+    """
+
+    def add_many(name, pairs):
+        """
+        Add name for each of an iterable of (subscriber, uid) pairs;
+        returns number of pairs name was added to.
+        """
+
+    def remove_many(name, pairs):
+        """
+        Remove name for each of an iterable of (subscriber, uid) pairs;
+        returns number of pairs name was removed from.
+        """
+
+    def names(subscriber, uid):
+        """Return sorted tuple of names linking subscriber and item uid."""
+
+    def names_for_items(subscriber, uids):
+        """
+        Bulk form of names(): return dict of each of uids to sorted tuple
+        of names linking subscriber and item, e.g. for a page of items.
+        """
+
+    def __len__():
+        """Return number of (subscriber, item) pairs linked by any name."""
+
+
+class IQuery(Interface):
+    """
+    Composable boolean query for ISubscriptionCatalog.search(), combined
+    with & (and), | (or) and ~ (not) operators.  All terms of a query
+    search for the same kind of result: items, or subscribers.
+    """
+
+    def kind():
+        """Return 'items' or 'subscribers': kind of result of query."""
+
+    def names():
+        """Return sorted tuple of index names used by query."""
+
+    def key():
+        """Return normalized, hashable key for query (for caching)."""
+
+    def ids(catalog):
+        """
+        Evaluate query against catalog: return tuple of (intern table,
+        set of integer ids); the set must not be modified.
+        """
+
+    def stream(catalog):
+        """
+        Return tuple of (intern table, iterator over integer ids of
+        result in order), evaluated lazily as the iterator is consumed.
+        """
+
+    def explain(catalog):
+        """
+        Evaluate query against catalog, and return list of steps taken,
+        in order: dicts with keys 'op' (operation: 'lookup',
+        'intersection', 'union', 'difference', or 'skip' for terms not
+        evaluated, as the result was already empty), 'term', 'size' (of
+        the set of the term) and 'result' (size after the step).
+        """
+
+
 class ISubscriptionIndex(Interface):
     """
     Each index is named, and is assumed to be accessed either via a
@@ -264,10 +499,12 @@ class ISubscriptionIndex(Interface):
         description=u'The relationship identifier for the subscription.',
         default='subscriber')
 
-    def index(subscriber, item_uid):
+    def index(subscriber, item_uid, timestamp=None):
         """
         Given an subscriber and and item_uid, associate for this index in
         both (subscriber to items) and (item to subscribers) mappings.
+        If the timeline of the index is enabled, a new association is
+        added to it at timestamp (default: now).
 
         The subscriber argument can be either a two-item tuple key or
         an IItemSubsriber object, in which case the key will be extracted
@@ -284,6 +521,20 @@ class ISubscriptionIndex(Interface):
         by calling the signature() method of the subscriber.
         """
 
+    def index_many(pairs, uids=None, timestamp=None):
+        """
+        Bulk form of index(): pairs is an iterable of two-item tuples of
+        (subscriber, item_uid), or if uids is passed an iterable of item
+        UIDs, pairs is a single subscriber to associate with each of
+        them.  Returns the number of associations added.
+        """
+
+    def unindex_many(pairs, uids=None):
+        """
+        Bulk form of unindex(), taking arguments like index_many().
+        Returns the number of associations removed.
+        """
+
     def item_uids_for(subscriber):
         """
         Find, return tuple of item UIDs given a subscriber for this index.
@@ -299,6 +550,75 @@ class ISubscriptionIndex(Interface):
         (composed keys) for subscribers an item in this index.
         """
 
+    def associations():
+        """
+        Return iterable of all (subscriber signature, item UID) pairs
+        associated by this index.
+        """
+
+    def count_subscribers(item_uid):
+        """
+        Return number of subscribers for item UID in this index, without
+        loading the subscribers.
+        """
+
+    def count_items(subscriber):
+        """
+        Return number of items for subscriber (object or signature) in
+        this index, from its set of item ids (usually a single bucket),
+        without resolving the items.
+        """
+
+    def is_subscribed(subscriber, item_uid):
+        """
+        Return True if subscriber (object or signature) is associated
+        with item UID in this index, else False.  Probes only the smaller
+        of the two sets for subscriber and item, without loading either.
+        """
+
+    def __len__():
+        """Return number of items with subscribers in this index."""
+
+    timeline = Attribute('Time-ordered secondary index, or None if not '
+                         'enabled.')
+
+    def enable_timeline(timestamps=None):
+        """
+        Enable the time-ordered secondary index (timeline) of this index,
+        maintained by index/unindex from then on.  Existing associations
+        are added at timestamps given by optional function of (signature,
+        item uid) returning a timestamp or None, or else now.
+        """
+
+    def disable_timeline():
+        """Remove timeline of this index."""
+
+    def subscribers_between(item_uid, start=None, end=None,
+                            newest_first=False, limit=None):
+        """
+        Return list of (timestamp, signature) for subscribers associated
+        with item at timestamps in [start, end) -- either may be None for
+        an open-ended range -- in time order (oldest or newest first),
+        at most limit; walks only the range asked for.  Raises ValueError
+        if timeline is not enabled.
+        """
+
+    def items_between(subscriber, start=None, end=None,
+                      newest_first=False, limit=None):
+        """
+        Return list of (timestamp, item uid) for items associated with
+        subscriber at timestamps in [start, end), like
+        subscribers_between(), e.g. limit=100, newest_first=True for the
+        100 most recent.
+        """
+
+    def generation():
+        """
+        Return integer generation of this index, which increases with
+        every change to its associations (and is never re-used), such
+        that results computed from the index can be cached.
+        """
+
 
 class ISubscriptionCatalog(Interface):
     """
@@ -321,16 +641,112 @@ class ISubscriptionCatalog(Interface):
                     u'relationship, keyed off of the unique triple of '
                     u'(subscriber key, item uid, relationship/index name) '
                     u'as subject/object/predicate.  Values are mappings '
-                    u'of schemaless name/value pairs.',
-        schema=IFullMapping,
+                    u'of schemaless name/value pairs; a subscribed '
+                    u'timestamp is recorded for new associations if '
+                    u'record_subscribed is set.',
+        schema=IAssociationMetadata,
+        )
+
+    record_subscribed = schema.Bool(
+        title=u'Record time subscribed',
+        description=u'If True, index operations record a subscribed '
+                    u'timestamp in metadata for new associations; off '
+                    u'by default, as this adds a write of the records of '
+                    u'an item to each subscription (see also timelines '
+                    u'of indexes, which record times of associations).',
+        default=False,
+        )
+
+    pair_names = schema.Object(
+        title=u'Relationship names by pair',
+        description=u'Names of relationships (indexes) linking each '
+                    u'subscriber and item, maintained by index and '
+                    u'unindex operations of the catalog.',
+        schema=IPairNames,
+        )
+
+    cache_size = schema.Int(
+        title=u'Result cache size',
+        description=u'Maximum number of search results cached per '
+                    u'database connection; 0 disables caching.',
+        default=0,
         )
 
-    def search(query):
+    def get_item(uid):
+        """
+        Resolve item object for UID via IItemResolver utility, or None.
+        """
+
+    def get_items(uids):
+        """
+        Bulk form of get_item(): return list of item objects (or None)
+        for each of uids, in order given; uses get_many() of resolver if
+        it provides IBulkItemResolver.
+        """
+
+    def get_subscriber(signature):
+        """
+        Resolve subscriber object for signature via ISubscribers utility,
+        or None.
+        """
+
+    def get_subscribers(signatures):
+        """
+        Bulk form of get_subscriber(): return list of subscriber objects
+        (or None) for each of signatures, in order given.
+        """
+
+    def cache_stats():
+        """
+        Return dict of statistics of the search result cache of the
+        current connection: hits, misses, evictions, size, maxsize.
+        """
+
+    def names_for(subscriber, uid):
+        """
+        Return sorted list of relationship names linking subscriber
+        (object or signature) and item uid.
+        """
+
+    def names_for_items(subscriber, uids):
+        """
+        Bulk form of names_for(): return dict of each of uids to sorted
+        list of names linking subscriber and item.
+        """
+
+    def is_subscribed(subscriber, uid, name=None, negative=None):
+        """
+        Return True if subscriber (object or signature) is related to
+        item uid by name, or by any name if name is None, else False.
+        This is a direct membership test: use it rather than testing
+        for uid in search(subscriber), which builds the whole result.
+
+        negative is an optional set (e.g. kept for the duration of a
+        request) of (signature, uid, name) keys known not to be related,
+        checked before, and updated after, each test; it is not
+        invalidated by index() and should be short-lived.
+        """
+
+    def search(query, lazy=False, limit=None):
         """
         Searches one or more indexes specified in query for relationships
         between subscribers and items.  What is returned in the result
         sequence (signatures or item uids) depends on the query passed.
 
+        If limit is given, return at most limit results, the first of
+        the full result, computed by streaming (see isearch()).
+
+        Returns a tuple, or if lazy is True, a lazy sequence (supporting
+        len(), iteration, indexing, slicing and batch(start, size), and
+        map(fn) for resolving objects, e.g. via get_subscriber) resolving
+        only results actually accessed.  Results are in internal (integer
+        id) order, which is stable, but is not the sort order of the
+        values.
+
+        If cache_size is non-zero, results are cached per connection,
+        keyed by the normalized query, and remain valid until any index
+        searched changes (see ISubscriptionIndex.generation()).
+
         Unnamed query (all subscriptions)
         ---------------------------------
 
@@ -371,6 +787,40 @@ class ISubscriptionCatalog(Interface):
 
         Search criteria/arguments for names of indexes not managed by this
         catalog should be ignored silently.
+
+        Boolean queries
+        ---------------
+
+        Query may also be an object providing IQuery, composed of terms
+        (collective.subscribe.query.Related(name, value), with values as
+        above) by And (&), Or (|) and Not (~, as a term of And), e.g.:
+
+            (Related('watch', sig) | Related('owner', sig)) &
+                ~Related('muted', sig)
+
+        Terms of names of indexes not managed by this catalog relate
+        nothing (are empty).
+        """
+
+    def isearch(query, limit=None):
+        """
+        Iterate over results of search(query), in the same order,
+        evaluating lazily as consumed: results of a single index are
+        read from its set, unions merge the sets of indexes, and
+        intersections filter the smallest set by membership in others,
+        such that cost is proportional to the results taken (e.g. to
+        check for any result), not to the size of the sets.  Stops
+        after limit results, if given.  Uses the result cache if a
+        result is cached, but does not cache.
+        """
+
+    def explain(query):
+        """
+        Given query providing IQuery, or any other query accepted by
+        search() (evaluated as an equivalent IQuery: And of named terms,
+        Or for unnamed queries), return the steps taken to evaluate it,
+        in order, with sizes of sets at each step (see IQuery.explain()).
+        A query naming no index of the catalog takes no steps.
         """
 
     def index(subscriber, uid, names):
@@ -397,7 +847,80 @@ class ISubscriptionCatalog(Interface):
 
         Note: empty indexes are not removed or pruned from self.indexes
         by this operation, as it is of little or no cost to leave them
-        around after creation, even if automatically created by index().
+        around after creation, even if automatically created by index();
+        see compact().
+        """
+
+    def index_many(pairs, names, uids=None):
+        """
+        Bulk form of index() for one or more relationship names: pairs is
+        an iterable of (subscriber, uid) tuples, or if uids is passed an
+        iterable of item UIDs, pairs is a single subscriber to associate
+        with each of them.  Returns the number of associations added.
+        """
+
+    def unindex_many(pairs, names, uids=None):
+        """
+        Bulk form of unindex(), taking arguments like index_many().
+        Returns the number of associations removed.
+        """
+
+    def load(triples, batch_size=10000, commit=False):
+        """
+        Bulk load associations from an iterable of three-item tuples of
+        (relationship name, subscriber signature, item uid), consuming
+        the iterable in batches of batch_size, with a transaction
+        savepoint (or commit, if commit is True) after each batch.
+        Returns number of associations added.
+        """
+
+    def rebuild(triples=None, batch_size=10000, commit=False):
+        """
+        Clear all indexes and load() from triples, or if triples is None,
+        reload associations of existing indexes.  Returns number of
+        associations loaded.
+        """
+
+    def purge_item(uid, keys=None, prune_id=False, batch_size=10000,
+                   commit=False):
+        """
+        Remove all associations of item uid (by any name) from indexes,
+        with their metadata, in batches of batch_size, each followed by
+        a transaction savepoint (or commit, if commit is True); cost is
+        in proportion to the item's own subscriptions.  Subscription
+        keys for the item are revoked from keys (an ISubscriptionKeys
+        mapping, default: the registered utility, if any), also in
+        batches of batch_size.  If prune_id
+        is True, the uid is also removed from the intern table.
+
+        Returns a dict reporting what was removed: associations (total,
+        and names, a dict by relationship name), metadata (records),
+        keys (subscription keys revoked) and pruned (True if uid was
+        removed from the intern table).
+        """
+
+    def purge_subscriber(subscriber, keys=None, prune_id=False,
+                         batch_size=10000, commit=False):
+        """
+        Like purge_item(), for all associations of subscriber (object or
+        signature), e.g. when a user is deleted; prune_id removes the
+        signature from the intern table.  Returns report dict.
+        """
+
+    def enable_timeline(names=None):
+        """
+        Enable timelines of indexes named (default: all), see
+        ISubscriptionIndex.enable_timeline(); existing associations are
+        added at time subscribed as recorded in metadata, if recorded
+        (see record_subscribed), or else now.
+        """
+
+    def compact(prune_ids=False):
+        """
+        Maintenance operation: reclaim storage left by unindexing, by
+        removing empty indexes (and any empty sets within indexes), and
+        optionally any interned signatures or UIDs no longer referenced
+        by any index.  Returns a dict reporting what was removed.
         """
 
     def get_item(uid):
@@ -445,6 +968,20 @@ class IItemResolver(Interface):
         """return resolved object for uid or None if not found"""
 
 
+class IBulkItemResolver(IItemResolver):
+    """
+    Optional extension of IItemResolver, for resolvers able to resolve
+    many items at once more efficiently than one at a time (for example,
+    with a single catalog query for a list of UIDs).
+    """
+
+    def get_many(uids):
+        """
+        Given a sequence of UIDs, return a sequence of resolved objects
+        (or None, if not found) for each, in the order given.
+        """
+
+
 class ISubscriptionKeys(IFullMapping):
     """
     Utility component acts as many-to-one mapping of string keys to
@@ -472,11 +1009,14 @@ class ISubscriptionKeys(IFullMapping):
     def generate(name, signature, uid):
         """Given name, signature, uid: generate a unique string key"""
 
-    def add(name, signature, uid):
+    def add(name, signature, uid, ttl=None):
         """
         Given name, signature, uid: generate key and add key/value to
         mapping; need not check for duplicate/existing, and should
-        just overwrite any existing entries for key. Returns generated
+        just overwrite any existing entries for key. If ttl (number of
+        seconds) is given, key expires after that time: from then on,
+        lookups of the key (mapping access, get(), in) treat it as
+        missing, though it is only removed by sweep().  Returns generated
         key.
         """
 
@@ -488,3 +1028,55 @@ class ISubscriptionKeys(IFullMapping):
         item uid string).
         """
 
+    def keys_for_subscriber(subscriber, name=None):
+        """
+        Given subscriber signature (or IItemSubscriber object), return a
+        list of all keys for that subscriber, optionally only those for
+        relationship name, including keys expired but not yet swept.
+        Implementations should not need to inspect every value of the
+        mapping to do so.
+        """
+
+    def keys_for_item(uid, name=None):
+        """
+        Given item UID, return a list of all keys for that item,
+        optionally only those for relationship name.
+        """
+
+    def revoke_subscriber(subscriber, name=None):
+        """
+        Remove all keys for subscriber (optionally only for name), e.g.
+        when a subscriber is removed; return number of keys removed.
+        """
+
+    def revoke_item(uid, name=None):
+        """
+        Remove all keys for item UID (optionally only for name), e.g.
+        when content is deleted; return number of keys removed.
+        """
+
+    def set_expiry(key, expires):
+        """
+        Set expiry time (seconds since epoch) of existing key, or if
+        expires is None, make key not expire; raises KeyError for a
+        key not in mapping.
+        """
+
+    def expires(key):
+        """Return expiry time of key, or None if key does not expire"""
+
+    def is_expired(key, now=None):
+        """Is key expired at time now (default: current time)?"""
+
+    def sweep(limit=1000, now=None):
+        """
+        Remove at most limit keys expired at time now (default: current
+        time); return number of keys removed.
+        """
+
+    def expiry_stats(now=None):
+        """
+        Return dict of counts: 'keys' (all), 'expiring' (with an expiry
+        time), 'expired' (expired, not yet swept) and 'live'; counts of
+        keys should not require walking the mapping.
+        """
@@ -0,0 +1,127 @@
+import random
+
+from persistent import Persistent
+from zope.interface import implements
+from BTrees.LLBTree import LLSet, difference
+from BTrees.Length import Length
+
+from collective.subscribe.interfaces import IInternTable
+from collective.subscribe.utils import IdMapping, ValueIdMapping
+
+
+# ids are allocated from [0, MAXID); headroom below the signed 64-bit
+# maximum leaves room for sequential allocation from a random start.
+MAXID = 2 ** 62
+
+
+class InternTable(Persistent):
+    """
+    Two-way mapping of values to 64-bit integer ids, suitable for use
+    as keys and set members in LL* BTrees.
+    """
+
+    implements(IInternTable)
+
+    _v_nextid = None
+
+    def __init__(self):
+        self._ids = ValueIdMapping()    # value -> id
+        self._values = IdMapping()      # id -> value
+        self.size = Length()
+
+    def _generate_id(self):
+        """
+        Generate an unused id.  Like zope.intid, start at a random id,
+        then allocate sequentially per-connection (via volatile attr):
+        concurrent writers rarely touch the same buckets, and ids
+        allocated by a single writer are adjacent (good bucket locality
+        for bulk operations).
+        """
+        while True:
+            if self._v_nextid is None:
+                self._v_nextid = random.randrange(0, MAXID)
+            intid = self._v_nextid
+            self._v_nextid += 1
+            if intid not in self._values:
+                return intid
+            self._v_nextid = None
+
+    def intern(self, value):
+        intid = self._ids.get(value, None)
+        if intid is None:
+            intid = self._generate_id()
+            self._ids[value] = intid
+            self._values[intid] = value
+            self.size.change(1)
+        return intid
+
+    def _lookup(self, values):
+        """
+        Probe for each distinct value, in sorted order: return dict of
+        value to id for known values, and sorted list of unknown values.
+        """
+        get = self._ids.get
+        known, unknown = {}, []
+        for value in sorted(set(values)):
+            intid = get(value, None)
+            if intid is None:
+                unknown.append(value)
+            else:
+                known[value] = intid
+        return known, unknown
+
+    def intern_many(self, values):
+        """
+        Bulk form of intern(): return dict of value to id for each of
+        values, allocating ids for values not yet known.  New values are
+        stored in sorted order, in one update of each mapping.
+        """
+        result, new = self._lookup(values)
+        if new:
+            ids = [self._generate_id() for v in new]
+            self._ids.update(zip(new, ids))
+            self._values.update(zip(ids, new))
+            self.size.change(len(new))
+            result.update(zip(new, ids))
+        return result
+
+    def get_ids(self, values):
+        """
+        Bulk form of get_id(): return dict of value to id for each of
+        values known to this table.
+        """
+        return self._lookup(values)[0]
+
+    def get_id(self, value, default=None):
+        return self._ids.get(value, default)
+
+    def get_value(self, intid, default=None):
+        return self._values.get(intid, default)
+
+    def resolve(self, ids):
+        values = self._values
+        return (values[intid] for intid in ids)
+
+    def remove(self, value):
+        intid = self._ids[value]  # may raise KeyError
+        del self._ids[value]
+        del self._values[intid]
+        self.size.change(-1)
+
+    def retain(self, ids):
+        """
+        Remove all values except those with ids in the given set of
+        integer ids; returns number of values removed.
+        """
+        stale = difference(LLSet(self._values.keys()), ids)
+        for intid in stale:
+            del self._ids[self._values[intid]]
+            del self._values[intid]
+        self.size.change(-len(stale))
+        return len(stale)
+
+    def __contains__(self, value):
+        return value in self._ids
+
+    def __len__(self):
+        return self.size()
@@ -1,28 +1,66 @@
+import time
 from hashlib import md5
 from base64 import urlsafe_b64encode as encode
 
 from zope.interface import implements
-from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from BTrees.LOBTree import LOBTree
+from BTrees.Length import Length
 
 from collective.subscribe.interfaces import ISubscriptionKeys
-from collective.subscribe.utils import valid_signature
+from collective.subscribe.utils import TreeAttributesMixin, valid_signature
+from collective.subscribe.utils import checkpoint, prefixed, signature_of
 
 
-# string form of tuple delimited by slashes, sub. sig. is numeric hash
-pathform = lambda name, sig, uid: '%s/%s/%s' % (name, hash(sig), uid)
-# md5 digest of string form:
-mkhash = lambda name, sig, uid: md5(pathform(name, sig, uid)).digest()
-# base64 encoding of md5 is URL-safe with last two bytes of padding removed:
-mkkey = lambda name, sig, uid: encode(mkhash(name, sig, uid))[:22]
+# key: md5 of canonical string form of triple -- name, signature elements
+# and uid, NUL-delimited -- which unlike hash() of the signature is stable
+# across processes, interpreters and platforms (keys generated on any node
+# are the same); base64 encoding of md5 is URL-safe with last two bytes of
+# padding removed:
+mkkey = lambda name, sig, uid: encode(
+    md5('\x00'.join((name, sig[0], sig[1], uid))).digest())[:22]
 
+# expiring keys are grouped by expiry time in buckets of EXPIRY_BUCKET
+# seconds, such that a sweep reads only the buckets that are due:
+EXPIRY_BUCKET = 60
 
-class SubscriptionKeys(OOBTree):
-    """Mapping of string keys to (name, subscriber signature, uid)"""
+
+class SubscriptionKeys(TreeAttributesMixin, OOBTree):
+    """
+    Mapping of string keys to (name, subscriber signature, uid).
+
+    Reverse indexes of (signature, key) and (uid, key) tuples, kept in
+    two OOTreeSets as attributes of the mapping, find all keys for a
+    subscriber or for an item in one range walk.
+
+    Keys may be added with a time to live; expiry times are kept by key,
+    and keys by expiry time bucket, such that sweep() removes expired
+    keys in bounded batches.  Lookups (mapping access, get(), in) treat
+    an expired key as missing from the time it expires; iteration and
+    len() include expired keys until swept.
+
+    Length counters of keys, and of keys with an expiry time, are kept
+    such that counts do not walk the (unbounded) mapping.
+    """
     implements(ISubscriptionKeys)
 
+    # mappings stored by 0.1 lack these:
+    _by_subscriber = _by_item = None
+    _expires = _expiring = None
+    size = _expires_size = None
+
+    def __init__(self, *args, **kwargs):
+        self._by_subscriber = OOTreeSet()   # (signature, key)
+        self._by_item = OOTreeSet()         # (uid, key)
+        self._expires = OOBTree()           # key -> expiry time
+        self._expiring = LOBTree()          # time bucket -> OOTreeSet of keys
+        self.size = Length()
+        self._expires_size = Length()
+        super(SubscriptionKeys, self).__init__(*args, **kwargs)
+
     key_description = u"Base64 encoded (trailing padding removed) md5 hash "\
-                      u"of a slash-delimited string containing the "\
-                      u"subscription name, long-integer hash of subscriber "\
+                      u"of a NUL-delimited string containing the "\
+                      u"subscription name, both elements of the subscriber "\
                       u"signature tuple, and item uid of subscribed content."
 
     def generate(self, name, signature, uid):
@@ -38,21 +76,362 @@ class SubscriptionKeys(OOBTree):
         if not (isinstance(value[0], str) and isinstance(value[2], str)):
             raise ValueError('Invalid subscription description tuple.')
 
-    def add(self, name, signature, uid):
+    def add(self, name, signature, uid, ttl=None):
         """
         Add item to container/mapping as value using generated key,
         return that key.  Validates, does not check for duplicates or
-        existing entries.  Returns generated key.
+        existing entries.  If ttl (seconds) is given, the key expires
+        after that time, otherwise it does not expire.  Returns
+        generated key.
         """
-        self._validate((name, signature, uid))
+        value = (name, signature, uid)
+        self._validate(value)
         key = mkkey(name, signature, uid)
-        self[key] = (name, signature, uid)
+        self._set(key, value)  # already validated
+        self._set_expiry(key, self._expiry_time(ttl))
         return key
 
+    def add_many(self, triples, ttl=None):
+        """
+        Bulk form of add(): validate, generate keys for an iterable of
+        (name, signature, uid) triples, and insert all in one sorted
+        pass; reverse index (and expiry) sets are each updated once for
+        all new keys.  Returns list of generated keys, in order given.
+        """
+        triples = [tuple(triple) for triple in triples]
+        for triple in triples:
+            self._validate(triple)
+        keys = [mkkey(*triple) for triple in triples]
+        expires = self._expiry_time(ttl)
+        get = super(SubscriptionKeys, self).get
+        setitem = super(SubscriptionKeys, self).__setitem__
+        counter = self._size()
+        pending = dict(zip(keys, triples))  # distinct keys
+        added = []
+        for key in sorted(pending):
+            triple = pending[key]
+            if get(key, None) is not None:
+                self._set(key, triple)  # existing key, as add() does
+                self._set_expiry(key, expires)
+                continue
+            setitem(key, triple)  # validated above, not again per item
+            added.append((key, triple))
+        if added:
+            counter.change(len(added))
+            self._link_many(added, expires)
+        return keys
+
+    def _link_many(self, items, expires):
+        """
+        Add reverse index (and expiry) entries for new (key, value) items,
+        each set updated once, in its own sort order.
+        """
+        by_subscriber, by_item = self._reverse()
+        by_subscriber.update(sorted((value[1], key) for key, value in items))
+        by_item.update(sorted((value[2], key) for key, value in items))
+        if expires is None:
+            return
+        keys = [key for key, value in items]
+        times, buckets = self._expiry()
+        counter = self._expiry_count()  # counted before update
+        times.update(dict.fromkeys(keys, expires))
+        counter.change(len(keys))
+        bucket = int(expires // EXPIRY_BUCKET)
+        members = buckets.get(bucket, None)
+        if members is None:
+            members = buckets[bucket] = OOTreeSet()
+        members.update(keys)
+
+    def rekey(self):
+        """
+        Re-generate keys of all entries using the current key generation
+        scheme (e.g. for entries added by an older version of this
+        package, which generated keys from the process-specific hash() of
+        signatures), keeping expiry times.  Returns number of entries
+        re-keyed.
+        """
+        stale = [(key, value, self.expires(key))
+                 for key, value in self.items() if key != mkkey(*value)]
+        for key, value, expires in stale:
+            del self[key]
+        keys = self.add_many(value for key, value, expires in stale)
+        for key, (old, value, expires) in zip(keys, stale):
+            self._set_expiry(key, expires)
+        return len(stale)
+
+    def _reverse(self):
+        """
+        Return reverse index sets, building them on first use for
+        mappings stored without them.
+        """
+        if self._by_subscriber is None:
+            self._by_subscriber = OOTreeSet()
+            self._by_item = OOTreeSet()
+            for key, value in self.items():
+                self._link(key, value)
+        return self._by_subscriber, self._by_item
+
+    def _link(self, key, value):
+        by_subscriber, by_item = self._reverse()
+        by_subscriber.insert((value[1], key))
+        by_item.insert((value[2], key))
+
+    def _unlink(self, key, value):
+        by_subscriber, by_item = self._reverse()
+        by_subscriber.remove((value[1], key))
+        by_item.remove((value[2], key))
+
+    def _set(self, key, value):
+        """set validated value for key, maintaining reverse indexes"""
+        existing = super(SubscriptionKeys, self).get(key, None)
+        if existing == value:
+            return
+        if existing is not None:
+            self._unlink(key, existing)
+        else:
+            self._size().change(1)
+        super(SubscriptionKeys, self).__setitem__(key, value)
+        self._link(key, value)
+
+    def _size(self):
+        """Length counter of keys, counting on first use if not kept"""
+        if self.size is None:
+            self.size = Length(super(SubscriptionKeys, self).__len__())
+        return self.size
+
+    def __len__(self):
+        """number of keys, including expired keys not yet swept"""
+        return self._size()()
+
+    def _live(self, key):
+        """is key (if stored) not expired?"""
+        if not self._expires:
+            return True  # common case: no expiring keys
+        expires = self._expires.get(key, None)
+        return expires is None or expires > time.time()
+
+    def __getitem__(self, key):
+        value = super(SubscriptionKeys, self).__getitem__(key)
+        if not self._live(key):
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = super(SubscriptionKeys, self).get(key, None)
+        if value is None or not self._live(key):
+            return default
+        return value
+
+    def __contains__(self, key):
+        return (super(SubscriptionKeys, self).__contains__(key) and
+                self._live(key))
+
+    has_key = __contains__
+
+    def _stored(self, key):
+        """is key stored, expired or not?"""
+        return super(SubscriptionKeys, self).__contains__(key)
+
     def __setitem__(self, key, value):
         """set item with validation of key, values"""
         if not isinstance(key, basestring):
             raise KeyError('Subscription key must be string')
         self._validate(value)
-        super(SubscriptionKeys, self).__setitem__(str(key), tuple(value))
+        self._set(str(key), tuple(value))
+
+    def __delitem__(self, key):
+        """remove key, expired or not"""
+        value = super(SubscriptionKeys, self).__getitem__(key)
+        counter = self._size()  # counted (if not kept) before removal
+        super(SubscriptionKeys, self).__delitem__(key)
+        counter.change(-1)
+        self._unlink(key, value)
+        self._set_expiry(key, None)
+
+    # BTree pop(), setdefault() and clear() do not call the methods
+    # above, so are overridden to keep reverse indexes (and counters):
+
+    def pop(self, key, *default):
+        if self._stored(key):
+            live = self._live(key)
+            value = super(SubscriptionKeys, self).__getitem__(key)
+            del self[key]  # removed, if expired
+            if live:
+                return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def setdefault(self, key, default):
+        if key not in self:
+            if self._stored(key):
+                del self[key]  # expired
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        super(SubscriptionKeys, self).clear()
+        self._by_subscriber = OOTreeSet()
+        self._by_item = OOTreeSet()
+        self._expires = OOBTree()
+        self._expiring = LOBTree()
+        self.size = Length()
+        self._expires_size = Length()
 
+    def _matching(self, keys, name):
+        if name is None:
+            return list(keys)
+        get = super(SubscriptionKeys, self).get  # expired keys included
+        return [key for key in keys if get(key)[0] == name]
+
+    def keys_for_subscriber(self, subscriber, name=None):
+        """
+        List of keys, in key order, for subscriber (signature or
+        IItemSubscriber object), optionally only those for name.
+        """
+        keys = prefixed(self._reverse()[0], signature_of(subscriber))
+        return self._matching(keys, name)
+
+    def keys_for_item(self, uid, name=None):
+        """
+        List of keys, in key order, for item uid, optionally only those
+        for name.
+        """
+        keys = prefixed(self._reverse()[1], str(uid))
+        return self._matching(keys, name)
+
+    def _revoke(self, keys):
+        for key in keys:
+            del self[key]
+        return len(keys)
+
+    def revoke_subscriber(self, subscriber, name=None):
+        """
+        Remove all keys for subscriber (optionally only those for name);
+        returns number of keys removed.
+        """
+        return self._revoke(self.keys_for_subscriber(subscriber, name))
+
+    def revoke_item(self, uid, name=None):
+        """
+        Remove all keys for item uid (optionally only those for name);
+        returns number of keys removed.
+        """
+        return self._revoke(self.keys_for_item(uid, name))
+
+    def _expiry_time(self, ttl):
+        return time.time() + ttl if ttl is not None else None
+
+    def _expiry(self):
+        """
+        Return expiry indexes, creating them on first use for mappings
+        stored without them.
+        """
+        if self._expires is None:
+            self._expires = OOBTree()
+            self._expiring = LOBTree()
+        return self._expires, self._expiring
+
+    def _expiry_count(self):
+        """Length counter of expiring keys, counting on first use"""
+        if self._expires_size is None:
+            self._expires_size = Length(len(self._expiry()[0]))
+        return self._expires_size
+
+    def _set_expiry(self, key, expires):
+        """set (or if expires is None, remove) expiry time of key"""
+        if expires is None and not self._expires:
+            return  # common case: no expiring keys
+        times, buckets = self._expiry()
+        previous = times.get(key, None)
+        if previous == expires:
+            return
+        counter = self._expiry_count()  # counted before change
+        if previous is not None:
+            bucket = int(previous // EXPIRY_BUCKET)
+            members = buckets[bucket]
+            members.remove(key)
+            if not members:
+                del buckets[bucket]  # prune empty bucket
+            del times[key]
+            counter.change(-1)
+        if expires is not None:
+            times[key] = expires
+            counter.change(1)
+            bucket = int(expires // EXPIRY_BUCKET)
+            members = buckets.get(bucket, None)
+            if members is None:
+                members = buckets[bucket] = OOTreeSet()
+            members.insert(key)
+
+    def set_expiry(self, key, expires):
+        """
+        Set expiry time (seconds since epoch) of existing key, or if
+        expires is None, make key not expire.
+        """
+        if not self._stored(key):
+            raise KeyError(key)
+        self._set_expiry(key, expires)
+
+    def expires(self, key):
+        """expiry time of key, or None if key does not expire"""
+        return self._expiry()[0].get(key, None)
+
+    def is_expired(self, key, now=None):
+        expires = self.expires(key)
+        now = time.time() if now is None else now
+        return expires is not None and expires <= now
+
+    def _due(self, now, limit=None):
+        """iterate over keys expired at time now, in expiry bucket order"""
+        times, buckets = self._expiry()
+        found = 0
+        for members in buckets.values(max=int(now // EXPIRY_BUCKET)):
+            for key in members:
+                if limit is not None and found >= limit:
+                    return
+                if times[key] <= now:
+                    found += 1
+                    yield key
+
+    def sweep(self, limit=1000, now=None):
+        """
+        Remove at most limit expired keys (all, if limit is None), oldest
+        expiry time buckets first; returns number of keys removed.
+        """
+        now = time.time() if now is None else now
+        return self._revoke(list(self._due(now, limit)))
+
+    def sweep_all(self, batch_size=1000, commit=False, now=None):
+        """
+        Remove all expired keys, in batches of at most batch_size, each
+        followed by a transaction savepoint (or if commit is True, a
+        commit), such that no one write is unbounded.  Returns number
+        of keys removed.
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        while True:
+            count = self.sweep(batch_size, now)
+            removed += count
+            if not count:
+                break
+            checkpoint(self, commit)
+            if count < batch_size:
+                break
+        return removed
+
+    def expiry_stats(self, now=None):
+        """
+        Return dict of counts of all keys, of keys with an expiry time,
+        of keys expired (not yet swept) and of live (not expired) keys.
+        """
+        now = time.time() if now is None else now
+        expired = sum(1 for key in self._due(now))
+        total = len(self)
+        return {
+            'keys': total,
+            'expiring': self._expiry_count()(),
+            'expired': expired,
+            'live': total - expired,
+            }
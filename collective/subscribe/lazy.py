@@ -0,0 +1,72 @@
+from itertools import imap, islice
+
+
+class LazyResult(object):
+    """
+    Lazy sequence of search results, in the spirit of ZCatalog's LazyMap:
+    wraps a set of integer ids, and only resolves values (and optionally
+    objects) for positions actually accessed.
+
+    Supports len(), iteration, indexing, slicing (resolving only the
+    slice), and batch(start, size).  Positions counted from the start
+    are reached by iterating over the set, loading only the buckets up
+    to the last position asked for; len() of a stored tree set loads all
+    of its buckets, so is only computed for negative positions (or
+    steps), unless the length is known, e.g. from an index counter.
+    """
+
+    def __init__(self, ids, resolve, length=None):
+        self._ids = ids
+        self._resolve = resolve  # function: id -> value
+        self._len = length
+
+    def __len__(self):
+        if self._len is None:
+            self._len = len(self._ids)
+        return self._len
+
+    def __iter__(self):
+        return imap(self._resolve, self._ids)
+
+    def _range(self, start, stop):
+        """iterate over ids in positions start to stop (or end, if None)"""
+        return islice(iter(self._ids), start, stop)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            if (start or 0) < 0 or (stop or 0) < 0 or (step or 1) < 0:
+                start, stop, step = index.indices(len(self))
+                if step < 0:
+                    ids = list(self._range(0, start + 1))
+                    return tuple(self._resolve(ids[i])
+                                 for i in xrange(start, stop, step))
+            ids = islice(iter(self._ids), start, stop, step)
+            return tuple(imap(self._resolve, ids))
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError('result index out of range')
+        for intid in self._range(index, index + 1):
+            return self._resolve(intid)
+        raise IndexError('result index out of range')
+
+    def __nonzero__(self):
+        return bool(self._ids)
+
+    def __repr__(self):
+        return '<%s of %s results>' % (self.__class__.__name__, len(self))
+
+    def batch(self, start, size):
+        """Return tuple of at most size values, beginning at start."""
+        return self[start:start + size]
+
+    def map(self, fn):
+        """
+        Return new LazyResult over the same ids, resolving each value
+        through fn, e.g. SubscriptionCatalog.get_subscriber or get_item
+        to load objects only for the results accessed.
+        """
+        resolve = self._resolve
+        return self.__class__(self._ids, lambda v: fn(resolve(v)),
+                              self._len)
@@ -0,0 +1,133 @@
+from persistent import Persistent
+from zope.interface import implements
+from BTrees.Length import Length
+
+from collective.subscribe.interfaces import IAssociationMetadata
+from collective.subscribe.utils import ValueMapping
+from collective.subscribe.utils import interned_pairs, signature_of
+
+
+class AssociationMetadata(Persistent):
+    """
+    Metadata (mappings of schemaless name/value pairs) for associations
+    of subscriber and item by relationship name.
+
+    Records are plain dicts stored (inline in buckets) in one OOBTree,
+    keyed by (uid id, name, signature id) using integer ids of the
+    intern tables shared with the indexes of a catalog, such that all
+    records for an item -- or for an item and name -- are adjacent, and
+    read in one range walk.  The tree has large leaf buckets (see
+    utils.ValueMapping), as records of a popular item are written
+    concurrently.
+    """
+
+    implements(IAssociationMetadata)
+
+    def __init__(self, signature_ids, uid_ids):
+        self.signature_ids = signature_ids
+        self.uid_ids = uid_ids
+        self._records = ValueMapping()
+        self.size = Length()
+
+    def _key(self, name, subscriber, uid):
+        """return key for triple, or None if values are not interned"""
+        sid = self.signature_ids.get_id(signature_of(subscriber))
+        uid = self.uid_ids.get_id(str(uid))
+        if sid is None or uid is None:
+            return None
+        return (uid, str(name), sid)
+
+    def get(self, name, subscriber, uid, default=None):
+        key = self._key(name, subscriber, uid)
+        record = self._records.get(key) if key is not None else None
+        if record is None:
+            return default
+        return dict(record)
+
+    def update(self, name, subscriber, uid, **values):
+        key = self._key(name, subscriber, uid)
+        if key is None:
+            raise KeyError('unknown subscriber or uid')
+        return self._update(key, values)
+
+    def _update(self, key, values, only_new=False):
+        record = self._records.get(key)
+        if record is None:
+            record = {}
+            self.size.change(1)
+        elif only_new:
+            return record
+        else:
+            record = dict(record)  # stored dict is not itself persistent
+        record.update(values)
+        self._records[key] = record
+        return dict(record)
+
+    def _keys(self, name, pairs):
+        """sorted distinct keys for (subscriber, uid) pairs, if interned"""
+        name = str(name)
+        ids = interned_pairs(self.signature_ids, self.uid_ids, pairs)
+        return sorted(set((uid, name, sid) for sid, uid in ids))
+
+    def update_many(self, name, pairs, **values):
+        """
+        Bulk form of update(): set values on records for each of an
+        iterable of (subscriber, uid) pairs, in key order; pairs with
+        values unknown to intern tables are skipped.  Returns number of
+        records updated.
+        """
+        keys = self._keys(name, pairs)
+        for key in keys:
+            self._update(key, values)
+        return len(keys)
+
+    def add_many(self, name, pairs, **values):
+        """
+        Like update_many(), but creates records only for pairs without
+        an existing record, leaving existing records unchanged.  Returns
+        number of records added.
+        """
+        before = self.size()
+        for key in self._keys(name, pairs):
+            self._update(key, values, only_new=True)
+        return self.size() - before
+
+    def remove(self, name, subscriber, uid):
+        key = self._key(name, subscriber, uid)
+        if key is not None and self._records.pop(key, None) is not None:
+            self.size.change(-1)
+
+    def remove_many(self, name, pairs):
+        """Bulk form of remove(); returns number of records removed."""
+        removed = 0
+        for key in self._keys(name, pairs):
+            if self._records.pop(key, None) is not None:
+                removed += 1
+        if removed:
+            self.size.change(-removed)
+        return removed
+
+    def for_item(self, uid, name=None):
+        uid = self.uid_ids.get_id(str(uid))
+        if uid is None:
+            return
+        if name is None:
+            lo, hi = (uid,), (uid + 1,)
+        else:
+            lo, hi = (uid, str(name)), (uid, str(name) + '\x00')
+        get_signature = self.signature_ids.get_value
+        for key, record in self._records.items(lo, hi, excludemax=True):
+            yield key[1], get_signature(key[2]), dict(record)
+
+    def records(self):
+        """
+        Iterate over all (name, signature, uid, values) records, in key
+        (item) order.
+        """
+        get_signature = self.signature_ids.get_value
+        get_uid = self.uid_ids.get_value
+        for (uid, name, sid), record in self._records.items():
+            yield name, get_signature(sid), get_uid(uid), dict(record)
+
+    def __len__(self):
+        return self.size()
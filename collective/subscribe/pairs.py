@@ -0,0 +1,97 @@
+from persistent import Persistent
+from zope.interface import implements
+from BTrees.Length import Length
+
+from collective.subscribe.interfaces import IPairNames
+from collective.subscribe.utils import ValueMapping
+from collective.subscribe.utils import interned_pairs, signature_of
+
+
+class PairNames(Persistent):
+    """
+    Relationship names by (subscriber, item) pair: a large-bucket OOBTree
+    keyed by (signature id, uid id) using integer ids of the intern
+    tables shared with the indexes of a catalog, with values of sorted
+    tuples of names, stored inline in buckets.  Names linking a
+    subscriber to an item are found in one probe, and pairs of one
+    subscriber are adjacent, such that names for a page of items are
+    found in key order.  Large buckets split rarely, so concurrent
+    subscriptions seldom conflict on the tree.
+    """
+
+    implements(IPairNames)
+
+    def __init__(self, signature_ids, uid_ids):
+        self.signature_ids = signature_ids
+        self.uid_ids = uid_ids
+        self._names = ValueMapping()
+        self.size = Length()
+
+    def _keys(self, pairs):
+        """sorted distinct keys for (subscriber, uid) pairs, if interned"""
+        return sorted(set(interned_pairs(self.signature_ids, self.uid_ids,
+                                         pairs)))
+
+    def add_many(self, name, pairs):
+        """
+        Add name for each of an iterable of (subscriber, uid) pairs, in
+        key order; returns number of pairs name was added to.
+        """
+        name = str(name)
+        added = 0
+        for key in self._keys(pairs):
+            names = self._names.get(key, ())
+            if name in names:
+                continue
+            if not names:
+                self.size.change(1)
+            self._names[key] = tuple(sorted(names + (name,)))
+            added += 1
+        return added
+
+    def remove_many(self, name, pairs):
+        """
+        Remove name for each of an iterable of (subscriber, uid) pairs;
+        returns number of pairs name was removed from.
+        """
+        name = str(name)
+        removed = 0
+        for key in self._keys(pairs):
+            names = self._names.get(key, ())
+            if name not in names:
+                continue
+            names = tuple(n for n in names if n != name)
+            if names:
+                self._names[key] = names
+            else:
+                del self._names[key]
+                self.size.change(-1)
+            removed += 1
+        return removed
+
+    def names(self, subscriber, uid):
+        sid = self.signature_ids.get_id(signature_of(subscriber))
+        uid = self.uid_ids.get_id(str(uid))
+        if sid is None or uid is None:
+            return ()
+        return self._names.get((sid, uid), ())
+
+    def names_for_items(self, subscriber, uids):
+        """
+        Bulk form of names(): return dict of each of uids to tuple of
+        names, probing pairs of subscriber in key order.
+        """
+        uids = [str(uid) for uid in uids]
+        result = dict((uid, ()) for uid in uids)
+        sid = self.signature_ids.get_id(signature_of(subscriber))
+        if sid is None:
+            return result
+        ids = self.uid_ids.get_ids(uids)
+        get = self._names.get
+        for uid_id, uid in sorted((uid_id, uid) for uid, uid_id in
+                                  ids.items()):
+            result[uid] = get((sid, uid_id), ())
+        return result
+
+    def __len__(self):
+        return self.size()
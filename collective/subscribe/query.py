@@ -0,0 +1,343 @@
+"""
+Composable boolean queries for SubscriptionCatalog.search(), e.g. for
+items a subscriber watches or owns, but has not muted:
+
+    (Related('watch', sig) | Related('owner', sig)) & ~Related('muted', sig)
+
+Each Related term is the set of integer ids an index relates to a value:
+item ids for a subscriber (or signature), or subscriber ids for an item
+UID; all terms of a query must be of the same kind.  Sets are combined
+with native BTrees set operations: And intersects its terms smallest
+(estimated, from index counters, without loading sets) first, stopping
+as soon as the intersection is empty, then takes the difference of any
+negated (Not) terms.
+
+Queries can also be streamed: ids of the result are iterated in order,
+without computing the whole result first, such that taking the first N
+costs in proportion to N (and the ids skipped), not to the size of the
+sets: Or merges the (ordered) streams of its terms, And filters the
+stream of its smallest term by membership in the sets of the others.
+"""
+
+import heapq
+
+from zope.interface import implements
+from BTrees.LLBTree import LLSet, difference, intersection, multiunion
+
+from collective.subscribe.interfaces import IItemSubscriber, IQuery
+from collective.subscribe.utils import valid_signature
+
+
+ITEMS = 'items'
+SUBSCRIBERS = 'subscribers'
+
+
+class _Plan(object):
+    """
+    State of one evaluation of a query against a catalog: sets looked
+    up (each once), and steps taken, for explain().
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.sets = {}
+        self.steps = []
+
+    def lookup(self, term):
+        key = term.key()
+        if key not in self.sets:
+            idx = self.catalog.indexes.get(term.name, None)
+            if idx is None:
+                ids = LLSet()  # unknown name: relates nothing
+            elif term.kind() == SUBSCRIBERS:
+                ids = idx.subscriber_ids_for(term.value)
+            else:
+                ids = idx.item_ids_for(term.value)
+            self.sets[key] = ids
+        return self.sets[key]
+
+    def step(self, op, term, size, result):
+        self.steps.append({'op': op, 'term': repr(term), 'size': size,
+                           'result': result})
+
+
+class Query(object):
+    """Base for query nodes; combine with &, | and ~ operators."""
+
+    implements(IQuery)
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def _plan(self, catalog):
+        plan = _Plan(catalog)
+        ids = self._ids(plan)
+        return plan, ids
+
+    def ids(self, catalog):
+        """
+        Return tuple of (intern table, set of integer ids) of result;
+        the set may be stored by an index, and must not be modified.
+        """
+        plan, ids = self._plan(catalog)
+        if self.kind() == SUBSCRIBERS:
+            return catalog.signature_ids, ids
+        return catalog.uid_ids, ids
+
+    def explain(self, catalog):
+        """
+        Evaluate query, returning list of steps taken, in order: dicts
+        of operation ('lookup', 'intersection', 'union', 'difference',
+        or 'skip' for terms not evaluated), term, size of the term's
+        set and size of the result after the step.
+        """
+        return self._plan(catalog)[0].steps
+
+    def stream(self, catalog):
+        """
+        Return tuple of (intern table, iterator over integer ids of
+        result, in order), evaluated lazily as consumed.
+        """
+        stream = self._stream(_Plan(catalog))
+        if self.kind() == SUBSCRIBERS:
+            return catalog.signature_ids, stream
+        return catalog.uid_ids, stream
+
+    def _stream(self, plan):
+        return iter(self._ids(plan))
+
+
+def _merge(streams):
+    """lazy union: iterate over distinct ids of ordered id streams, in order"""
+    last = None
+    for intid in heapq.merge(*streams):
+        if intid != last:
+            yield intid
+            last = intid
+
+
+def _kind(queries):
+    kinds = set(query.kind() for query in queries)
+    if len(kinds) != 1:
+        raise ValueError('query combines terms for items and subscribers')
+    return kinds.pop()
+
+
+class Related(Query):
+    """
+    Term: ids related by index name to value; item UID ids for a
+    subscriber (object or signature), subscriber ids for an item UID.
+    """
+
+    def __init__(self, name, value):
+        if IItemSubscriber.providedBy(value):
+            value = value.signature()
+        elif isinstance(value, basestring):
+            value = str(value)
+        elif not valid_signature(value):
+            raise ValueError('value must be subscriber, signature or UID')
+        self.name = str(name)
+        self.value = value
+
+    def kind(self):
+        return SUBSCRIBERS if isinstance(self.value, str) else ITEMS
+
+    def names(self):
+        return (self.name,)
+
+    def key(self):
+        return ('related', self.name, self.value)
+
+    def count(self, catalog):
+        """number of ids related, from index counters, not the set"""
+        idx = catalog.indexes.get(self.name, None)
+        if idx is None:
+            return 0
+        if self.kind() == SUBSCRIBERS:
+            return idx.count_subscribers(self.value)
+        return idx.count_items(self.value)
+
+    def cost(self, plan):
+        return self.count(plan.catalog)  # len() of a set walks buckets
+
+    def _ids(self, plan):
+        ids = plan.lookup(self)
+        size = self.cost(plan)
+        plan.step('lookup', self, size, size)
+        return ids
+
+    def _stream(self, plan):
+        return iter(plan.lookup(self))
+
+    def __repr__(self):
+        return 'Related(%r, %r)' % (self.name, self.value)
+
+
+class _Compound(Query):
+
+    op = None
+
+    def __init__(self, *queries):
+        flat = []
+        for query in queries:
+            if not isinstance(query, Query):
+                raise ValueError('%s of non-query: %r' % (self.op, query))
+            if type(query) is type(self):
+                flat.extend(query.queries)  # (a & b) & c is And(a, b, c)
+            else:
+                flat.append(query)
+        if not flat:
+            raise ValueError('%s of no queries' % self.op)
+        self.queries = tuple(flat)
+        self.kind()  # validate
+
+    def kind(self):
+        return _kind(self.queries)
+
+    def names(self):
+        return tuple(sorted(set(name for query in self.queries
+                                for name in query.names())))
+
+    def key(self):
+        return (self.op,) + tuple(sorted(query.key()
+                                         for query in self.queries))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join(repr(q) for q in self.queries))
+
+
+class And(_Compound):
+    """
+    Intersection of queries, smallest (estimated) first, then difference
+    of negated (Not) queries; requires at least one query not negated.
+    """
+
+    op = 'and'
+
+    def __init__(self, *queries):
+        super(And, self).__init__(*queries)
+        if not self._positive():
+            raise ValueError('And of only negated queries')
+
+    def _positive(self):
+        return [q for q in self.queries if not isinstance(q, Not)]
+
+    def _negative(self):
+        return [q.query for q in self.queries if isinstance(q, Not)]
+
+    def cost(self, plan):
+        return min(query.cost(plan) for query in self._positive())
+
+    def _ordered(self, plan):
+        """positive queries, smallest (estimated) first"""
+        positive = self._positive()
+        if len(positive) == 1:
+            return positive  # nothing to order: no estimates needed
+        return sorted(positive, key=lambda q: q.cost(plan))
+
+    def _ids(self, plan):
+        ordered = self._ordered(plan)
+        result = None
+        for query in ordered:
+            if result is not None and not result:
+                plan.step('skip', query, None, 0)  # short-circuit
+                continue
+            ids = query._ids(plan)
+            if result is None:
+                result = ids
+            else:
+                result = intersection(result, ids)
+                plan.step('intersection', query, len(ids), len(result))
+        for query in sorted(self._negative(), key=lambda q: q.cost(plan)):
+            if not result:
+                plan.step('skip', Not(query), None, 0)
+                continue
+            ids = query._ids(plan)
+            result = difference(result, ids)
+            plan.step('difference', query, len(ids), len(result))
+        return result
+
+    def _members(self, query, plan):
+        if isinstance(query, Related):
+            return plan.lookup(query)  # stored set
+        return query._ids(plan)
+
+    def _stream(self, plan):
+        ordered = self._ordered(plan)
+        included = [self._members(q, plan) for q in ordered[1:]]
+        if not all(included):
+            return
+        excluded = [self._members(q, plan) for q in self._negative()]
+        excluded = [ids for ids in excluded if ids]
+        for intid in ordered[0]._stream(plan):
+            for ids in included:
+                if intid not in ids:
+                    break
+            else:
+                for ids in excluded:
+                    if intid in ids:
+                        break
+                else:
+                    yield intid
+
+
+class Or(_Compound):
+    """Union of (non-negated) queries."""
+
+    op = 'or'
+
+    def __init__(self, *queries):
+        super(Or, self).__init__(*queries)
+        if [q for q in self.queries if isinstance(q, Not)]:
+            raise ValueError('negated query must be combined with And')
+
+    def cost(self, plan):
+        return sum(query.cost(plan) for query in self.queries)
+
+    def _ids(self, plan):
+        sets = [query._ids(plan) for query in self.queries]
+        if len(sets) == 1:
+            return sets[0]
+        result = multiunion(sets)
+        plan.step('union', self, sum(len(ids) for ids in sets), len(result))
+        return result
+
+    def _stream(self, plan):
+        return _merge([query._stream(plan) for query in self.queries])
+
+
+class Not(Query):
+    """Negated query; only meaningful as a term of And."""
+
+    def __init__(self, query):
+        if not isinstance(query, Query):
+            raise ValueError('Not of non-query: %r' % (query,))
+        self.query = query
+
+    def __invert__(self):
+        return self.query
+
+    def kind(self):
+        return self.query.kind()
+
+    def names(self):
+        return self.query.names()
+
+    def key(self):
+        return ('not', self.query.key())
+
+    def cost(self, plan):
+        return self.query.cost(plan)
+
+    def _ids(self, plan):
+        raise ValueError('negated query must be combined with And')
+
+    def __repr__(self):
+        return 'Not(%r)' % (self.query,)
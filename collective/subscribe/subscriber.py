@@ -1,10 +1,28 @@
+from collections import namedtuple
+from itertools import islice
+
 import persistent
 from zope.interface import implements
-from BTrees.OOBTree import OOBTree
+from zope.schema.fieldproperty import FieldProperty
+from BTrees.OOBTree import OOBTree, OOTreeSet
 from BTrees.Length import Length
 
 from collective.subscribe.interfaces import IItemSubscriber, ISubscribers
 from collective.subscribe.utils import bind_field_properties
+from collective.subscribe.utils import TreeAttributesMixin, prefixed
+from collective.subscribe.utils import checkpoint
+
+
+class SignatureFieldProperty(FieldProperty):
+    """
+    Field property for a field of which the subscriber signature is
+    composed: setting the field invalidates the signature cached on
+    the instance.
+    """
+
+    def __set__(self, inst, value):
+        super(SignatureFieldProperty, self).__set__(inst, value)
+        inst.__dict__.pop('_v_signature', None)
 
 
 class ItemSubscriber(persistent.Persistent):
@@ -13,6 +31,13 @@ class ItemSubscriber(persistent.Persistent):
     implements(IItemSubscriber)
 
     bind_field_properties(locals(), IItemSubscriber)  # props from field schema
+    bind_field_properties(locals(), IItemSubscriber,
+                          ('namespace', 'user', 'email'),
+                          SignatureFieldProperty)
+
+    # Signature, computed (and invariant validated) once, until a field it
+    # is composed of is set; volatile, so not stored with the subscriber:
+    _v_signature = None
 
     def __init__(self, **kwargs):
         """
@@ -45,37 +70,109 @@ class ItemSubscriber(persistent.Persistent):
         zope.interface.Invalid exception if signature is not possible due to
         insufficient field data.
         """
-        IItemSubscriber.validateInvariants(self)  # may raise Invalid...
-        namespace = self.namespace
-        identifier = self.user
+        signature = self._v_signature
+        if signature is None:
+            IItemSubscriber.validateInvariants(self)  # may raise Invalid...
+            namespace = self.namespace
+            identifier = self.user
+            if self.email and not self.user:
+                namespace = 'email'  # ignore field default
+                identifier = self.email
+            signature = self._v_signature = (namespace, identifier)
+        return signature
+
+
+def _load_record(*values):
+    """unpickle SubscriberRecord, without validating again"""
+    return tuple.__new__(SubscriberRecord, values)
+
+
+class SubscriberRecord(namedtuple('SubscriberRecord',
+                                  ('namespace', 'user', 'email', 'name'))):
+    """
+    Lightweight, immutable subscriber record: a tuple of field values
+    without instance dict or persistence of its own, stored (pickled)
+    inline in the bucket of the container holding it.  Fields are
+    validated once, on construction; use replace() for a modified copy.
+    """
+
+    implements(IItemSubscriber)
+
+    __slots__ = ()
+
+    def __new__(cls, namespace='member', user=None, email=None, name=None):
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        if isinstance(email, unicode):
+            email = email.encode('utf-8')
+        if isinstance(name, str):
+            name = name.decode('utf-8')
+        if isinstance(namespace, unicode):
+            namespace = namespace.encode('utf-8')
+        record = super(SubscriberRecord, cls).__new__(
+            cls, namespace, user, email, name)
+        for fieldname in cls._fields:
+            IItemSubscriber[fieldname].validate(getattr(record, fieldname))
+        IItemSubscriber.validateInvariants(record)
+        return record
+
+    @classmethod
+    def from_fields(cls, fields):
+        """construct from a mapping of field values, ignoring other keys"""
+        return cls(**dict((k, fields[k]) for k in cls._fields if k in fields))
+
+    @classmethod
+    def from_subscriber(cls, subscriber):
+        """construct from field values of an IItemSubscriber object"""
+        return cls(*[getattr(subscriber, k, None) for k in cls._fields])
+
+    def __reduce__(self):
+        return (_load_record, tuple(self))
+
+    def replace(self, **fields):
+        values = self._asdict()
+        values.update(fields)
+        return SubscriberRecord(**values)
+
+    def signature(self):
+        """see ItemSubscriber.signature(); invariant is validated on init"""
         if self.email and not self.user:
-            namespace = 'email'  # ignore field default
-            identifier = self.email
-        return (namespace, identifier)
+            return ('email', self.email)
+        return (self.namespace, self.user)
 
 
-class SubscribersContainer(OOBTree):
-    """Container/mapping for subscribers"""
+class SubscribersContainer(TreeAttributesMixin, OOBTree):
+    """
+    Container/mapping for subscribers.
+
+    In inline mode, add() stores subscribers as immutable SubscriberRecord
+    values in the buckets of the tree, instead of persistent ItemSubscriber
+    objects each loaded on their own: loading a bucket loads the records
+    for a range of keys in one database read.
+
+    A secondary index of (lower-case) email address to keys of records
+    with that email is kept in an OOTreeSet of (email, key) tuples, along
+    with the indexed email by key.
+
+    Keys of a namespace are contiguous in the tree, so are iterated by
+    range; a Length counter is kept per namespace.
+    """
     implements(ISubscribers)
 
+    inline = False
+    # containers stored by 0.1 lack these:
+    _by_email = _email_of = None
+    _namespace_sizes = None
+
     def __init__(self, *args, **kwargs):
+        inline = kwargs.pop('inline', False)
         super(SubscribersContainer, self).__init__(*args, **kwargs)
         self.size = Length()
-
-    # wrap superclass __getstate__ and __setstate__ to save attrs such
-
-    def __getstate__(self):
-        tree_state = super(SubscribersContainer, self).__getstate__()
-        attr_state = [(k, v) for k, v in self.__dict__.items()
-                      if not (k.startswith('_v_') or k.startswith('__'))]
-        return (tree_state, attr_state)
-
-    def __setstate__(self, v):
-        tree_state = v[0]
-        attr_state = v[1]
-        for k, v in attr_state:
-            setattr(self, k, v)
-        super(SubscribersContainer, self).__setstate__(tree_state)
+        self._by_email = OOTreeSet()  # (email, key)
+        self._email_of = OOBTree()    # key -> indexed email
+        self._namespace_sizes = OOBTree()  # namespace -> Length
+        if inline:
+            self.inline = True
 
     def _normalize_key(self, key):
         """
@@ -102,6 +199,11 @@ class SubscribersContainer(OOBTree):
             v = args[0]
             if IItemSubscriber.providedBy(v):
                 k = self._normalize_key(v)
+                if self.inline:
+                    if not isinstance(v, SubscriberRecord):
+                        v = SubscriberRecord.from_subscriber(v)
+                    self._set_new(k, v)
+                    return k, v
                 if isinstance(v, persistent.Persistent):
                     self._set_new(k, v)
                     return k, v
@@ -114,7 +216,10 @@ class SubscribersContainer(OOBTree):
                     import sys
                     exc_info = sys.exc_info()
                     raise (KeyError, exc_info[1], exc_info[2])  # noqa
-        v = ItemSubscriber(**fields)
+        if self.inline:
+            v = SubscriberRecord.from_fields(fields)
+        else:
+            v = ItemSubscriber(**fields)
         if k is None:
             k = self._normalize_key(v)
         self._set_new(k, v)
@@ -127,12 +232,76 @@ class SubscribersContainer(OOBTree):
             raise ValueError('__setitem__ value must provide IItemSubscriber')
         if key not in self:
             self.size.change(1)  # increment
+            self._namespace_size(key[0]).change(1)
         super(SubscribersContainer, self).__setitem__(key, value)
+        self._index_email(key, value)
+
+    def set_inline(self, inline=True, batch_size=1000, commit=False):
+        """
+        Switch storage mode, converting all stored subscribers to
+        SubscriberRecord values (or if inline is False, to persistent
+        ItemSubscriber objects).  Subscribers are read by key range,
+        batch_size at a time, each batch converted followed by a
+        transaction savepoint (or if commit is True, a commit), such that
+        neither memory use nor any one write is unbounded.  Returns number
+        of subscribers converted.
+        """
+        self.inline = bool(inline)
+        items = super(SubscribersContainer, self).items
+        setitem = super(SubscribersContainer, self).__setitem__
+        converted = 0
+        lo, excludemin = None, False
+        while True:
+            batch = list(islice(items(lo, excludemin=excludemin), batch_size))
+            changed = 0
+            for key, value in batch:
+                if inline and not isinstance(value, SubscriberRecord):
+                    value = SubscriberRecord.from_subscriber(value)
+                elif not inline and isinstance(value, SubscriberRecord):
+                    value = ItemSubscriber(**value._asdict())
+                else:
+                    continue
+                setitem(key, value)
+                changed += 1
+            if changed:
+                converted += changed
+                checkpoint(self, commit)
+            if len(batch) < batch_size:
+                return converted
+            lo, excludemin = batch[-1][0], True
 
     def get(self, subscriber, default=None):
         key = self._normalize_key(subscriber)
         return super(SubscribersContainer, self).get(key, default)
 
+    # get_many() walks the key range once if at least 1/WALK_RATIO of all
+    # records are requested, otherwise probes for each key, in key order.
+    WALK_RATIO = 8
+
+    def get_many(self, subscribers, default=None):
+        """
+        Bulk form of get(): return list of records (or default, if not
+        found) for each of subscribers (keys or IItemSubscriber objects),
+        in order given.  Distinct keys are looked up in sorted order.
+        """
+        keys = [self._normalize_key(sub) for sub in subscribers]
+        wanted = sorted(set(keys))
+        found = {}
+        if wanted and len(wanted) * self.WALK_RATIO >= len(self):
+            wanted_keys = set(wanted)
+            items = super(SubscribersContainer, self).items(wanted[0],
+                                                            wanted[-1])
+            for key, value in items:
+                if key in wanted_keys:
+                    found[key] = value
+        else:
+            get = super(SubscribersContainer, self).get
+            for key in wanted:
+                value = get(key, None)
+                if value is not None:
+                    found[key] = value
+        return [found.get(key, default) for key in keys]
+
     def __getitem__(self, key):
         key = self._normalize_key(key)
         return super(SubscribersContainer, self).__getitem__(key)
@@ -143,14 +312,129 @@ class SubscribersContainer(OOBTree):
     def __contains__(self, key):
         normalized = self._normalize_key(key)
         if IItemSubscriber.providedBy(key):
-            if key is not super(SubscribersContainer, self).get(normalized,
-                                                                None):
+            stored = super(SubscribersContainer, self).get(normalized, None)
+            if key is not stored and not (isinstance(key, SubscriberRecord)
+                                          and key == stored):
                 return False
         key = self._normalize_key(normalized)
         return super(SubscribersContainer, self).__contains__(normalized)
 
     def __delitem__(self, key):
         key = self._normalize_key(key)
+        # containers stored without counters count on first use, which
+        # must happen before the key is removed, not after:
+        self._namespace_sizes_index()
         super(SubscribersContainer, self).__delitem__(key)
         self.size.change(-1)  # decrement if superclass __delitem__ succeeds
+        self._namespace_size(key[0]).change(-1)
+        self._index_email(key, None)
+
+    def _namespace_sizes_index(self):
+        """
+        Return mapping of namespace to Length, counting on first use for
+        containers stored without it.
+        """
+        if self._namespace_sizes is None:
+            self._namespace_sizes = OOBTree()
+            for namespace, identifier in self.keys():
+                self._namespace_size(namespace).change(1)
+        return self._namespace_sizes
+
+    def _namespace_size(self, namespace):
+        sizes = self._namespace_sizes_index()
+        size = sizes.get(namespace, None)
+        if size is None:
+            size = sizes[namespace] = Length()
+        return size
+
+    def count_namespace(self, namespace):
+        """number of subscribers in namespace, from its counter"""
+        size = self._namespace_sizes_index().get(namespace, None)
+        return size() if size is not None else 0
+
+    def namespace_counts(self):
+        """dict of namespace to number of subscribers (omitting empty)"""
+        sizes = self._namespace_sizes_index()
+        return dict((namespace, size()) for namespace, size in sizes.items()
+                    if size())
+
+    def iter_namespace(self, namespace, start=None, batch_size=1000):
+        """
+        Iterate over (key, subscriber) items of namespace, in identifier
+        order, starting at identifier start (inclusive) if given.  Items
+        are read by range, batch_size at a time, with garbage collection
+        of the connection cache between batches, such that memory use of
+        an export is bounded by batch size.
+        """
+        items = super(SubscribersContainer, self).items
+        lo, excludemin = (namespace, start or ''), False
+        hi = (namespace + '\x00',)  # sorts after any (namespace, id) key
+        while True:
+            batch = list(islice(
+                items(lo, hi, excludemin=excludemin, excludemax=True),
+                batch_size))
+            for key, value in batch:
+                yield key, value
+            if len(batch) < batch_size:
+                return
+            lo, excludemin = batch[-1][0], True
+            if self._p_jar is not None:
+                self._p_jar.cacheGC()
+
+    def _email_index(self):
+        """
+        Return email index (set and mapping), building it on first use
+        for containers stored without it.
+        """
+        if self._by_email is None:
+            self._by_email = OOTreeSet()
+            self._email_of = OOBTree()
+            for key, value in super(SubscribersContainer, self).items():
+                self._index_email(key, value)
+        return self._by_email, self._email_of
+
+    def _index_email(self, key, value):
+        """index email of value (or if value is None, unindex) for key"""
+        by_email, email_of = self._email_index()
+        email = getattr(value, 'email', None)
+        email = email.lower() if email else None
+        previous = email_of.get(key, None)
+        if previous == email:
+            return
+        if previous is not None:
+            by_email.remove((previous, key))
+            del email_of[key]
+        if email is not None:
+            by_email.insert((email, key))
+            email_of[key] = email
+
+    def reindex_email(self, subscriber):
+        """
+        Update email index for stored subscriber (key or object), e.g.
+        after the email of a persistent subscriber object is changed.
+        """
+        key = self._normalize_key(subscriber)
+        self._index_email(key, super(SubscribersContainer, self).get(key))
+
+    def keys_for_email(self, email):
+        """
+        List of keys, in key order, of all records with email (matched
+        without regard to case), whether keyed by email or otherwise.
+        """
+        return list(prefixed(self._email_index()[0], email.lower()))
+
+    def keys_for_emails(self, emails):
+        """
+        Bulk form of keys_for_email(): return dict of each of emails to
+        list of keys, looking up distinct emails in sorted order.
+        """
+        by_email = self._email_index()[0]
+        found = {}
+        for email in sorted(set(email.lower() for email in emails)):
+            found[email] = list(prefixed(by_email, email))
+        return dict((email, found[email.lower()]) for email in emails)
+
+    def get_by_email(self, email):
+        """list of records with email (see keys_for_email())"""
+        return self.get_many(self.keys_for_email(email))
 
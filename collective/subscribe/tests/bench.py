@@ -0,0 +1,568 @@
+"""
+Micro-benchmarks for collective.subscribe; not run as part of the tests.
+
+Run all benchmarks, or only those named:
+
+    python -m collective.subscribe.tests.bench [name ...]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from collective.subscribe.catalog import SubscriptionCatalog
+from collective.subscribe.keys import SubscriptionKeys, mkkey
+from collective.subscribe.query import Related
+from collective.subscribe.interfaces import IItemSubscriber
+from collective.subscribe.subscriber import ItemSubscriber
+from collective.subscribe.subscriber import SubscribersContainer
+
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def timed(fn, *args, **kwargs):
+    """call fn, return elapsed seconds"""
+    start = time.time()
+    fn(*args, **kwargs)
+    return time.time() - start
+
+
+def report(label, baseline, *results):
+    """print timings of results relative to baseline (label, seconds)"""
+    print '%s:' % label
+    print '  %-32s %8.4fs' % baseline
+    for name, seconds in results:
+        print '  %-32s %8.4fs  (%.1fx)' % (
+            name, seconds, baseline[1] / max(seconds, 1e-9))
+
+
+@benchmark
+def index_many(count=20000):
+    """subscribe a group of members to a folder, one call vs. bulk"""
+    uid = str(uuid.uuid4())
+    sigs = [('member', 'user%06d' % i) for i in xrange(count)]
+
+    def one_at_a_time(catalog):
+        for sig in sigs:
+            catalog.index(sig, uid, 'subscribed')
+
+    def bulk(catalog):
+        catalog.index_many(((sig, uid) for sig in sigs), 'subscribed')
+
+    def one_at_a_time_unindex(catalog):
+        for sig in sigs:
+            catalog.unindex(sig, uid, 'subscribed')
+
+    def bulk_unindex(catalog):
+        catalog.unindex_many(((sig, uid) for sig in sigs), 'subscribed')
+
+    single, many = SubscriptionCatalog(), SubscriptionCatalog()
+    report('index %s subscribers to one item' % count,
+           ('index()', timed(one_at_a_time, single)),
+           ('index_many()', timed(bulk, many)))
+    report('unindex %s subscribers from one item' % count,
+           ('unindex()', timed(one_at_a_time_unindex, single)),
+           ('unindex_many()', timed(bulk_unindex, many)))
+
+    uids = [str(uuid.uuid4()) for i in xrange(count)]
+
+    def one_at_a_time_uids(catalog):
+        for uid in uids:
+            catalog.index(sigs[0], uid, 'subscribed')
+
+    def bulk_uids(catalog):
+        catalog.index_many(sigs[0], 'subscribed', uids=uids)
+
+    report('index one subscriber to %s items' % count,
+           ('index()', timed(one_at_a_time_uids, SubscriptionCatalog())),
+           ('index_many()', timed(bulk_uids, SubscriptionCatalog())))
+
+
+@benchmark
+def unindex_many_cold(count=100000, sample=5000, cache_size=200):
+    """unindex random subscribers of a large item, with a cold ZODB cache"""
+    uid = str(uuid.uuid4())
+    sigs = [('member', 'user%06d' % i) for i in xrange(count)]
+    victims = random.sample(sigs, sample)
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'Data.fs')
+    try:
+        db = DB(FileStorage(path))
+        conn = db.open()
+        catalog = conn.root()['catalog'] = SubscriptionCatalog()
+        for i in xrange(0, count, 10000):
+            catalog.index_many(((sig, uid) for sig in sigs[i:i + 10000]),
+                               'subscribed')
+            transaction.commit()
+        db.close()
+
+        def one_at_a_time(catalog):
+            for sig in victims:
+                catalog.unindex(sig, uid, 'subscribed')
+
+        def bulk(catalog):
+            catalog.unindex_many(((sig, uid) for sig in victims),
+                                 'subscribed')
+
+        results = []
+        for name, fn in (('unindex()', one_at_a_time),
+                         ('unindex_many()', bulk)):
+            db = DB(FileStorage(path), cache_size=cache_size)
+            catalog = db.open().root()['catalog']
+            results.append((name, timed(fn, catalog)))
+            transaction.abort()
+            db.close()
+        report('unindex %s of %s subscribers, cold cache' % (sample, count),
+               *results)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def get_subscribers(count=50000, sample=10000, cache_size=1000):
+    """resolve subscriber records, one call each vs. bulk, cold cache"""
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'Data.fs')
+    try:
+        db = DB(FileStorage(path))
+        conn = db.open()
+        container = conn.root()['subscribers'] = SubscribersContainer()
+        for i in xrange(count):
+            container.add(user='user%06d' % i)
+        transaction.commit()
+        keys = list(container.keys())
+        db.close()
+        for wanted in (sample, count / 2):
+            sigs = random.sample(keys, wanted)
+
+            def one_at_a_time(container):
+                return [container.get(sig) for sig in sigs]
+
+            def bulk(container):
+                return container.get_many(sigs)
+
+            results = []
+            for name, fn in (('get()', one_at_a_time),
+                             ('get_many()', bulk)):
+                db = DB(FileStorage(path), cache_size=cache_size)
+                container = db.open().root()['subscribers']
+                results.append((name, timed(fn, container)))
+                db.close()
+            report('resolve %s of %s subscribers, cold cache' % (
+                wanted, count), *results)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def inline_subscribers(count=50000, sample=10000, cache_size=1000):
+    """read subscriber fields: persistent objects vs. inline records"""
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'Data.fs')
+    try:
+        db = DB(FileStorage(path))
+        conn = db.open()
+        root = conn.root()
+        root['persistent'] = SubscribersContainer()
+        root['inline'] = SubscribersContainer(inline=True)
+        for i in xrange(count):
+            for name in ('persistent', 'inline'):
+                root[name].add(user='user%06d' % i,
+                               email='u%s@example.com' % i)
+        transaction.commit()
+        keys = list(root['inline'].keys())
+        db.close()
+        for wanted in (sample, count):
+            sigs = sorted(random.sample(keys, wanted))
+
+            def read(container):
+                return [sub.email for sub in container.get_many(sigs)]
+
+            results = []
+            for name in ('persistent', 'inline'):
+                db = DB(FileStorage(path), cache_size=cache_size)
+                container = db.open().root()[name]
+                results.append((name, timed(read, container)))
+                db.close()
+            report('read %s of %s subscribers, cold cache' % (
+                wanted, count), *results)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def email_lookup(count=100000, lookups=100):
+    """find records with an email address: scan vs. email index"""
+    container = SubscribersContainer(inline=True)
+    for i in xrange(count):
+        container.add(user='user%06d' % i, email='u%s@example.com' % i)
+    emails = ['U%s@example.com' % random.randrange(count)
+              for i in xrange(lookups)]
+
+    def scan():
+        for email in emails:
+            email = email.lower()
+            [key for key, sub in container.items()
+             if sub.email and sub.email.lower() == email]
+
+    def indexed():
+        for email in emails:
+            container.keys_for_email(email)
+
+    report('find %s emails among %s subscribers' % (lookups, count),
+           ('scan', timed(scan)),
+           ('keys_for_email()', timed(indexed)),
+           ('keys_for_emails()', timed(container.keys_for_emails, emails)))
+
+
+@benchmark
+def names_for(names=40, items=1000, page=50, rounds=100):
+    """names linking a subscriber to a page of items: probes vs. pair index"""
+    uids = [str(uuid.uuid4()) for i in xrange(items)]
+    sig = ('member', 'jdoe')
+    catalog = SubscriptionCatalog()
+    for i in xrange(names):
+        catalog.index_many(sig, 'name%02d' % i, uids=uids[i::names / 4])
+        catalog.index_many(((('member', 'user%04d' % j), uid)
+                            for j in xrange(20) for uid in uids[:items / 10]),
+                           'name%02d' % i)
+    pages = [random.sample(uids, page) for i in xrange(rounds)]
+
+    def lookup(catalog):
+        for uids in pages:
+            catalog.names_for_items(sig, uids)
+
+    def probe(catalog):
+        sid = catalog.signature_ids.get_id(sig)
+        for uids in pages:
+            dict((uid, [name for name, idx in catalog.indexes.items()
+                        if sid in idx.subscriber_ids_for(uid)])
+                 for uid in uids)
+
+    report('%s pages of %s items, %s names' % (rounds, page, names),
+           ('probe each index', timed(probe, catalog)),
+           ('pair index', timed(lookup, catalog)))
+
+
+@benchmark
+def boolean_query(count=20000, rounds=100):
+    """(watch | owner) & ~muted: searches combined in Python vs. query"""
+    sig = ('member', 'jdoe')
+    uids = [str(uuid.uuid4()) for i in xrange(count)]
+    catalog = SubscriptionCatalog()
+    catalog.index_many(sig, 'watch', uids=uids[:count / 2])
+    catalog.index_many(sig, 'owner', uids=uids[count / 4:count * 3 / 4])
+    catalog.index_many(sig, 'muted', uids=uids[::10])
+
+    def combined():
+        for i in xrange(rounds):
+            result = set(catalog.search({'watch': sig}))
+            result.update(catalog.search({'owner': sig}))
+            result.difference_update(catalog.search({'muted': sig}))
+
+    query = ((Related('watch', sig) | Related('owner', sig)) &
+             ~Related('muted', sig))
+
+    def planned():
+        for i in xrange(rounds):
+            catalog.search(query)
+
+    report('%s rounds, %s items' % (rounds, count),
+           ('search() x 3, Python sets', timed(combined)),
+           ('search(query)', timed(planned)))
+
+
+@benchmark
+def is_subscribed(count=20000, names=5, rounds=1000):
+    """is subscriber subscribed to item: uid in search() vs. probe"""
+    sig = ('member', 'jdoe')
+    uids = [str(uuid.uuid4()) for i in xrange(count)]
+    catalog = SubscriptionCatalog()
+    for i in xrange(names):
+        catalog.index_many(sig, 'name%s' % i, uids=uids[i::names])
+    absent = str(uuid.uuid4())
+
+    def searched(uid):
+        for i in xrange(rounds):
+            uid in catalog.search(sig)
+
+    def probed(uid, **kw):
+        for i in xrange(rounds):
+            catalog.is_subscribed(sig, uid, **kw)
+
+    for label, uid in (('subscribed', uids[-1]), ('not subscribed', absent)):
+        report('%s: %s rounds, %s items in %s indexes' % (
+               label, rounds, count, names),
+               ('uid in search(sig)', timed(searched, uid)),
+               ('is_subscribed()', timed(probed, uid)),
+               ('is_subscribed(negative)', timed(probed, uid,
+                                                 negative=set())))
+
+
+@benchmark
+def purge(subscribers=2000, other=100000, names=3):
+    """delete item: unindex per (subscriber, name) and scan keys vs. purge"""
+    sigs = [('member', 'user%06d' % i) for i in xrange(subscribers)]
+    names = ['name%s' % i for i in xrange(names)]
+
+    def fixture():
+        uid = str(uuid.uuid4())
+        catalog = SubscriptionCatalog()
+        subkeys = SubscriptionKeys()
+        catalog.index_many([(sig, uid) for sig in sigs], names)
+        catalog.index_many([(('member', 'other%06d' % i), str(uuid.uuid4()))
+                            for i in xrange(other)], names[0])
+        subkeys.add_many((names[0], sig, uid) for sig in sigs)
+        subkeys.add_many((names[0], ('member', 'other%06d' % i),
+                          str(uuid.uuid4())) for i in xrange(other))
+        return catalog, subkeys, uid
+
+    def by_hand(catalog, subkeys, uid):
+        for name in names:
+            for sig in catalog.search({name: uid}):
+                catalog.unindex(sig, uid, name)
+        for key in [k for k, v in subkeys.items() if v[2] == uid]:
+            del subkeys[key]
+
+    def purged(catalog, subkeys, uid):
+        catalog.purge_item(uid, keys=subkeys)
+
+    report('purge item with %s subscribers x %s names, %s other' % (
+           subscribers, len(names), other),
+           ('unindex() each, scan keys', timed(by_hand, *fixture())),
+           ('purge_item()', timed(purged, *fixture())))
+
+
+@benchmark
+def limit(count=20000, rounds=100):
+    """first page of a large union: whole result vs. search(limit=...)"""
+    sig = ('member', 'jdoe')
+    uids = [str(uuid.uuid4()) for i in xrange(count)]
+    catalog = SubscriptionCatalog()
+    catalog.index_many(sig, 'watch', uids=uids[:count / 2])
+    catalog.index_many(sig, 'owner', uids=uids[count / 4:count * 3 / 4])
+    catalog.index_many(sig, 'muted', uids=uids[::10])
+
+    def first_page(query, limit=None):
+        for i in xrange(rounds):
+            catalog.search(query, limit=limit)[:20]
+
+    query = ((Related('watch', sig) | Related('owner', sig)) &
+             ~Related('muted', sig))
+    for label, q in (('unnamed', sig), ('boolean', query)):
+        report('%s: first 20 of %s rounds, %s items' % (label, rounds, count),
+               ('search()[:20]', timed(first_page, q)),
+               ('search(limit=20)', timed(first_page, q, 20)))
+
+
+@benchmark
+def keys(count=100000):
+    """subscription key generation, and add() vs. add_many()"""
+    from base64 import urlsafe_b64encode
+    from hashlib import md5
+
+    def legacy_mkkey(name, sig, uid):
+        # key scheme prior to 0.2, using process-specific hash():
+        return urlsafe_b64encode(
+            md5('%s/%s/%s' % (name, hash(sig), uid)).digest())[:22]
+
+    uid = str(uuid.uuid4())
+    triples = [('subscribed', ('member', 'user%06d' % i), uid)
+               for i in xrange(count)]
+
+    def generate(fn):
+        for triple in triples:
+            fn(*triple)
+
+    report('generate %s keys' % count,
+           ('legacy mkkey (hash)', timed(generate, legacy_mkkey)),
+           ('mkkey', timed(generate, mkkey)))
+
+    def one_at_a_time(subkeys):
+        for triple in triples:
+            subkeys.add(*triple)
+
+    def bulk(subkeys):
+        subkeys.add_many(triples)
+
+    report('add %s keys' % count,
+           ('add()', timed(one_at_a_time, SubscriptionKeys())),
+           ('add_many()', timed(bulk, SubscriptionKeys())))
+
+
+@benchmark
+def revoke(count=50000, other=200000):
+    """revoke keys of an item: scan of all values vs. reverse index"""
+    uid = str(uuid.uuid4())
+    subkeys = SubscriptionKeys()
+    subkeys.add_many(('subscribed', ('member', 'user%06d' % i), uid)
+                     for i in xrange(count))
+    subkeys.add_many(('subscribed', ('member', 'user%06d' % i),
+                      str(uuid.uuid4())) for i in xrange(other))
+
+    def scan():
+        return [key for key, value in subkeys.items() if value[2] == uid]
+
+    report('find %s of %s keys for item' % (count, count + other),
+           ('scan values', timed(scan)),
+           ('keys_for_item()', timed(subkeys.keys_for_item, uid)))
+    report('revoke %s keys for item' % count,
+           ('revoke_item()', timed(subkeys.revoke_item, uid)))
+
+
+@benchmark
+def signature(count=100000):
+    """per-call cost of ItemSubscriber.signature() and its hot callers"""
+    def uncached_signature(sub):
+        # signature() prior to 0.2, validating invariants on every call:
+        IItemSubscriber.validateInvariants(sub)
+        namespace, identifier = sub.namespace, sub.user
+        if sub.email and not sub.user:
+            namespace, identifier = 'email', sub.email
+        return (namespace, identifier)
+
+    sub = ItemSubscriber(user='jdoe', email='jdoe@example.com')
+    container = SubscribersContainer()
+    container.add(sub)
+    catalog = SubscriptionCatalog()
+    catalog.index(sub, str(uuid.uuid4()), 'subscribed')
+
+    def calls(fn, *args):
+        for i in xrange(count):
+            fn(*args)
+
+    cached = ItemSubscriber.signature
+    for label, fn, args in (
+            ('signature()', lambda sub: sub.signature(), (sub,)),
+            ('container._normalize_key()', container._normalize_key, (sub,)),
+            ('container.get()', container.get, (sub,)),
+            ('catalog.search()', catalog.search, ({'subscribed': sub},))):
+        ItemSubscriber.signature = uncached_signature
+        try:
+            baseline = timed(calls, fn, *args)
+        finally:
+            ItemSubscriber.signature = cached
+        report('%s: %s calls' % (label, count),
+               ('uncached signature', baseline),
+               ('cached signature', timed(calls, fn, *args)))
+
+
+def concurrently(path, work, threads, per_thread):
+    """
+    Run work(root, thread, i) for i in range(per_thread) in each of
+    threads, each thread using its own connection (and transaction
+    manager) to the FileStorage at path, committing after each call and
+    retrying on ConflictError.  Return (commits, conflicts).
+    """
+    db = DB(FileStorage(path))
+    counts = {'commits': 0, 'conflicts': 0}
+    lock = threading.Lock()
+    start = threading.Event()
+
+    def worker(n):
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        start.wait()
+        for i in xrange(per_thread):
+            while True:
+                try:
+                    tm.begin()
+                    work(conn.root(), n, i)
+                    tm.commit()
+                except ConflictError:
+                    tm.abort()
+                    outcome = 'conflicts'
+                else:
+                    outcome = 'commits'
+                with lock:
+                    counts[outcome] += 1
+                if outcome == 'commits':
+                    break
+        conn.close()
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in xrange(threads)]
+    for t in workers:
+        t.start()
+    start.set()
+    for t in workers:
+        t.join()
+    db.close()
+    return counts['commits'], counts['conflicts']
+
+
+@benchmark
+def conflicts(existing=1000, threads=4, per_thread=50,
+              record_subscribed=False, timeline=False):
+    """
+    Conflict rate of concurrent writers, each committing one change per
+    transaction, on a popular item (with existing subscribers); with
+    record_subscribed, the catalog also writes metadata records, and
+    with timeline, the index also writes its timeline.
+    """
+    uid = str(uuid.uuid4())
+    sigs = [('member', 'user%06d' % i) for i in xrange(existing)]
+    # each thread unsubscribes its own random sample of existing members
+    victims = random.sample(sigs, threads * per_thread)
+
+    def subscribe(root, n, i):
+        sig = ('member', 'new%02d-%06d' % (n, i))
+        root['catalog'].index(sig, uid, 'subscribed')
+
+    def new_items(root, n, i):
+        root['catalog'].index(sigs[n], str(uuid.uuid4()), 'subscribed')
+
+    def unsubscribe(root, n, i):
+        sig = victims[n * per_thread + i]
+        root['catalog'].unindex(sig, uid, 'subscribed')
+
+    print 'conflicts, %s threads x %s commits, item with %s subscribers%s:' % (
+        threads, per_thread, existing,
+        ''.join(', %s' % name for name, on in (
+            ('record_subscribed', record_subscribed),
+            ('timeline', timeline)) if on))
+    for work in (subscribe, new_items, unsubscribe):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'Data.fs')
+        try:
+            db = DB(FileStorage(path))
+            conn = db.open()
+            catalog = conn.root()['catalog'] = SubscriptionCatalog()
+            catalog.record_subscribed = record_subscribed
+            catalog.index_many(((sig, uid) for sig in sigs), 'subscribed')
+            if timeline:
+                catalog.enable_timeline(['subscribed'])
+            transaction.commit()
+            db.close()
+            commits, failed = concurrently(path, work, threads, per_thread)
+            print '  %-32s %5d conflicts / %5d commits  (%.1f%%)' % (
+                work.__name__, failed, commits,
+                100.0 * failed / (commits + failed))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def main(names=()):
+    for fn in BENCHMARKS:
+        if not names or fn.__name__ in names:
+            fn()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
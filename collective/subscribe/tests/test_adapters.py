@@ -0,0 +1,147 @@
+import uuid
+import unittest2 as unittest
+
+from zope.interface import implements
+from zope.component import getGlobalSiteManager
+
+from collective.subscribe.adapters import SubscribersOf, ItemsFor, prefetch
+from collective.subscribe.catalog import SubscriptionCatalog
+from collective.subscribe.interfaces import ISubscribersOf, IItemsFor
+from collective.subscribe.interfaces import ISubscriptionCatalog, ISubscribers
+from collective.subscribe.interfaces import IItemResolver, IUIDStrategy
+from collective.subscribe.subscriber import ItemSubscriber
+from collective.subscribe.subscriber import SubscribersContainer
+
+
+class MockItem(object):
+    def __init__(self):
+        self.uid = str(uuid.uuid4())
+
+
+class MockItemUID(object):
+    implements(IUIDStrategy)
+
+    def __init__(self, context):
+        self.context = context
+
+    def getuid(self):
+        return self.context.uid
+
+    __call__ = getuid
+
+
+class MockResolver(object):
+    implements(IItemResolver)
+
+    def __init__(self, items):
+        self.items = dict((item.uid, item) for item in items)
+
+    def get(self, uid):
+        return self.items.get(uid)
+
+
+class MockJar(object):
+    def __init__(self):
+        self.prefetched = []
+
+    def prefetch(self, *args):
+        self.prefetched.append(list(args[0]))
+
+
+class MockGhost(object):
+    _p_changed = None  # ghost
+
+    def __init__(self, jar):
+        self._p_jar = jar
+
+
+class AdaptersTest(unittest.TestCase):
+    """Test ISubscribersOf and IItemsFor adapters"""
+
+    def setUp(self):
+        self.gsm = getGlobalSiteManager()
+        self.catalog = SubscriptionCatalog()
+        self.container = SubscribersContainer()
+        self.items = [MockItem() for i in range(5)]
+        self.subscribers = [ItemSubscriber(namespace='member',
+                                           user='user%03d' % i)
+                            for i in range(250)]
+        for sub in self.subscribers:
+            self.container.add(sub)
+        self.resolver = MockResolver(self.items)
+        self.gsm.registerUtility(self.catalog, ISubscriptionCatalog)
+        self.gsm.registerUtility(self.container, ISubscribers)
+        self.gsm.registerUtility(self.resolver, IItemResolver)
+        self.gsm.registerAdapter(MockItemUID, (MockItem,), IUIDStrategy)
+
+    def tearDown(self):
+        self.gsm.unregisterUtility(self.catalog, ISubscriptionCatalog)
+        self.gsm.unregisterUtility(self.container, ISubscribers)
+        self.gsm.unregisterUtility(self.resolver, IItemResolver)
+        self.gsm.unregisterAdapter(MockItemUID, (MockItem,), IUIDStrategy)
+
+    def test_subscribers_of(self):
+        item = self.items[0]
+        self.catalog.index_many(((sub, item.uid) for sub in self.subscribers),
+                                'subscribed')
+        self.catalog.index(self.subscribers[0], item.uid, 'owner')
+        adapter = SubscribersOf(item)
+        assert ISubscribersOf.providedBy(adapter)
+        found = adapter.find('subscribed')
+        assert not isinstance(found, (list, tuple))  # lazy
+        self.assertEqual(set(found), set(self.subscribers))
+        self.assertEqual(list(adapter.find('owner')), [self.subscribers[0]])
+        self.assertEqual(list(SubscribersOf(self.items[1]).find('owner')), [])
+        self.assertRaises(ValueError, adapter.find, 'unknown')
+        # subscriber removed from container is skipped:
+        del self.container[self.subscribers[1].signature()]
+        self.assertEqual(len(list(adapter.find('subscribed'))), 249)
+
+    def test_subscriptions_for(self):
+        item = self.items[0]
+        sub = self.subscribers[0]
+        adapter = SubscribersOf(item)
+        self.assertEqual(adapter.subscriptions_for(sub), [])
+        self.catalog.index(sub, item.uid, ('subscribed', 'owner'))
+        self.catalog.index(sub, self.items[1].uid, 'likes')
+        self.assertEqual(sorted(adapter.subscriptions_for(sub)),
+                         ['owner', 'subscribed'])
+        self.assertEqual(adapter.subscriptions_for(sub.signature()),
+                         adapter.subscriptions_for(sub))
+
+    def test_items_for(self):
+        sub = self.subscribers[0]
+        self.catalog.index_many(sub, 'subscribed',
+                                uids=[item.uid for item in self.items])
+        self.catalog.index(sub, str(uuid.uuid4()), 'subscribed')  # missing
+        adapter = ItemsFor(sub)
+        assert IItemsFor.providedBy(adapter)
+        adapter.batch_size = 2
+        self.assertEqual(set(adapter.find('subscribed')), set(self.items))
+        self.assertRaises(ValueError, adapter.find, 'unknown')
+        self.assertEqual(list(ItemsFor(self.subscribers[1]).find(
+            'subscribed')), [])
+
+    def test_items_subscriptions_for(self):
+        sub = self.subscribers[0]
+        uids = [item.uid for item in self.items]
+        self.catalog.index_many(sub, 'subscribed', uids=uids[:3])
+        self.catalog.index(sub, uids[1], 'owner')
+        found = ItemsFor(sub).subscriptions_for(uids)
+        self.assertEqual(found[uids[0]], ['subscribed'])
+        self.assertEqual(found[uids[1]], ['owner', 'subscribed'])
+        self.assertEqual(found[uids[4]], [])
+
+    def test_prefetch(self):
+        jar = MockJar()
+        ghosts = [MockGhost(jar) for i in range(3)]
+        loaded = MockGhost(jar)
+        loaded._p_changed = False
+        prefetch([None, loaded] + ghosts)
+        self.assertEqual(jar.prefetched, [ghosts])
+        prefetch([loaded, object(), None])  # nothing to prefetch
+        self.assertEqual(len(jar.prefetched), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
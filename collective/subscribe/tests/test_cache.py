@@ -0,0 +1,37 @@
+import unittest2 as unittest
+
+from collective.subscribe.cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+    """Test LRU result cache with stamped entries"""
+
+    def test_get_set(self):
+        cache = ResultCache(10)
+        assert cache.get('a', 1) is None
+        cache.set('a', 1, 'result-a')
+        self.assertEqual(cache.get('a', 1), 'result-a')
+        assert cache.get('a', 2) is None  # different stamp: stale
+        self.assertEqual(cache.get('b', 1, 'default'), 'default')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+        self.assertEqual(stats['size'], 0)  # stale entry was dropped
+        self.assertEqual(stats['maxsize'], 10)
+
+    def test_lru(self):
+        cache = ResultCache(3)
+        for key in 'abc':
+            cache.set(key, 1, key.upper())
+        assert cache.get('a', 1) == 'A'  # now most recently used
+        cache.set('d', 1, 'D')  # evicts least recently used, 'b'
+        self.assertEqual(len(cache), 3)
+        assert cache.get('b', 1) is None
+        for key in 'acd':
+            self.assertEqual(cache.get(key, 1), key.upper())
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,24 @@
+import time
 import uuid
 import unittest2 as unittest
 
+import transaction
+from ZODB import DB
+from BTrees.OOBTree import OOBTree, OOSet
+
+from zope.interface import implements
+from zope.component import getGlobalSiteManager
+
 from collective.subscribe.catalog import SubscriptionCatalog
+from collective.subscribe.interfaces import IItemResolver, IBulkItemResolver
+from collective.subscribe.interfaces import ISubscribers, ISubscriptionKeys
+from collective.subscribe.keys import SubscriptionKeys
+from collective.subscribe.query import Related
+from collective.subscribe.subscriber import SubscribersContainer
+from collective.subscribe.subscriber import SubscriberRecord
 from collective.subscribe.index import SubscriptionIndex
+from collective.subscribe.index import ItemUIDToSignatureMapping
+from collective.subscribe.index import SignatureToItemUIDMapping
 from collective.subscribe.tests.common import MockSub
 
 
@@ -96,6 +112,533 @@ class CatalogTest(unittest.TestCase):
         r = self.catalog.search({'like': UID1, 'hate': UID1})
         assert len(r) == 0
 
+    def test_search_lazy(self):
+        self.catalog = self.test_index()
+        self.catalog.index(SUB3, UID1, ('love',))
+        r = self.catalog.search(UID1, lazy=True)
+        assert not isinstance(r, tuple)
+        self.assertEqual(len(r), 3)
+        self.assertEqual(tuple(r), self.catalog.search(UID1))
+        self.assertEqual(r.batch(1, 2), self.catalog.search(UID1)[1:3])
+        r = self.catalog.search({'like': UID1, 'love': UID1}, lazy=True)
+        self.assertEqual(list(r), [SUB2.signature()])
+        r = self.catalog.search({'like': SUB1}, lazy=True)
+        self.assertEqual(r[0], UID1)
+        assert not self.catalog.search({'love': SUB1}, lazy=True)
+
+    def test_search_empty(self):
+        assert self.catalog.search(UID1) == ()
+        assert self.catalog.search(SUB1) == ()
+        assert self.catalog.search({'like': UID1}) == ()
+        self.catalog = self.test_index()
+        # names not managed by this catalog are ignored:
+        assert self.catalog.search({'unknown': UID1}) == ()
+        r = self.catalog.search({'unknown': UID1, 'like': UID1})
+        assert SUB1.signature() in r
+
+    def test_index_many(self):
+        uids = [str(uuid.uuid4()) for i in range(0, 20)]
+        added = self.catalog.index_many(SUB1, ('like', 'love'), uids=uids)
+        self.assertEqual(added, 40)
+        pairs = ((sub, UID1) for sub in (SUB1, SUB2, SUB3))
+        self.assertEqual(self.catalog.index_many(pairs, ('like', 'love')), 6)
+        self.assertEqual(len(self.catalog.search({'love': SUB1})), 21)
+        self.assertEqual(len(self.catalog.search({'like': UID1})), 3)
+        pairs = ((sub, UID1) for sub in (SUB1, SUB2))
+        removed = self.catalog.unindex_many(pairs, ('love', 'unknown'))
+        self.assertEqual(removed, 2)
+        self.assertEqual(self.catalog.search({'love': UID1}),
+                         (SUB3.signature(),))
+        removed = self.catalog.unindex_many(SUB1, 'like', uids=uids)
+        self.assertEqual(removed, 20)
+        self.assertEqual(self.catalog.search({'like': SUB1}), (UID1,))
+
+    def test_index_many_records(self):
+        # SubscriberRecord is a (namedtuple) subscriber, not a signature:
+        records = [SubscriberRecord(user='user%02d' % i) for i in range(3)]
+        uids = [str(uuid.uuid4()) for i in range(0, 5)]
+        catalog = self.catalog
+        self.assertEqual(catalog.index_many([(r, UID1) for r in records],
+                                            'like'), 3)
+        self.assertEqual(catalog.index_many(records[0], 'like', uids=uids),
+                         5)
+        self.assertEqual(set(catalog.search({'like': UID1})),
+                         set(r.signature() for r in records))
+        self.assertEqual(catalog.names_for(records[0], uids[0]), ['like'])
+        self.assertEqual(catalog.unindex_many(records[0], 'like',
+                                              uids=uids), 5)
+        self.assertEqual(catalog.unindex_many([(records[1], UID1)],
+                                              'like'), 1)
+        self.assertEqual(catalog.search({'like': UID1}),
+                         (records[0].signature(), records[2].signature()))
+
+    def test_load(self):
+        uids = [str(uuid.uuid4()) for i in range(0, 25)]
+        triples = (('like' if i % 2 else 'love', sig, uid)
+                   for i, uid in enumerate(uids)
+                   for sig in (SUB1.signature(), SUB2.signature()))
+        self.assertEqual(self.catalog.load(triples, batch_size=7), 50)
+        self.assertEqual(len(self.catalog.search({'like': SUB1})), 12)
+        self.assertEqual(len(self.catalog.search({'love': SUB2})), 13)
+        self.assertEqual(len(self.catalog.search(SUB1)), 25)
+        # loading existing associations again adds nothing:
+        triples = [('like', SUB1.signature(), uid) for uid in uids]
+        self.assertEqual(self.catalog.load(triples), 13)
+
+    def test_rebuild(self):
+        self.catalog = self.test_index()
+        before = dict((name, sorted(idx.associations()))
+                      for name, idx in self.catalog.indexes.items())
+        signature_ids = self.catalog.signature_ids
+        self.assertEqual(self.catalog.rebuild(), 3)
+        assert self.catalog.signature_ids is not signature_ids
+        after = dict((name, sorted(idx.associations()))
+                     for name, idx in self.catalog.indexes.items())
+        self.assertEqual(before, after)
+        # rebuild from external source replaces all existing:
+        self.assertEqual(self.catalog.rebuild([('hate', SUB3, UID2)]), 1)
+        self.assertEqual(list(self.catalog.indexes.keys()), ['hate'])
+        self.assertEqual(self.catalog.search(UID2), (SUB3.signature(),))
+
+    def test_metadata(self):
+        self.test_index()
+        md = self.catalog.metadata
+        self.assertEqual(len(md), 0)  # not recorded unless enabled
+        self.catalog = SubscriptionCatalog()
+        self.catalog.record_subscribed = True
+        self.catalog = self.test_index()
+        md = self.catalog.metadata
+        record = md.get('like', SUB1, UID1)
+        subscribed = record['subscribed']
+        self.catalog.index(SUB1, UID1, 'like')  # existing: time unchanged
+        self.assertEqual(md.get('like', SUB1, UID1), record)
+        self.assertEqual(len(md), 3)  # SUB1 like, SUB2 like & love
+        self.catalog.index_many([(SUB3, UID1), (SUB1, UID1)], 'like')
+        assert 'subscribed' in md.get('like', SUB3, UID1)
+        self.assertEqual(md.get('like', SUB1, UID1)['subscribed'], subscribed)
+        md.update('like', SUB1, UID1, delivery='digest')
+        self.catalog.unindex(SUB2, UID1, 'love')
+        assert md.get('love', SUB2, UID1) is None
+        self.catalog.unindex_many([(SUB3, UID1)], ('like', 'love'))
+        assert md.get('like', SUB3, UID1) is None
+        self.assertEqual(len(md), 2)
+        # rebuild keeps metadata of existing associations:
+        self.catalog.rebuild()
+        assert self.catalog.metadata is not md
+        self.assertEqual(self.catalog.metadata.get('like', SUB1, UID1),
+                         {'subscribed': subscribed, 'delivery': 'digest'})
+        self.assertEqual(len(self.catalog.metadata), 2)
+
+    def test_names_for(self):
+        self.catalog = self.test_index()
+        catalog = self.catalog
+        self.assertEqual(catalog.names_for(SUB2, UID1), ['like', 'love'])
+        self.assertEqual(catalog.names_for(SUB1.signature(), UID1), ['like'])
+        self.assertEqual(catalog.names_for(SUB3, UID1), [])
+        catalog.index_many([(SUB3, UID1), (SUB3, UID2)], ('like', 'hate'))
+        self.assertEqual(catalog.names_for_items(SUB3, [UID1, UID2]),
+                         {UID1: ['hate', 'like'], UID2: ['hate', 'like']})
+        catalog.unindex(SUB3, UID1, 'hate')
+        catalog.unindex_many([(SUB3, UID2)], 'like')
+        self.assertEqual(catalog.names_for_items(SUB3, [UID1, UID2]),
+                         {UID1: ['like'], UID2: ['hate']})
+        catalog.rebuild()
+        self.assertEqual(catalog.names_for(SUB2, UID1), ['like', 'love'])
+        self.assertEqual(catalog.names_for_items(SUB3, [UID1, UID2]),
+                         {UID1: ['like'], UID2: ['hate']})
+
+    def test_is_subscribed(self):
+        self.catalog = self.test_index()
+        catalog = self.catalog
+        assert catalog.is_subscribed(SUB2, UID1)
+        assert catalog.is_subscribed(SUB2.signature(), UID1, 'love')
+        assert not catalog.is_subscribed(SUB1, UID1, 'love')
+        assert not catalog.is_subscribed(SUB1, UID1, 'unknown')
+        assert not catalog.is_subscribed(SUB3, UID1)
+        self.assertRaises(ValueError, catalog.is_subscribed, 123, UID1)
+        # negative cache, e.g. for a request:
+        negative = set()
+        assert not catalog.is_subscribed(SUB3, UID1, negative=negative)
+        self.assertEqual(negative, set([(SUB3.signature(), UID1, None)]))
+        catalog.index(SUB3, UID1, 'like')
+        assert not catalog.is_subscribed(SUB3, UID1, negative=negative)
+        assert catalog.is_subscribed(SUB3, UID1, negative=set())
+        assert catalog.is_subscribed(SUB3, UID1, 'like', negative=negative)
+        self.assertEqual(len(negative), 1)
+        assert not catalog.is_subscribed(SUB3, UID2)
+        assert not catalog.is_subscribed(('member', 'nobody'), UID1)
+
+    def test_purge(self):
+        catalog = self.catalog
+        catalog.record_subscribed = True
+        uids = [str(uuid.uuid4()) for i in range(10)]
+        sigs = [('member', 'user%02d' % i) for i in range(20)]
+        catalog.index_many([(sig, UID1) for sig in sigs], ('like', 'love'))
+        catalog.index_many(sigs[0], 'like', uids=uids)
+        catalog.index(SUB1, UID2, 'hate')
+        keys = SubscriptionKeys()
+        keys.add_many(('like', sig, UID1) for sig in sigs[:5])
+        keys.add('like', sigs[0], uids[0])
+        report = catalog.purge_item(UID1, keys=keys, batch_size=7)
+        self.assertEqual(report, {'associations': 40,
+                                  'names': {'like': 20, 'love': 20},
+                                  'metadata': 40, 'keys': 5,
+                                  'pruned': False})
+        self.assertEqual(catalog.search(UID1), ())
+        self.assertEqual(catalog.names_for(sigs[0], UID1), [])
+        self.assertEqual(len(catalog.search(sigs[0])), 10)
+        self.assertEqual(catalog.search(UID2), (SUB1.signature(),))
+        self.assertEqual(len(keys), 1)
+        assert UID1 in catalog.uid_ids
+        self.assertEqual(catalog.purge_item(UID1, prune_id=True)['pruned'],
+                         True)
+        assert UID1 not in catalog.uid_ids
+        # subscriber, with keys from the ISubscriptionKeys utility:
+        gsm = getGlobalSiteManager()
+        gsm.registerUtility(keys, ISubscriptionKeys)
+        try:
+            report = catalog.purge_subscriber(sigs[0], prune_id=True)
+        finally:
+            gsm.unregisterUtility(keys, ISubscriptionKeys)
+        self.assertEqual(report, {'associations': 10, 'names': {'like': 10},
+                                  'metadata': 10, 'keys': 1,
+                                  'pruned': True})
+        assert sigs[0] not in catalog.signature_ids
+        self.assertEqual(len(keys), 0)
+        self.assertEqual(catalog.purge_subscriber(SUB2)['associations'], 0)
+        self.assertEqual(len(catalog.metadata), 1)
+
+    def test_timeline(self):
+        self.catalog.record_subscribed = True
+        self.catalog = self.test_index()
+        subscribed = self.catalog.metadata.get('like', SUB1, UID1)['subscribed']
+        self.catalog.enable_timeline(['like', 'new'])
+        assert 'new' in self.catalog.indexes
+        assert self.catalog.indexes['love'].timeline is None
+        idx = self.catalog.indexes['like']
+        found = idx.subscribers_between(UID1)
+        self.assertEqual(found[0], (subscribed, SUB1.signature()))
+        self.catalog.index(SUB3, UID1, 'like')
+        found = idx.subscribers_between(UID1, newest_first=True, limit=1)
+        self.assertEqual(found[0][1], SUB3.signature())
+        self.assertEqual(
+            found[0][0],
+            self.catalog.metadata.get('like', SUB3, UID1)['subscribed'])
+        # rebuild keeps timeline, and times:
+        before = idx.subscribers_between(UID1)
+        self.catalog.rebuild()
+        idx = self.catalog.indexes['like']
+        self.assertEqual(idx.subscribers_between(UID1), before)
+        assert self.catalog.indexes['love'].timeline is None
+
+    def test_rebuild_timeline(self):
+        # times are kept from timelines, without recorded metadata:
+        catalog = self.catalog
+        catalog.enable_timeline(['like'])
+        catalog.index_many([(SUB1, UID1), (SUB2, UID2)], ('like', 'love'))
+        catalog.metadata.update('love', SUB2, UID2, delivery='digest')
+        before = catalog.indexes['like'].timeline.size()
+        times = catalog.indexes['like'].subscribers_between(UID1)
+        time.sleep(0.01)
+        self.assertEqual(catalog.rebuild(batch_size=1), 4)
+        idx = catalog.indexes['like']
+        self.assertEqual(idx.subscribers_between(UID1), times)
+        self.assertEqual(len(idx.timeline), before)
+        self.assertEqual(catalog.metadata.get('love', SUB2, UID2),
+                         {'delivery': 'digest'})
+
+    def test_rebuild_legacy(self):
+        # index as persisted by 0.1, with signatures/uids not interned:
+        legacy = SubscriptionIndex('like')
+        legacy._forward = ItemUIDToSignatureMapping()
+        legacy._reverse = SignatureToItemUIDMapping()
+        legacy._forward[UID1] = OOSet([SUB1.signature(), SUB2.signature()])
+        legacy._reverse[SUB1.signature()] = OOSet([UID1])
+        legacy._reverse[SUB2.signature()] = OOSet([UID1])
+        # add, bypassing re-binding of index by collection:
+        OOBTree.__setitem__(self.catalog.indexes, 'like', legacy)
+        self.assertEqual(self.catalog.rebuild(), 2)
+        assert self.catalog.indexes['like'] is not legacy
+        self.assertEqual(sorted(self.catalog.search({'like': UID1})),
+                         sorted([SUB1.signature(), SUB2.signature()]))
+
+    def test_compact(self):
+        self.catalog = self.test_index()
+        self.catalog.index(SUB3, UID2, 'hate')
+        self.catalog.unindex(SUB3, UID2, 'hate')
+        report = self.catalog.compact()
+        self.assertEqual(report['indexes'], ['hate'])
+        self.assertEqual(report['sets'], 0)
+        assert 'hate' not in self.catalog.indexes
+        assert SUB3.signature() in self.catalog.signature_ids  # not pruned
+        report = self.catalog.compact(prune_ids=True)
+        self.assertEqual(report['indexes'], [])
+        self.assertEqual((report['signatures'], report['uids']), (1, 1))
+        assert SUB3.signature() not in self.catalog.signature_ids
+        assert UID2 not in self.catalog.uid_ids
+        assert SUB1.signature() in self.catalog.search(UID1)
+        self.assertEqual(len(self.catalog.signature_ids), 2)
+
+    def test_shared_intern_tables(self):
+        self.catalog = self.test_index()
+        for name in ('like', 'love'):
+            idx = self.catalog.indexes[name]
+            assert idx.signature_ids is self.catalog.signature_ids
+            assert idx.uid_ids is self.catalog.uid_ids
+        # an index created outside of the catalog is re-bound on add:
+        idx = SubscriptionIndex('hate')
+        idx.index(SUB3, UID2)
+        self.catalog.indexes['hate'] = idx
+        assert idx.signature_ids is self.catalog.signature_ids
+        assert idx.uid_ids is self.catalog.uid_ids
+        assert SUB3.signature() in self.catalog.search({'hate': UID2})
+
+    def test_search_cache(self):
+        self.catalog = self.test_index()
+        self.assertEqual(self.catalog.cache_stats()['maxsize'], 0)
+        expected = self.catalog.search(UID1)
+        self.catalog.cache_size = 2
+        self.assertEqual(self.catalog.search(UID1), expected)
+        self.assertEqual(self.catalog.search(UID1), expected)
+        r = self.catalog.search(UID1, lazy=True)
+        self.assertEqual(tuple(r), expected)
+        stats = self.catalog.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        # changes to any index searched invalidate cached result:
+        self.catalog.index(SUB3, UID1, 'love')
+        assert SUB3.signature() in self.catalog.search(UID1)
+        self.catalog.unindex(SUB3, UID1, 'love')
+        self.assertEqual(self.catalog.search(UID1), expected)
+        self.assertEqual(self.catalog.cache_stats()['hits'], 2)
+        # ...but changes to other indexes do not, for named queries:
+        query = {'like': UID1, 'unknown': UID1}
+        self.assertEqual(self.catalog.search(query), expected)
+        self.catalog.index(SUB3, UID2, 'love')
+        self.assertEqual(self.catalog.search({'unknown': UID1, 'like': UID1}),
+                         expected)
+        self.assertEqual(self.catalog.cache_stats()['hits'], 3)
+        # a new index with a name in a query invalidates:
+        self.catalog.index(SUB3, UID1, 'unknown')
+        self.assertEqual(self.catalog.search(query), ())
+        # no-op changes do not invalidate:
+        self.catalog.search(SUB1)
+        self.catalog.index(SUB1, UID1, 'like')
+        self.catalog.unindex(SUB3, UID2, 'like')
+        self.assertEqual(self.catalog.search(SUB1), (UID1,))
+        stats = self.catalog.cache_stats()
+        self.assertEqual(stats['hits'], 4)
+        self.assertEqual((stats['size'], stats['evictions']), (2, 1))
+
+    def test_search_limit(self):
+        catalog = self.catalog
+        uids = sorted(str(uuid.uuid4()) for i in range(50))
+        catalog.index_many(SUB1, 'like', uids=uids)
+        catalog.index_many(SUB1, 'love', uids=uids[::2])
+        catalog.index_many(SUB2, 'like', uids=uids[:5])
+        for query in (SUB1, {'like': SUB1}, {'like': SUB1, 'love': SUB1},
+                      uids[0], {'like': uids[0]}, {'unknown': SUB1}):
+            expected = catalog.search(query)
+            self.assertEqual(catalog.search(query, limit=3), expected[:3])
+            self.assertEqual(tuple(catalog.isearch(query)), expected)
+            self.assertEqual(tuple(catalog.isearch(query, limit=3)),
+                             expected[:3])
+            self.assertEqual(tuple(catalog.search(query, lazy=True,
+                                                  limit=3)), expected[:3])
+        self.assertEqual(len(catalog.search(SUB1, limit=100)), 50)
+        self.assertEqual(catalog.search(SUB3, limit=1), ())
+        self.assertEqual(catalog.search(uids[0], limit=0), ())
+        # any subscriber?
+        assert list(catalog.isearch({'love': uids[2]}, limit=1))
+        assert not list(catalog.isearch({'love': uids[1]}, limit=1))
+        # cached results are used if cached:
+        catalog.cache_size = 10
+        expected = catalog.search({'like': SUB1})
+        self.assertEqual(catalog.search({'like': SUB1}, limit=2),
+                         expected[:2])
+        self.assertEqual(catalog.cache_stats()['hits'], 1)
+
+    def test_get_items(self):
+        class Resolver(object):
+            implements(IItemResolver)
+            calls = []
+
+            def get(self, uid):
+                self.calls.append(uid)
+                return {UID1: 'item1'}.get(uid)
+
+        class BulkResolver(Resolver):
+            implements(IBulkItemResolver)
+
+            def get_many(self, uids):
+                self.calls.append(tuple(uids))
+                return [{UID1: 'item1'}.get(uid) for uid in uids]
+
+        gsm = getGlobalSiteManager()
+        for factory in (Resolver, BulkResolver):
+            resolver = factory()
+            gsm.registerUtility(resolver, IItemResolver)
+            self.catalog = SubscriptionCatalog()
+            try:
+                result = self.catalog.get_items(iter([UID2, UID1]))
+                self.assertEqual(result, [None, 'item1'])
+            finally:
+                gsm.unregisterUtility(resolver, IItemResolver)
+        self.assertEqual(Resolver.calls, [UID2, UID1, (UID2, UID1)])
+
+    def test_get_subscribers(self):
+        container = SubscribersContainer()
+        container.add(SUB1)
+        gsm = getGlobalSiteManager()
+        gsm.registerUtility(container, ISubscribers)
+        try:
+            result = self.catalog.get_subscribers([SUB2.signature(), SUB1])
+            self.assertEqual(result, [None, container.get(SUB1)])
+            self.assertEqual(self.catalog.get_subscribers([]), [])
+        finally:
+            gsm.unregisterUtility(container, ISubscribers)
+
+
+class CachedSearchTest(unittest.TestCase):
+    """Test result cache of catalog persisted in ZODB"""
+
+    def setUp(self):
+        self.db = DB(None)  # in-memory MappingStorage
+        conn = self.db.open()
+        catalog = conn.root()['catalog'] = SubscriptionCatalog()
+        catalog.cache_size = 10
+        catalog.index(SUB1, UID1, 'like')
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_invalidation(self):
+        tm1 = transaction.TransactionManager()
+        tm2 = transaction.TransactionManager()
+        catalog1 = self.db.open(tm1).root()['catalog']
+        catalog2 = self.db.open(tm2).root()['catalog']
+        self.assertEqual(catalog1.search(UID1), (SUB1.signature(),))
+        # uncommitted change, aborted, is not seen in later results:
+        catalog1.index(SUB2, UID1, 'like')
+        self.assertEqual(len(catalog1.search(UID1)), 2)
+        tm1.abort()
+        self.assertEqual(catalog1.search(UID1), (SUB1.signature(),))
+        # change committed by another connection invalidates results:
+        catalog2.index(SUB3, UID1, 'like')
+        tm2.commit()
+        tm1.begin()
+        self.assertEqual(set(catalog1.search(UID1)),
+                         set([SUB1.signature(), SUB3.signature()]))
+        self.assertEqual(catalog1.cache_stats()['hits'], 0)
+        self.assertEqual(catalog1.search(UID1), catalog2.search(UID1))
+        self.assertEqual(catalog1.cache_stats()['hits'], 1)
+
+
+class BatchTransactionTest(unittest.TestCase):
+    """Test batched operations use the transaction of the catalog"""
+
+    def setUp(self):
+        self.db = DB(None)  # in-memory MappingStorage
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(self.tm)
+        self.conn.root()['catalog'] = SubscriptionCatalog()
+        self.tm.commit()
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def committed(self):
+        conn = self.db.open(transaction.TransactionManager())
+        try:
+            return len(conn.root()['catalog'].search(SUB1))
+        finally:
+            conn.close()
+
+    def test_load_commit(self):
+        catalog = self.conn.root()['catalog']
+        uids = [str(uuid.uuid4()) for i in range(10)]
+        triples = [('like', SUB1.signature(), uid) for uid in uids]
+        catalog.load(triples, batch_size=4, commit=True)
+        # committed by the connection's own transaction manager:
+        self.assertEqual(self.committed(), 10)
+        catalog.purge_subscriber(SUB1, batch_size=4, commit=True)
+        self.assertEqual(self.committed(), 0)
+
+    def test_purge_keys_commit(self):
+        catalog = self.conn.root()['catalog']
+        keys = self.conn.root()['keys'] = SubscriptionKeys()
+        sigs = [('member', 'user%02d' % i) for i in range(10)]
+        catalog.index_many([(sig, UID1) for sig in sigs], 'like')
+        keys.add_many(('like', sig, UID1) for sig in sigs)
+        self.tm.commit()
+        commits = []
+        commit = self.tm.commit
+        self.tm.commit = lambda: commits.append(commit())
+        report = catalog.purge_item(UID1, keys=keys, batch_size=4,
+                                    commit=True)
+        self.assertEqual(report['keys'], 10)
+        self.assertEqual(len(commits), 3 + 3)  # associations, then keys
+        conn = self.db.open(transaction.TransactionManager())
+        self.assertEqual(len(conn.root()['keys']), 0)  # committed
+        conn.close()
+
+
+class LoadCountTest(unittest.TestCase):
+    """Test objects loaded for the first results of a large set"""
+
+    def setUp(self):
+        self.db = DB(None)  # in-memory MappingStorage
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(self.tm)
+        catalog = self.conn.root()['catalog'] = SubscriptionCatalog()
+        self.sigs = [('member', 'user%05d' % i) for i in range(20000)]
+        catalog.index_many([(sig, UID1) for sig in self.sigs], 'watch')
+        catalog.index_many([(sig, UID1) for sig in self.sigs[::2]], 'like')
+        self.tm.commit()
+        self.catalog = catalog
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def loads(self, fn, *args, **kwargs):
+        """return number of objects loaded by fn, from a cold cache"""
+        self.conn.cacheMinimize()
+        self.conn.getTransferCounts(True)
+        fn(*args, **kwargs)
+        return self.conn.getTransferCounts(True)[0]
+
+    def test_lazy_batch(self):
+        search = self.catalog.search
+        walk = self.loads(lambda: len(search({'watch': UID1})))
+        assert walk > 50  # whole set, and its values
+        page = []
+        loads = self.loads(lambda: page.extend(
+            search({'watch': UID1}, lazy=True).batch(0, 50)))
+        self.assertEqual(page, self.sigs[:50])
+        assert loads < 20, loads
+        result = search({'watch': UID1}, lazy=True)
+        loads = self.loads(lambda: self.assertEqual(len(result), 20000))
+        assert loads < 5, loads  # from counter
+        self.assertEqual(result[-1], self.sigs[-1])
+
+    def test_stream_first(self):
+        catalog = self.catalog
+        walk = self.loads(lambda: len(catalog.search({'watch': UID1})))
+        for query in ({'watch': UID1}, {'watch': UID1, 'like': UID1},
+                      UID1, Related('watch', UID1) & ~Related('like', UID1)):
+            first = []
+            loads = self.loads(lambda: first.extend(
+                catalog.search(query, limit=1)))
+            self.assertEqual(len(first), 1)
+            assert loads < 30 and loads * 4 < walk, (query, loads, walk)
+            loads = self.loads(lambda: catalog.isearch(query).next())
+            assert loads < 30, (query, loads)
+
 
 if __name__ == '__main__':
     unittest.main()
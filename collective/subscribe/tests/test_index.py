@@ -1,9 +1,18 @@
+import os
+import shutil
+import tempfile
 import uuid
 import unittest2 as unittest
 
+import transaction
 from zope.schema import ValidationError
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+
+from BTrees.LLBTree import LLTreeSet
 
 from collective.subscribe.index import SubscriptionIndex
+from collective.subscribe.interned import InternTable
 from collective.subscribe.tests.common import MockSub
 
 
@@ -74,6 +83,248 @@ class IndexTest(unittest.TestCase):
         result_subs = index.subscribers_for(uid)
         assert len(result_uids) == 0
         assert len(result_subs) == 0
+        # empty sets are pruned on unindex:
+        self.assertEqual(len(index._forward), 0)
+        self.assertEqual(len(index._reverse), 0)
+
+    def test_compact(self):
+        idx_locals = self.test_index()
+        index = idx_locals['index']
+        # simulate empty sets left by unindex of older versions:
+        index._forward[123] = LLTreeSet()
+        index._reverse[456] = LLTreeSet()
+        self.assertEqual(index.compact(), 2)
+        assert 123 not in index._forward
+        assert 456 not in index._reverse
+        self.assertEqual(len(list(index.associations())), 2)
+        self.assertEqual(index.compact(), 0)
+
+    def test_index_many(self):
+        index = SubscriptionIndex('test_index')
+        uids = [str(uuid.uuid4()) for i in range(0, 50)]
+        sub = MockSub()
+        # one subscriber, many uids:
+        self.assertEqual(index.index_many(sub, uids), 50)
+        self.assertEqual(sorted(index.item_uids_for(sub)), sorted(uids))
+        for uid in uids:
+            self.assertEqual(index.subscribers_for(uid), (sub.signature(),))
+        # pairs, including duplicates of existing associations:
+        sigs = [('member', 'user%s' % i) for i in range(0, 10)]
+        pairs = [(sig, uid) for sig in sigs for uid in uids[:5]]
+        pairs.append((sub, uids[0]))  # already indexed
+        self.assertEqual(index.index_many(iter(pairs)), 50)
+        self.assertEqual(len(index.subscribers_for(uids[0])), 11)
+        self.assertEqual(len(index.item_uids_for(sigs[0])), 5)
+        self.assertRaises(ValueError, index.index_many, [(('a',), uids[0])])
+        return locals()
+
+    def test_unindex_many(self):
+        idx_locals = self.test_index_many()
+        index, sub = idx_locals['index'], idx_locals['sub']
+        uids, sigs = idx_locals['uids'], idx_locals['sigs']
+        self.assertEqual(index.unindex_many(sub, uids[:10]), 10)
+        self.assertEqual(len(index.item_uids_for(sub)), 40)
+        self.assertEqual(len(index.subscribers_for(uids[0])), 10)
+        # pairs, including associations never indexed:
+        pairs = [(sig, uids[0]) for sig in sigs]
+        pairs.append((('member', 'unknown'), uids[0]))
+        pairs.append((sigs[0], 'unknown-uid'))
+        self.assertEqual(index.unindex_many(pairs), 10)
+        self.assertEqual(index.subscribers_for(uids[0]), ())
+        self.assertEqual(len(index.item_uids_for(sigs[0])), 4)
+        assert 'unknown-uid' not in index.uid_ids
+
+    def test_counts(self):
+        index = SubscriptionIndex('test_index')
+        uid = str(uuid.uuid4())
+        sub = MockSub()
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.count_subscribers(uid), 0)
+        self.assertEqual(index.count_items(sub), 0)
+        idx_locals = self.test_index_many()
+        index, uids, sigs = (idx_locals['index'], idx_locals['uids'],
+                             idx_locals['sigs'])
+        self.assertEqual(len(index), 50)
+        self.assertEqual(index.count_subscribers(uids[0]), 11)
+        self.assertEqual(index.count_subscribers(uids[-1]), 1)
+        self.assertEqual(index.count_items(sub), 50)
+        self.assertEqual(index.count_items(sigs[0]), 5)
+        index.index(sigs[0], uids[0])  # existing, no change
+        index.index(sigs[0], uid)  # new item
+        self.assertEqual(len(index), 51)
+        self.assertEqual(index.count_items(sigs[0]), 6)
+        index.unindex(sigs[0], uid)
+        self.assertEqual(len(index), 50)
+        self.assertEqual(index.count_items(sigs[0]), 5)
+        self.assertEqual(index.count_subscribers(uid), 0)
+        index.unindex_many([(sig, uid) for sig in sigs for uid in uids[:5]])
+        self.assertEqual(index.count_subscribers(uids[0]), 1)
+        self.assertEqual(index.count_items(sigs[0]), 0)
+        index.unindex_many(sub, uids)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(len(index._forward_counts), 0)
+
+    def test_is_subscribed(self):
+        index = SubscriptionIndex('test_index')
+        popular = str(uuid.uuid4())
+        sigs = [('member', 'user%03d' % i) for i in range(100)]
+        index.index_many((sig, popular) for sig in sigs)
+        index.index(sigs[0], str(uuid.uuid4()))
+        assert index.is_subscribed(sigs[0], popular)
+        assert index.is_subscribed(sigs[99], popular)
+        assert not index.is_subscribed(MockSub(), popular)
+        assert not index.is_subscribed(sigs[0], str(uuid.uuid4()))
+        index.index(MockSub(), popular)
+        assert index.is_subscribed(MockSub(), popular)
+        index.unindex(MockSub(), popular)
+        assert not index.is_subscribed(MockSub(), popular)
+        # the (reverse) set of the subscriber is probed, not the forward
+        # set of 100 subscribers of the item:
+        uid = index.uid_ids.get_id(popular)
+        forward = index._forward.pop(uid)
+        try:
+            assert index.is_subscribed(sigs[0], popular)
+        finally:
+            index._forward[uid] = forward
+        self.assertRaises(ValueError, index.is_subscribed, ('member',),
+                          popular)
+
+    def test_interned(self):
+        idx_locals = self.test_index()
+        index = idx_locals['index']
+        uid = idx_locals['uid']
+        sig = MockSub().signature()
+        uid_id = index.uid_ids.get_id(uid)
+        sid = index.signature_ids.get_id(sig)
+        assert isinstance(uid_id, (int, long))
+        assert isinstance(sid, (int, long))
+        assert sid in index._forward[uid_id]
+        assert uid_id in index._reverse[sid]
+        # unindex of values never indexed is a no-op, does not intern:
+        index.unindex(('member', 'nobody'), 'nonexistent-uid')
+        assert 'nonexistent-uid' not in index.uid_ids
+        assert ('member', 'nobody') not in index.signature_ids
+
+    def test_associations(self):
+        idx_locals = self.test_index()
+        index = idx_locals['index']
+        uid = idx_locals['uid']
+        pairs = sorted(index.associations())
+        expected = sorted([(MockSub().signature(), uid),
+                           (('email', 'me@example.com'), uid)])
+        self.assertEqual(pairs, expected)
+
+    def test_rebind(self):
+        idx_locals = self.test_index()
+        index = idx_locals['index']
+        uid = idx_locals['uid']
+        before = sorted(index.associations())
+        signature_ids, uid_ids = InternTable(), InternTable()
+        index.rebind(signature_ids, uid_ids)
+        assert index.signature_ids is signature_ids
+        assert index.uid_ids is uid_ids
+        self.assertEqual(sorted(index.associations()), before)
+        self.assertEqual(len(index.subscribers_for(uid)), 2)
+        assert uid in uid_ids
+
+    def test_timeline(self):
+        index = SubscriptionIndex('subscribed')
+        uid = str(uuid.uuid4())
+        sigs = [('member', 'user%02d' % i) for i in range(10)]
+        index.index(sigs[0], uid, timestamp=100.0)
+        self.assertRaises(ValueError, index.subscribers_between, uid)
+        index.enable_timeline(lambda sig, item_uid: 50.0)
+        for i, sig in enumerate(sigs[1:5]):
+            index.index(sig, uid, timestamp=200.0 + i)
+        index.index_many(((sig, uid) for sig in sigs[5:]), timestamp=300.0)
+        self.assertEqual(index.subscribers_between(uid, end=100.0),
+                         [(50.0, sigs[0])])
+        found = index.subscribers_between(uid, 201.0, 300.0)
+        self.assertEqual(found, [(201.0 + i, sig)
+                                 for i, sig in enumerate(sigs[2:5])])
+        found = index.subscribers_between(uid, 200.0, newest_first=True,
+                                          limit=7)
+        self.assertEqual([sig for t, sig in found][-2:], [sigs[4], sigs[3]])
+        self.assertEqual(index.items_between(sigs[0]), [(50.0, uid)])
+        index.unindex(sigs[0], uid)
+        index.unindex_many((sig, uid) for sig in sigs[5:])
+        self.assertEqual(len(index.subscribers_between(uid)), 4)
+        self.assertEqual(index.items_between(sigs[0]), [])
+        # re-binding to other intern tables keeps timestamps:
+        index.rebind(InternTable(), InternTable())
+        self.assertEqual(index.subscribers_between(uid, limit=1),
+                         [(200.0, sigs[1])])
+        index.disable_timeline()
+        assert index.timeline is None
+
+
+class ConcurrentIndexTest(unittest.TestCase):
+    """
+    Test that concurrent changes (in two connections) to subscribers of
+    the same item are merged by conflict resolution (see also the
+    conflicts benchmark in tests/bench.py).
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.tmpdir, 'Data.fs')))
+        self.uid = str(uuid.uuid4())
+        self.sigs = [('member', 'user%03d' % i) for i in range(150)]
+        conn = self.db.open()
+        index = conn.root()['index'] = SubscriptionIndex('subscribed')
+        index.index_many((sig, self.uid) for sig in self.sigs)
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _concurrently(self, first, second):
+        """call each of first, second with index in its own connection"""
+        managers = [transaction.TransactionManager() for fn in (1, 2)]
+        conns = [self.db.open(tm) for tm in managers]
+        for fn, conn in zip((first, second), conns):
+            fn(conn.root()['index'])
+        for tm in managers:
+            tm.commit()  # second commit resolves conflicts, or raises
+        for conn in conns:
+            conn.close()
+        conn = self.db.open()
+        index = conn.root()['index']
+        return index, conn
+
+    def test_concurrent_index(self):
+        new = [[('member', 'new%d-%03d' % (n, i)) for i in range(40)]
+               for n in (1, 2)]
+        index, conn = self._concurrently(
+            lambda idx: idx.index_many((sig, self.uid) for sig in new[0]),
+            lambda idx: idx.index_many((sig, self.uid) for sig in new[1]),
+            )
+        expected = set(self.sigs + new[0] + new[1])
+        self.assertEqual(set(index.subscribers_for(self.uid)), expected)
+        self.assertEqual(index.count_subscribers(self.uid), len(expected))
+        for sig in new[0] + new[1]:
+            self.assertEqual(index.item_uids_for(sig), (self.uid,))
+        conn.close()
+
+    def test_concurrent_unindex(self):
+        # avoid removing the lowest ids: BTrees conflict resolution does
+        # not merge removal of the first key of a bucket.
+        conn = self.db.open()
+        index = conn.root()['index']
+        sids = list(index.subscriber_ids_for(self.uid))[10:70]
+        victims = list(index.signature_ids.resolve(sids))
+        conn.close()
+        index, conn = self._concurrently(
+            lambda idx: [idx.unindex(sig, self.uid) for sig in victims[::2]],
+            lambda idx: [idx.unindex(sig, self.uid) for sig in victims[1::2]],
+            )
+        expected = set(self.sigs) - set(victims)
+        self.assertEqual(set(index.subscribers_for(self.uid)), expected)
+        self.assertEqual(index.count_subscribers(self.uid), len(expected))
+        self.assertEqual(index.count_items(victims[0]), 0)
+        conn.close()
 
 
 if __name__ == '__main__':
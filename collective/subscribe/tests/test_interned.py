@@ -0,0 +1,58 @@
+import unittest2 as unittest
+
+from BTrees.LLBTree import LLSet
+
+from collective.subscribe.interfaces import IInternTable
+from collective.subscribe.interned import InternTable, MAXID
+
+
+class InternTableTest(unittest.TestCase):
+    """Test interning of values to integer ids"""
+
+    def setUp(self):
+        self.table = InternTable()
+
+    def test_iface(self):
+        assert IInternTable.providedBy(self.table)
+
+    def test_intern(self):
+        sig = ('member', 'somebody')
+        assert sig not in self.table
+        assert self.table.get_id(sig) is None
+        intid = self.table.intern(sig)
+        assert 0 <= intid < MAXID
+        assert sig in self.table
+        assert len(self.table) == 1
+        # interning again is idempotent:
+        self.assertEqual(self.table.intern(sig), intid)
+        self.assertEqual(len(self.table), 1)
+        self.assertEqual(self.table.get_id(sig), intid)
+        self.assertEqual(self.table.get_value(intid), sig)
+
+    def test_distinct_ids(self):
+        values = ['uid-%s' % i for i in range(100)]
+        ids = [self.table.intern(v) for v in values]
+        self.assertEqual(len(set(ids)), 100)
+        self.assertEqual(len(self.table), 100)
+        self.assertEqual(list(self.table.resolve(ids)), values)
+
+    def test_remove(self):
+        intid = self.table.intern('abc')
+        self.table.remove('abc')
+        assert 'abc' not in self.table
+        assert self.table.get_value(intid) is None
+        self.assertEqual(len(self.table), 0)
+        self.assertRaises(KeyError, self.table.remove, 'abc')
+
+    def test_retain(self):
+        ids = [self.table.intern('uid-%s' % i) for i in range(10)]
+        self.assertEqual(self.table.retain(LLSet(ids[:3])), 7)
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(list(self.table.resolve(ids[:3])),
+                         ['uid-0', 'uid-1', 'uid-2'])
+        assert 'uid-3' not in self.table
+        self.assertEqual(self.table.retain(LLSet(ids)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
 import base64
 import unittest2 as unittest
+import time
 import uuid
 from hashlib import md5
 
+import transaction
+from ZODB import DB
+from BTrees.OOBTree import OOBTree
+
 from collective.subscribe.interfaces import ISubscriptionKeys
 from collective.subscribe.tests.common import MockSub
 from collective.subscribe.keys import SubscriptionKeys
@@ -18,7 +23,7 @@ INVALID = (
     (NAME, SUB.signature),
     )
 EXPECTED = base64.urlsafe_b64encode(
-    md5('%s/%s/%s' % (NAME, hash(SUB.signature()), UID)).digest())[:22]
+    md5('\x00'.join((NAME,) + SUB.signature() + (UID,))).digest())[:22]
 
 
 class KeysTest(unittest.TestCase):
@@ -57,6 +62,230 @@ class KeysTest(unittest.TestCase):
         del(self.subkeys[key])
         assert key not in self.subkeys
 
+    def test_stable_generation(self):
+        # known value, independent of process, interpreter or platform:
+        key = self.subkeys.generate('invited', ('member', 'somebody'),
+                                    '68c47dd7-897d-43f1-b610-a6a8c885fe36')
+        self.assertEqual(key, 'F41zgo2fwkYJcOu6EQ7BOw')
+
+    def test_add_many(self):
+        triples = [(NAME, ('member', 'user%03d' % i), UID)
+                   for i in range(100)]
+        keys = self.subkeys.add_many(iter(triples))
+        self.assertEqual(len(self.subkeys), 100)
+        for key, triple in zip(keys, triples):
+            self.assertEqual(key, self.subkeys.generate(*triple))
+            self.assertEqual(self.subkeys[key], triple)
+        self.assertRaises(ValueError, self.subkeys.add_many,
+                          [triples[0], INVALID[0]])
+        self.assertEqual(len(self.subkeys), 100)  # nothing added
+        self.assertEqual(self.subkeys.keys_for_item(UID), sorted(keys))
+        self.assertEqual(self.subkeys.keys_for_subscriber(triples[0][1]),
+                         keys[:1])
+        # duplicates, and existing keys (re-added with a ttl):
+        other = str(uuid.uuid4())
+        more = [(NAME, SUB.signature(), other)] * 2 + triples[:2]
+        added = self.subkeys.add_many(more, ttl=60)
+        self.assertEqual(len(self.subkeys), 101)
+        self.assertEqual(self.subkeys.keys_for_item(other), added[:1])
+        for key in added:
+            assert self.subkeys.expires(key) is not None
+        self.assertEqual(self.subkeys.expiry_stats()['expiring'], 3)
+
+    def test_rekey(self):
+        key = self.subkeys.add(NAME, SUB.signature(), UID)
+        self.subkeys['legacy-key'] = (NAME, ('member', 'other'), UID)
+        self.assertEqual(self.subkeys.rekey(), 1)
+        self.assertEqual(self.subkeys.rekey(), 0)
+        assert 'legacy-key' not in self.subkeys
+        assert key in self.subkeys
+        new_key = self.subkeys.generate(NAME, ('member', 'other'), UID)
+        self.assertEqual(self.subkeys[new_key], (NAME, ('member', 'other'),
+                                                 UID))
+
+    def test_reverse_lookup(self):
+        other_uid = str(uuid.uuid4())
+        sigs = [('member', 'user%03d' % i) for i in range(20)]
+        self.subkeys.add_many((NAME, sig, UID) for sig in sigs)
+        self.subkeys.add_many(('other', sig, other_uid) for sig in sigs[:5])
+        keys = self.subkeys.keys_for_item(UID)
+        self.assertEqual(len(keys), 20)
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(self.subkeys.keys_for_item(other_uid)), 5)
+        self.assertEqual(self.subkeys.keys_for_item(other_uid, NAME), [])
+        self.assertEqual(self.subkeys.keys_for_item(str(uuid.uuid4())), [])
+        self.assertEqual(
+            sorted(self.subkeys[k][0]
+                   for k in self.subkeys.keys_for_subscriber(sigs[0])),
+            [NAME, 'other'])
+        self.assertEqual(self.subkeys.keys_for_subscriber(sigs[0], 'other'),
+                         [self.subkeys.generate('other', sigs[0], other_uid)])
+        self.assertEqual(self.subkeys.keys_for_subscriber(SUB), [])
+        key = self.subkeys.add(NAME, SUB.signature(), UID)
+        self.assertEqual(self.subkeys.keys_for_subscriber(SUB), [key])
+
+    def test_revoke(self):
+        other_uid = str(uuid.uuid4())
+        sigs = [('member', 'user%03d' % i) for i in range(20)]
+        self.subkeys.add_many((NAME, sig, UID) for sig in sigs)
+        self.subkeys.add_many(('other', sig, other_uid) for sig in sigs)
+        self.assertEqual(self.subkeys.revoke_item(UID), 20)
+        self.assertEqual(self.subkeys.revoke_item(UID), 0)
+        self.assertEqual(len(self.subkeys), 20)
+        self.assertEqual(self.subkeys.revoke_subscriber(sigs[0], NAME), 0)
+        self.assertEqual(self.subkeys.revoke_subscriber(sigs[0]), 1)
+        self.assertEqual(len(self.subkeys), 19)
+        self.assertEqual(len(self.subkeys.keys_for_item(other_uid)), 19)
+
+    def test_reverse_maintained(self):
+        sig = SUB.signature()
+        key = self.subkeys.add(NAME, sig, UID)
+        # replacing value of key replaces reverse index entries:
+        self.subkeys[key] = (NAME, ('member', 'other'), UID)
+        self.assertEqual(self.subkeys.keys_for_subscriber(sig), [])
+        self.assertEqual(
+            self.subkeys.keys_for_subscriber(('member', 'other')), [key])
+        self.assertEqual(self.subkeys.pop(key), (NAME, ('member', 'other'),
+                                                 UID))
+        self.assertEqual(self.subkeys.pop(key, None), None)
+        self.assertRaises(KeyError, self.subkeys.pop, key)
+        self.assertEqual(self.subkeys.keys_for_item(UID), [])
+        self.subkeys.setdefault('abc', VALID)
+        self.subkeys.update({'def': VALID})
+        self.assertEqual(self.subkeys.keys_for_item(UID), ['abc', 'def'])
+        self.subkeys.clear()
+        self.assertEqual(self.subkeys.keys_for_item(UID), [])
+        self.assertEqual(self.subkeys.keys_for_subscriber(sig), [])
+
+    def test_reverse_persisted(self):
+        key = self.subkeys.add(NAME, SUB.signature(), UID)
+        copied = SubscriptionKeys()
+        copied.__setstate__(self.subkeys.__getstate__())
+        self.assertEqual(copied.keys_for_item(UID), [key])
+        # state of a 0.1 mapping, pickled without reverse indexes:
+        legacy = SubscriptionKeys()
+        legacy.__setstate__(OOBTree(self.subkeys).__getstate__())
+        for name in ('_by_subscriber', '_by_item', 'size', '_expires_size'):
+            del legacy.__dict__[name]
+        self.assertEqual(legacy.keys_for_subscriber(SUB), [key])
+        self.assertEqual(legacy.revoke_item(UID), 1)
+        self.assertEqual(len(legacy), 0)
+
+    def test_expiry(self):
+        key = self.subkeys.add(NAME, SUB.signature(), UID, ttl=3600)
+        assert self.subkeys.expires(key) > time.time() + 3500
+        assert not self.subkeys.is_expired(key)
+        assert self.subkeys.is_expired(key, now=time.time() + 3601)
+        self.subkeys.set_expiry(key, None)
+        assert self.subkeys.expires(key) is None
+        self.assertRaises(KeyError, self.subkeys.set_expiry, 'abc', 1.0)
+        self.subkeys.set_expiry(key, 100.0)
+        assert self.subkeys.is_expired(key)
+        del self.subkeys[key]
+        assert self.subkeys.expires(key) is None
+        # re-adding key without ttl makes it not expire:
+        self.subkeys.add(NAME, SUB.signature(), UID, ttl=60)
+        self.subkeys.add(NAME, SUB.signature(), UID)
+        assert self.subkeys.expires(key) is None
+        # rekey() keeps expiry times:
+        self.subkeys['legacy-key'] = (NAME, ('member', 'other'), UID)
+        self.subkeys.set_expiry('legacy-key', 1234.0)
+        self.subkeys.rekey()
+        new_key = self.subkeys.generate(NAME, ('member', 'other'), UID)
+        self.assertEqual(self.subkeys.expires(new_key), 1234.0)
+
+    def test_expired_lookup(self):
+        key = self.subkeys.add(NAME, SUB.signature(), UID, ttl=3600)
+        assert key in self.subkeys
+        self.assertEqual(self.subkeys[key], VALID)
+        self.subkeys.set_expiry(key, time.time() - 1)
+        # expired, not yet swept: lookups treat key as missing
+        assert key not in self.subkeys
+        assert not self.subkeys.has_key(key)
+        self.assertRaises(KeyError, self.subkeys.__getitem__, key)
+        self.assertEqual(self.subkeys.get(key), None)
+        self.assertEqual(len(self.subkeys), 1)
+        self.assertEqual(self.subkeys.keys_for_item(UID), [key])
+        self.assertEqual(self.subkeys.keys_for_item(UID, NAME), [key])
+        self.assertEqual(self.subkeys.pop(key, 'gone'), 'gone')
+        self.assertEqual(len(self.subkeys), 0)  # pop removed expired key
+        self.subkeys.add(NAME, SUB.signature(), UID, ttl=3600)
+        self.subkeys.set_expiry(key, time.time() - 1)
+        self.assertEqual(self.subkeys.setdefault(key, VALID), VALID)
+        assert self.subkeys.expires(key) is None
+        # re-adding an expired key without ttl makes it live:
+        self.subkeys.set_expiry(key, time.time() - 1)
+        self.subkeys.add(NAME, SUB.signature(), UID)
+        assert key in self.subkeys
+
+    def test_counters(self):
+        sigs = [('member', 'user%03d' % i) for i in range(10)]
+        keys = self.subkeys.add_many(((NAME, sig, UID) for sig in sigs),
+                                     ttl=60)
+        self.subkeys.add(NAME, SUB.signature(), UID)
+        self.subkeys['abc'] = VALID
+        self.assertEqual(len(self.subkeys), 12)
+        self.assertEqual(self.subkeys._expires_size(), 10)
+        del self.subkeys[keys[0]]
+        self.subkeys.pop(keys[1])
+        self.subkeys.set_expiry(keys[2], None)
+        self.assertEqual(len(self.subkeys), 10)
+        self.assertEqual(self.subkeys.expiry_stats()['expiring'], 7)
+        # mapping stored without counters counts on first use:
+        legacy = SubscriptionKeys()
+        legacy.__setstate__(self.subkeys.__getstate__())
+        del legacy.__dict__['size']
+        del legacy.__dict__['_expires_size']
+        legacy.set_expiry(keys[3], None)  # first change counts before
+        legacy.add_many([(NAME, ('member', 'new'), UID)], ttl=60)
+        del legacy['abc']
+        self.assertEqual(len(legacy), 10)
+        self.assertEqual(legacy.expiry_stats()['expiring'], 7)
+        self.subkeys.clear()
+        self.assertEqual(len(self.subkeys), 0)
+
+    def test_sweep(self):
+        now = time.time()
+        sigs = [('member', 'user%03d' % i) for i in range(30)]
+        short = self.subkeys.add_many(((NAME, sig, UID) for sig in sigs[:10]),
+                                      ttl=60)
+        self.subkeys.add_many(((NAME, sig, UID) for sig in sigs[10:20]),
+                              ttl=86400)
+        self.subkeys.add_many((NAME, sig, UID) for sig in sigs[20:])
+        self.assertEqual(self.subkeys.expiry_stats(now), {
+            'keys': 30, 'expiring': 20, 'expired': 0, 'live': 30})
+        later = now + 3600
+        self.assertEqual(self.subkeys.expiry_stats(later)['expired'], 10)
+        self.assertEqual(self.subkeys.sweep(now=now), 0)
+        self.assertEqual(self.subkeys.sweep(limit=4, now=later), 4)
+        self.assertEqual(self.subkeys.sweep(limit=None, now=later), 6)
+        for key in short:
+            assert key not in self.subkeys
+        self.assertEqual(self.subkeys.expiry_stats(later), {
+            'keys': 20, 'expiring': 10, 'expired': 0, 'live': 20})
+        removed = self.subkeys.sweep_all(batch_size=3, now=later + 86400)
+        self.assertEqual(removed, 10)
+        self.assertEqual(self.subkeys.expiry_stats(), {
+            'keys': 10, 'expiring': 0, 'expired': 0, 'live': 10})
+        self.assertEqual(len(self.subkeys._expiring), 0)  # buckets pruned
+
+    def test_sweep_all_commit(self):
+        db = DB(None)
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        subkeys = conn.root()['keys'] = SubscriptionKeys()
+        subkeys.add_many(((NAME, ('member', 'user%03d' % i), UID)
+                          for i in range(10)), ttl=60)
+        tm.commit()
+        self.assertEqual(subkeys.sweep_all(batch_size=4, commit=True,
+                                           now=time.time() + 3600), 10)
+        # committed by the connection's own transaction manager:
+        other = db.open(transaction.TransactionManager())
+        self.assertEqual(len(other.root()['keys']), 0)
+        other.close()
+        conn.close()
+        db.close()
+
     def tearDown(self):
         for key in list(self.subkeys):
             del(self.subkeys[key])
@@ -0,0 +1,82 @@
+import unittest2 as unittest
+
+from BTrees.LLBTree import LLSet, LLTreeSet
+
+from collective.subscribe.lazy import LazyResult
+
+
+class LazyResultTest(unittest.TestCase):
+    """Test lazy result sequence over integer id sets"""
+
+    def setUp(self):
+        self.resolved = []
+
+    def resolve(self, v):
+        self.resolved.append(v)
+        return 'value-%s' % v
+
+    def _results(self, settype=LLTreeSet):
+        return LazyResult(settype(range(0, 3000, 3)), self.resolve)
+
+    def test_len(self):
+        for settype in (LLSet, LLTreeSet):
+            result = self._results(settype)
+            self.assertEqual(len(result), 1000)
+            assert result
+            assert not self.resolved  # len does not resolve values
+        assert not LazyResult(LLSet(), self.resolve)
+
+    def test_index(self):
+        for settype in (LLSet, LLTreeSet):
+            result = self._results(settype)
+            self.assertEqual(result[0], 'value-0')
+            self.assertEqual(result[10], 'value-30')
+            self.assertEqual(result[-1], 'value-2997')
+            self.assertRaises(IndexError, result.__getitem__, 1000)
+            self.assertRaises(IndexError, result.__getitem__, -1001)
+
+    def test_slice_batch(self):
+        for settype in (LLSet, LLTreeSet):
+            self.resolved = []
+            result = self._results(settype)
+            page = result[50:55]
+            self.assertEqual(page, tuple('value-%s' % (i * 3)
+                                         for i in range(50, 55)))
+            self.assertEqual(len(self.resolved), 5)
+            self.assertEqual(result.batch(50, 5), page)
+            self.assertEqual(result.batch(998, 50),
+                             ('value-2994', 'value-2997'))
+            self.assertEqual(result[-2:], ('value-2994', 'value-2997'))
+            self.assertEqual(result.batch(2000, 50), ())
+
+    def test_slice_without_len(self):
+        class Unsized(LLTreeSet):
+            def __len__(self):
+                raise AssertionError('len() walks a stored tree set')
+        result = LazyResult(Unsized(range(0, 3000, 3)), self.resolve)
+        self.assertEqual(result.batch(0, 2), ('value-0', 'value-3'))
+        self.assertEqual(result[1:10:4], ('value-3', 'value-15',
+                                          'value-27'))
+        self.assertEqual(result[999], 'value-2997')
+        self.assertRaises(IndexError, result.__getitem__, 1000)
+        # negative positions need the length, if given:
+        result = LazyResult(Unsized(range(0, 3000, 3)), self.resolve, 1000)
+        self.assertEqual(result[-1], 'value-2997')
+        self.assertEqual(result[:-998], ('value-0', 'value-3'))
+        self.assertEqual(result[2::-1], ('value-6', 'value-3', 'value-0'))
+        self.assertEqual(len(result.map(str)), 1000)
+
+    def test_iter(self):
+        result = self._results()
+        self.assertEqual(len(list(result)), 1000)
+        self.assertEqual(len(self.resolved), 1000)
+
+    def test_map(self):
+        result = self._results().map(lambda v: v.upper())
+        self.assertEqual(len(result), 1000)
+        self.assertEqual(result.batch(1, 2), ('VALUE-3', 'VALUE-6'))
+        self.assertEqual(len(self.resolved), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import uuid
+import unittest2 as unittest
+
+from collective.subscribe.interfaces import IAssociationMetadata
+from collective.subscribe.interned import InternTable
+from collective.subscribe.metadata import AssociationMetadata
+from collective.subscribe.tests.common import MockSub
+
+
+UIDS = [str(uuid.uuid4()) for i in range(3)]
+SIGS = [('member', 'user%02d' % i) for i in range(10)]
+
+
+class MetadataTest(unittest.TestCase):
+    """Test association metadata store"""
+
+    def setUp(self):
+        self.signature_ids = InternTable()
+        self.uid_ids = InternTable()
+        for sig in SIGS:
+            self.signature_ids.intern(sig)
+        for uid in UIDS:
+            self.uid_ids.intern(uid)
+        self.metadata = AssociationMetadata(self.signature_ids, self.uid_ids)
+
+    def test_iface(self):
+        assert IAssociationMetadata.providedBy(self.metadata)
+
+    def test_get_update_remove(self):
+        md = self.metadata
+        assert md.get('like', SIGS[0], UIDS[0]) is None
+        self.assertEqual(md.get('like', SIGS[0], UIDS[0], {}), {})
+        record = md.update('like', SIGS[0], UIDS[0], subscribed=1.0)
+        self.assertEqual(record, {'subscribed': 1.0})
+        record['subscribed'] = 2.0  # copy, does not modify stored record
+        md.update('like', SIGS[0], UIDS[0], delivery='digest')
+        self.assertEqual(md.get('like', SIGS[0], UIDS[0]),
+                         {'subscribed': 1.0, 'delivery': 'digest'})
+        assert md.get('love', SIGS[0], UIDS[0]) is None
+        self.assertEqual(len(md), 1)
+        self.assertRaises(KeyError, md.update, 'like', ('member', 'x'),
+                          UIDS[0], subscribed=1.0)
+        sub = MockSub()
+        self.signature_ids.intern(sub.signature())
+        md.update('like', sub, UIDS[1], subscribed=3.0)
+        self.assertEqual(md.get('like', sub.signature(), UIDS[1]),
+                         {'subscribed': 3.0})
+        md.remove('like', SIGS[0], UIDS[0])
+        md.remove('like', SIGS[0], UIDS[0])  # no-op
+        md.remove('like', ('member', 'x'), UIDS[0])  # unknown: no-op
+        assert md.get('like', SIGS[0], UIDS[0]) is None
+        self.assertEqual(len(md), 1)
+
+    def test_bulk(self):
+        md = self.metadata
+        pairs = [(sig, UIDS[0]) for sig in SIGS]
+        pairs.append((('member', 'unknown'), UIDS[0]))
+        self.assertEqual(md.add_many('like', pairs, subscribed=1.0), 10)
+        self.assertEqual(md.add_many('like', pairs, subscribed=2.0), 0)
+        self.assertEqual(md.update_many('like', pairs[:5], notified=3.0), 5)
+        self.assertEqual(md.get('like', SIGS[0], UIDS[0]),
+                         {'subscribed': 1.0, 'notified': 3.0})
+        self.assertEqual(md.get('like', SIGS[9], UIDS[0]),
+                         {'subscribed': 1.0})
+        self.assertEqual(md.remove_many('like', pairs[:3]), 3)
+        self.assertEqual(len(md), 7)
+
+    def test_for_item(self):
+        md = self.metadata
+        for uid in UIDS:
+            md.add_many('like', [(sig, uid) for sig in SIGS], subscribed=1.0)
+            md.add_many('likes', [(SIGS[0], uid)], subscribed=2.0)
+        md.update('love', SIGS[1], UIDS[1], subscribed=3.0)
+        result = list(md.for_item(UIDS[1]))
+        self.assertEqual(len(result), 12)
+        self.assertEqual(sorted(set(name for name, sig, r in result)),
+                         ['like', 'likes', 'love'])
+        result = list(md.for_item(UIDS[1], 'like'))
+        self.assertEqual(sorted(sig for name, sig, r in result), SIGS)
+        self.assertEqual(list(md.for_item(UIDS[1], 'likes')),
+                         [('likes', SIGS[0], {'subscribed': 2.0})])
+        self.assertEqual(list(md.for_item(str(uuid.uuid4()))), [])
+        self.assertEqual(len(list(md.records())), 34)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import uuid
+import unittest2 as unittest
+
+from collective.subscribe.interfaces import IPairNames
+from collective.subscribe.interned import InternTable
+from collective.subscribe.pairs import PairNames
+from collective.subscribe.subscriber import SubscriberRecord
+from collective.subscribe.tests.common import MockSub
+
+
+UIDS = [str(uuid.uuid4()) for i in range(5)]
+SIGS = [('member', 'user%02d' % i) for i in range(10)]
+
+
+class PairNamesTest(unittest.TestCase):
+    """Test relationship names by (subscriber, item) pair"""
+
+    def setUp(self):
+        self.signature_ids = InternTable()
+        self.uid_ids = InternTable()
+        for sig in SIGS:
+            self.signature_ids.intern(sig)
+        for uid in UIDS:
+            self.uid_ids.intern(uid)
+        self.pairs = PairNames(self.signature_ids, self.uid_ids)
+
+    def test_iface(self):
+        assert IPairNames.providedBy(self.pairs)
+
+    def test_add_remove(self):
+        pairs = self.pairs
+        self.assertEqual(pairs.names(SIGS[0], UIDS[0]), ())
+        self.assertEqual(pairs.add_many('subscribed', [(SIGS[0], UIDS[0])]),
+                         1)
+        self.assertEqual(pairs.add_many('owner', [(SIGS[0], UIDS[0])]), 1)
+        self.assertEqual(pairs.add_many('owner', [(SIGS[0], UIDS[0])]), 0)
+        self.assertEqual(pairs.names(SIGS[0], UIDS[0]),
+                         ('owner', 'subscribed'))
+        self.assertEqual(len(pairs), 1)
+        # values not interned are skipped:
+        self.assertEqual(pairs.add_many('owner', [(('member', 'x'),
+                                                   UIDS[0])]), 0)
+        self.assertEqual(pairs.names(('member', 'x'), UIDS[0]), ())
+        self.assertEqual(pairs.remove_many('owner', [(SIGS[0], UIDS[0])]), 1)
+        self.assertEqual(pairs.remove_many('owner', [(SIGS[0], UIDS[0])]), 0)
+        self.assertEqual(pairs.names(SIGS[0], UIDS[0]), ('subscribed',))
+        pairs.remove_many('subscribed', [(SIGS[0], UIDS[0])])
+        self.assertEqual(len(pairs), 0)
+        sub = MockSub()
+        self.signature_ids.intern(sub.signature())
+        pairs.add_many('likes', [(sub, UIDS[1])])
+        self.assertEqual(pairs.names(sub.signature(), UIDS[1]), ('likes',))
+        # a SubscriberRecord (a tuple) is a subscriber, not a signature:
+        record = SubscriberRecord(user='user03')
+        pairs.add_many('likes', [(record, UIDS[2])])
+        self.assertEqual(pairs.names(SIGS[3], UIDS[2]), ('likes',))
+        self.assertEqual(pairs.names(record, UIDS[2]), ('likes',))
+
+    def test_names_for_items(self):
+        pairs = self.pairs
+        pairs.add_many('subscribed', [(SIGS[0], uid) for uid in UIDS[:3]])
+        pairs.add_many('owner', [(SIGS[0], UIDS[1]), (SIGS[1], UIDS[2])])
+        unknown = str(uuid.uuid4())
+        self.assertEqual(
+            pairs.names_for_items(SIGS[0], UIDS + [unknown]),
+            {UIDS[0]: ('subscribed',),
+             UIDS[1]: ('owner', 'subscribed'),
+             UIDS[2]: ('subscribed',),
+             UIDS[3]: (),
+             UIDS[4]: (),
+             unknown: ()})
+        self.assertEqual(pairs.names_for_items(('member', 'x'), UIDS[:1]),
+                         {UIDS[0]: ()})
+
+
+if __name__ == '__main__':
+    unittest.main()
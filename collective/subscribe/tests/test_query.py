@@ -0,0 +1,161 @@
+import uuid
+import unittest2 as unittest
+
+from collective.subscribe.catalog import SubscriptionCatalog
+from collective.subscribe.interfaces import IQuery
+from collective.subscribe.query import Related, And, Or, Not
+from collective.subscribe.tests.common import MockSub
+
+
+UIDS = [str(uuid.uuid4()) for i in range(10)]
+SIG = ('member', 'jdoe')
+OTHER = ('member', 'other')
+
+
+class QueryTest(unittest.TestCase):
+    """Test boolean queries against a subscription catalog"""
+
+    def setUp(self):
+        self.catalog = SubscriptionCatalog()
+        self.catalog.index_many(SIG, 'watch', uids=UIDS[:6])
+        self.catalog.index_many(SIG, 'owner', uids=UIDS[4:8])
+        self.catalog.index_many(SIG, 'muted', uids=UIDS[2:5])
+        self.catalog.index_many(OTHER, 'watch', uids=UIDS[:2])
+
+    def search(self, query):
+        return sorted(self.catalog.search(query))
+
+    def test_construction(self):
+        query = Related('watch', SIG) & Related('owner', SIG)
+        assert IQuery.providedBy(query)
+        assert isinstance(query, And)
+        self.assertEqual(query.names(), ('owner', 'watch'))
+        # nested like operations are flattened, keys are normalized:
+        query = query & Related('muted', SIG)
+        self.assertEqual(len(query.queries), 3)
+        self.assertEqual(query.key(), And(Related('muted', SIG),
+                                          Related('owner', SIG),
+                                          Related('watch', SIG)).key())
+        self.assertEqual(Related('watch', MockSub()).value,
+                         MockSub().signature())
+        assert ~~Related('watch', SIG) is not None
+        self.assertRaises(ValueError, Related, 'watch', 123)
+        # mixed kinds of terms:
+        self.assertRaises(ValueError, And, Related('watch', SIG),
+                          Related('watch', UIDS[0]))
+        self.assertRaises(ValueError, Or, Related('watch', SIG),
+                          Not(Related('muted', SIG)))
+        self.assertRaises(ValueError, And, Not(Related('muted', SIG)))
+        self.assertRaises(ValueError, And)
+        self.assertRaises(ValueError, self.catalog.search,
+                          Not(Related('muted', SIG)))
+
+    def test_search(self):
+        watch, owner, muted = [Related(name, SIG)
+                               for name in ('watch', 'owner', 'muted')]
+        self.assertEqual(self.search(watch), sorted(UIDS[:6]))
+        self.assertEqual(self.search(watch & owner), sorted(UIDS[4:6]))
+        self.assertEqual(self.search(watch | owner), sorted(UIDS[:8]))
+        self.assertEqual(self.search((watch | owner) & ~muted),
+                         sorted(UIDS[:2] + UIDS[5:8]))
+        self.assertEqual(self.search(watch & ~muted & ~owner),
+                         sorted(UIDS[:2]))
+        self.assertEqual(self.search(watch & Related('unknown', SIG)), [])
+        self.assertEqual(self.search(watch & ~Related('unknown', SIG)),
+                         sorted(UIDS[:6]))
+        # queries for subscribers of an item:
+        self.assertEqual(self.search(Related('watch', UIDS[0])),
+                         sorted([SIG, OTHER]))
+        self.assertEqual(self.search(Related('watch', UIDS[0]) &
+                                     ~Related('muted', UIDS[0])),
+                         sorted([SIG, OTHER]))
+        self.assertEqual(self.search(Related('watch', UIDS[1]) &
+                                     ~Related('watch', UIDS[5])), [OTHER])
+
+    def test_explain(self):
+        watch, owner, muted = [Related(name, SIG)
+                               for name in ('watch', 'owner', 'muted')]
+        steps = self.catalog.explain(watch & owner & ~muted)
+        self.assertEqual([(s['op'], s['size'], s['result']) for s in steps],
+                         [('lookup', 4, 4),          # owner, smallest first
+                          ('lookup', 6, 6),          # watch
+                          ('intersection', 6, 2),
+                          ('lookup', 3, 3),          # muted
+                          ('difference', 3, 1)])
+        self.assertEqual(steps[0]['term'], repr(owner))
+        # short-circuit on empty intersection:
+        nothing = Related('watch', ('member', 'nobody'))
+        steps = self.catalog.explain(watch & nothing & owner & ~muted)
+        self.assertEqual([(s['op'], s['result']) for s in steps],
+                         [('lookup', 0), ('skip', 0), ('skip', 0),
+                          ('skip', 0)])
+        steps = self.catalog.explain(watch | owner)
+        self.assertEqual(steps[-1]['op'], 'union')
+        self.assertEqual(steps[-1]['result'], 8)
+        # queries accepted by search(), as equivalent IQuery:
+        steps = self.catalog.explain({'watch': SIG, 'owner': SIG})
+        self.assertEqual([(s['op'], s['result']) for s in steps],
+                         [('lookup', 4), ('lookup', 6),
+                          ('intersection', 2)])
+        steps = self.catalog.explain(SIG)  # unnamed: all indexes
+        self.assertEqual(steps[-1]['op'], 'union')
+        self.assertEqual(steps[-1]['result'], 8)
+        self.assertEqual(self.catalog.explain({'unknown': SIG}), [])
+
+    def test_stream(self):
+        watch, owner, muted = [Related(name, SIG)
+                               for name in ('watch', 'owner', 'muted')]
+        for query in (watch, watch & owner, watch | owner,
+                      (watch | owner) & ~muted, watch & ~muted & ~owner,
+                      watch & (owner | muted), watch & Related('none', SIG),
+                      Related('watch', UIDS[0]) & ~Related('muted', UIDS[0])):
+            table, ids = self.catalog._search_ids(query)
+            table, stream = query.stream(self.catalog)
+            self.assertEqual(list(stream), list(ids))
+            expected = self.catalog.search(query)
+            self.assertEqual(self.catalog.search(query, limit=2),
+                             expected[:2])
+
+    def test_stream_lazy(self):
+        # streaming reads only as much of the sets as needed:
+        class Counting(object):
+            def __init__(self, ids):
+                self.ids, self.read = ids, 0
+
+            def __iter__(self):
+                for intid in self.ids:
+                    self.read += 1
+                    yield intid
+
+        idx = self.catalog.indexes['watch']
+        sid = self.catalog.signature_ids.get_id(SIG)
+        counting = Counting(idx._reverse[sid])
+        original = idx.item_ids_for
+        idx.item_ids_for = lambda sub: counting
+        try:
+            table, stream = Related('watch', SIG).stream(self.catalog)
+            self.assertEqual(len([i for i, intid in zip(range(2), stream)]),
+                             2)
+        finally:
+            idx.item_ids_for = original
+        self.assertEqual(counting.read, 2)
+
+    def test_cache(self):
+        catalog = self.catalog
+        catalog.cache_size = 10
+        watch, owner = Related('watch', SIG), Related('owner', SIG)
+        self.assertEqual(len(catalog.search(watch & owner)), 2)
+        self.assertEqual(len(catalog.search(owner & watch)), 2)
+        self.assertEqual(catalog.cache_stats()['hits'], 1)
+        catalog.index(SIG, UIDS[8], 'watch')
+        catalog.index(SIG, UIDS[8], 'owner')
+        self.assertEqual(len(catalog.search(watch & owner)), 3)
+        # index for a term added after result was cached:
+        later = watch & ~Related('later', SIG)
+        self.assertEqual(len(catalog.search(later)), 7)
+        catalog.index(SIG, UIDS[0], 'later')
+        self.assertEqual(len(catalog.search(later)), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,18 @@
 
 import sys
+import uuid
 import unittest2 as unittest
 from new import instancemethod as methodtype
 
 import persistent
+import transaction
+from ZODB import DB
 from zope.interface import Invalid
 from zope.schema import getSchemaValidationErrors, ValidationError
 
 from collective.subscribe.interfaces import IItemSubscriber, ISubscribers
 from collective.subscribe.subscriber import ItemSubscriber, SubscribersContainer
+from collective.subscribe.subscriber import SubscriberRecord
 from collective.subscribe.tests.common import DATA, DATAKEY, MockSub
 
 
@@ -65,6 +69,28 @@ class TestSubscriber(unittest.TestCase):
         sub2.user = 'here'  # default namespace is 'member'
         assert sub2.signature() == key2
 
+    def test_signature_cache(self):
+        sub = ItemSubscriber(email='me@example.com')
+        sig = sub.signature()
+        self.assertEqual(sig, ('email', 'me@example.com'))
+        assert sub.signature() is sig  # cached
+        sub.name = u'Me'  # not a field of signature, cache kept
+        assert sub.signature() is sig
+        sub.user = 'me'  # setting field of signature invalidates
+        self.assertEqual(sub.signature(), ('member', 'me'))
+        sub.namespace = 'group'
+        self.assertEqual(sub.signature(), ('group', 'me'))
+        sub.user = None
+        self.assertEqual(sub.signature(), ('email', 'me@example.com'))
+        sub.email = None
+        self.assertRaises(Invalid, sub.signature)
+        # validation on set is kept:
+        self.assertRaises(ValidationError, setattr, sub, 'user', u'me')
+        # cache is volatile, not part of stored state:
+        sub.user = 'me'
+        sub.signature()
+        assert '_v_signature' not in sub.__getstate__()
+
     def test_construction(self):
         """Test different construction parameters for subscriber"""
         subscriber = ItemSubscriber()
@@ -111,6 +137,231 @@ class TestSubscriber(unittest.TestCase):
             subscriber)
 
 
+class RecordTest(unittest.TestCase):
+    """Test lightweight subscriber records"""
+
+    def test_record(self):
+        record = SubscriberRecord(user=u'jdoe', name='J. Doe')
+        assert IItemSubscriber.providedBy(record)
+        self.assertEqual(record.signature(), ('member', 'jdoe'))
+        assert isinstance(record.user, str)
+        assert isinstance(record.name, unicode)
+        self.assertRaises(AttributeError, setattr, record, 'user', 'x')
+        record = record.replace(user=None, email='jdoe@example.com')
+        self.assertEqual(record.signature(), ('email', 'jdoe@example.com'))
+        self.assertEqual(record.name, u'J. Doe')
+        self.assertRaises(Invalid, SubscriberRecord, name=u'Nobody')
+        self.assertRaises(Invalid, record.replace, email=None)
+        self.assertRaises(ValidationError, SubscriberRecord, user='a\nb')
+
+    def test_conversion(self):
+        sub = ItemSubscriber(user='jdoe', email='jdoe@example.com')
+        record = SubscriberRecord.from_subscriber(sub)
+        self.assertEqual(record.signature(), sub.signature())
+        self.assertEqual(record.email, sub.email)
+        record = SubscriberRecord.from_fields(dict(sub.__dict__, extra=1))
+        self.assertEqual(record.signature(), sub.signature())
+
+
+class InlineContainerTest(unittest.TestCase):
+    """Test subscriber container in inline storage mode"""
+
+    def setUp(self):
+        self.container = SubscribersContainer(inline=True)
+
+    def test_add(self):
+        container = self.container
+        k, v = container.add(ItemSubscriber(user='a', email='a@example.com'))
+        assert isinstance(v, SubscriberRecord)
+        self.assertEqual(k, ('member', 'a'))
+        k, v = container.add(user='b')
+        assert isinstance(v, SubscriberRecord)
+        k, v = container.add({'email': 'c@example.com'})
+        self.assertEqual(k, ('email', 'c@example.com'))
+        k, v = container.add(MockSub())
+        assert isinstance(v, SubscriberRecord)
+        self.assertEqual(len(container), 4)
+        assert v in container
+        assert SubscriberRecord.from_subscriber(MockSub()) in container
+        self.assertRaises(ValueError, container.add, user='b')
+        # records are modified by replacing them:
+        container[k] = container[k].replace(name=u'Changed')
+        self.assertEqual(container.get(k).name, u'Changed')
+        self.assertEqual(len(container), 4)
+
+    def test_set_inline(self):
+        container = SubscribersContainer()
+        for i in range(5):
+            container.add(user='user%s' % i)
+        assert isinstance(container[('member', 'user0')], ItemSubscriber)
+        self.assertEqual(container.set_inline(), 5)
+        assert container.inline
+        assert isinstance(container[('member', 'user0')], SubscriberRecord)
+        self.assertEqual(container.set_inline(), 0)
+        self.assertEqual(container.set_inline(False), 5)
+        assert isinstance(container[('member', 'user0')], ItemSubscriber)
+        self.assertEqual(len(container), 5)
+
+    def test_set_inline_batches(self):
+        db = DB(None)  # in-memory MappingStorage
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        container = SubscribersContainer(inline=True)
+        conn.root()['subscribers'] = container
+        for i in range(25):
+            container.add(user='user%02d' % i)
+        tm.commit()
+        self.assertLess(len(db.storage), 25)
+        self.assertEqual(container.set_inline(True, batch_size=10), 0)
+        self.assertEqual(container.set_inline(False, batch_size=10,
+                                              commit=True), 25)
+        self.assertGreater(len(db.storage), 25)  # committed, in batches
+        self.assertEqual(container.set_inline(True, batch_size=7), 25)
+        tm.abort()  # savepoints only: nothing committed
+        assert not conn.root()['subscribers'].inline
+        conn.close()
+        db.close()
+
+    def test_persistence(self):
+        db = DB(None)  # in-memory MappingStorage
+        conn = db.open()
+        conn.root()['subscribers'] = self.container
+        for i in range(100):
+            self.container.add(user='user%03d' % i, name=u'User %s' % i)
+        transaction.commit()
+        self.assertLess(len(db.storage), 20)  # not an oid per subscriber
+        conn2 = db.open(transaction_manager=transaction.TransactionManager())
+        container = conn2.root()['subscribers']
+        assert container.inline
+        subs = container.get_many([('member', 'user%03d' % i)
+                                   for i in range(100)])
+        assert all(isinstance(sub, SubscriberRecord) for sub in subs)
+        self.assertEqual(subs[42].name, u'User 42')
+        self.assertEqual(subs[42].signature(), ('member', 'user042'))
+        conn2.close()
+        conn.close()
+        db.close()
+
+
+class EmailIndexTest(unittest.TestCase):
+    """Test email secondary index of subscriber container"""
+
+    def setUp(self):
+        self.container = SubscribersContainer()
+        self.container.add(user='jdoe', email='JDoe@example.com')
+        self.container.add(email='jdoe@example.com')
+        self.container.add(namespace='openid', user='jdoe',
+                           email='jdoe@example.com')
+        self.container.add(user='other', email='other@example.com')
+        self.container.add(user='noemail')
+
+    def test_lookup(self):
+        container = self.container
+        expected = [('email', 'jdoe@example.com'), ('member', 'jdoe'),
+                    ('openid', 'jdoe')]
+        self.assertEqual(container.keys_for_email('jdoe@example.com'),
+                         expected)
+        self.assertEqual(container.keys_for_email('JDOE@example.com'),
+                         expected)
+        self.assertEqual(container.keys_for_email('none@example.com'), [])
+        records = container.get_by_email('jdoe@example.com')
+        self.assertEqual([r.signature() for r in records], expected)
+        found = container.keys_for_emails(['other@example.com',
+                                           'JDoe@Example.com',
+                                           'none@example.com'])
+        self.assertEqual(found, {'other@example.com': [('member', 'other')],
+                                 'JDoe@Example.com': expected,
+                                 'none@example.com': []})
+
+    def test_maintained(self):
+        container = self.container
+        del container[('member', 'jdoe')]
+        self.assertEqual(len(container.keys_for_email('jdoe@example.com')),
+                         2)
+        container[('member', 'other')] = ItemSubscriber(
+            user='other', email='new@example.com')
+        self.assertEqual(container.keys_for_email('other@example.com'), [])
+        self.assertEqual(container.keys_for_email('new@example.com'),
+                         [('member', 'other')])
+        # persistent object modified in place is reindexed on request:
+        sub = container[('openid', 'jdoe')]
+        sub.email = 'changed@example.com'
+        container.reindex_email(sub)
+        self.assertEqual(container.keys_for_email('changed@example.com'),
+                         [('openid', 'jdoe')])
+        self.assertEqual(container.keys_for_email('jdoe@example.com'),
+                         [('email', 'jdoe@example.com')])
+        # inline records:
+        container.set_inline()
+        self.assertEqual(container.keys_for_email('new@example.com'),
+                         [('member', 'other')])
+        container.add(user='inline', email='new@example.com')
+        self.assertEqual(len(container.keys_for_email('new@example.com')), 2)
+
+    def test_legacy(self):
+        container = self.container
+        del container.__dict__['_by_email']
+        del container.__dict__['_email_of']
+        self.assertEqual(len(container.keys_for_email('jdoe@example.com')),
+                         3)
+
+
+class NamespaceTest(unittest.TestCase):
+    """Test namespace iteration and counts of subscriber container"""
+
+    def setUp(self):
+        self.container = SubscribersContainer()
+        for i in range(25):
+            self.container.add(user='user%02d' % i)
+        for i in range(10):
+            self.container.add(email='user%02d@example.com' % i)
+        self.container.add(namespace='uuid', user=str(uuid.uuid4()))
+
+    def test_iter_namespace(self):
+        container = self.container
+        items = list(container.iter_namespace('member', batch_size=7))
+        self.assertEqual([key for key, sub in items],
+                         [('member', 'user%02d' % i) for i in range(25)])
+        self.assertEqual(items[3][1].user, 'user03')
+        self.assertEqual(len(list(container.iter_namespace('email'))), 10)
+        self.assertEqual(len(list(container.iter_namespace('uuid', None, 1))),
+                         1)
+        self.assertEqual(list(container.iter_namespace('none')), [])
+        self.assertEqual(list(container.iter_namespace('mem')), [])
+        # range ends at namespace, whatever sorts next:
+        container.add(user='nobody', namespace='membership')
+        self.assertEqual(len(list(container.iter_namespace('member', None,
+                                                           25))), 25)
+        self.assertEqual([key for key, sub in
+                          container.iter_namespace('member', 'user99')], [])
+        # resume from identifier (inclusive):
+        items = list(container.iter_namespace('member', 'user20', 2))
+        self.assertEqual(len(items), 5)
+        self.assertEqual(items[0][0], ('member', 'user20'))
+
+    def test_count_namespace(self):
+        container = self.container
+        self.assertEqual(container.count_namespace('member'), 25)
+        self.assertEqual(container.count_namespace('email'), 10)
+        self.assertEqual(container.count_namespace('none'), 0)
+        del container[('member', 'user00')]
+        container.add(user='user00', namespace='group')
+        self.assertEqual(container.namespace_counts(),
+                         {'member': 24, 'email': 10, 'uuid': 1, 'group': 1})
+        del container[('uuid', container.iter_namespace('uuid').next()[0][1])]
+        self.assertEqual(container.count_namespace('uuid'), 0)
+        self.assertEqual(sorted(container.namespace_counts()),
+                         ['email', 'group', 'member'])
+        # containers stored without counters count on first use:
+        del container.__dict__['_namespace_sizes']
+        self.assertEqual(container.count_namespace('member'), 24)
+        # ...including when the first use is a delete:
+        del container.__dict__['_namespace_sizes']
+        del container[('member', 'user01')]
+        self.assertEqual(container.count_namespace('member'), 23)
+        self.assertEqual(container.count_namespace('group'), 1)
+
+
 class ContainerTest(unittest.TestCase):
     """Test subscriber container/mapping without a ZODB fixture"""
 
@@ -265,6 +516,23 @@ class ContainerTest(unittest.TestCase):
         self.assertEqual(self.container.size(), 1)
         self.assertEqual(self.container.size(), len(self.container))
 
+    def test_get_many(self):
+        keys = [self.container.add(user='user%03d' % i)[0]
+                for i in range(100)]
+        mock = MockSub()
+        self.assertEqual(self.container.get_many([]), [])
+        # sparse (probe each key) and dense (walk range) lookups:
+        for wanted in (keys[50:53], keys[::-2]):
+            lookup = wanted + [mock, wanted[0]]
+            result = self.container.get_many(lookup, default='missing')
+            self.assertEqual(len(result), len(lookup))
+            for key, record in zip(wanted, result):
+                assert record is self.container.get(key)
+            self.assertEqual(result[-2], 'missing')
+            assert result[-1] is result[0]
+        self.container.add(mock)
+        assert self.container.get_many([mock])[0] is self.container.get(mock)
+
     def tearDown(self):
         for key in list(self.container):
             del(self.container[key])
@@ -0,0 +1,51 @@
+import unittest2 as unittest
+
+from collective.subscribe.timeline import Timeline
+
+
+class TimelineTest(unittest.TestCase):
+    """Test time-ordered secondary index of integer ids"""
+
+    def setUp(self):
+        self.timeline = Timeline()
+        for i in range(100):
+            # item 1: subscribers 0..99 at times 1000..1099
+            self.timeline.add(1, i, 1000.0 + i)
+        self.timeline.add(2, 5, 500.0)
+
+    def test_add_remove(self):
+        timeline = self.timeline
+        self.assertEqual(len(timeline), 101)
+        assert not timeline.add(1, 5, 2000.0)  # keeps original time
+        self.assertEqual(timeline.timestamp(1, 5), 1005.0)
+        assert timeline.remove(1, 5)
+        assert not timeline.remove(1, 5)
+        assert timeline.timestamp(1, 5) is None
+        self.assertEqual(timeline.items(5), [(500.0, 2)])
+        assert timeline.remove(2, 5)
+        self.assertEqual(timeline.items(5), [])
+        assert 5 not in timeline._by_subscriber  # pruned empty set
+        self.assertEqual(len(timeline), 99)
+
+    def test_range(self):
+        timeline = self.timeline
+        found = timeline.subscribers(1, 1090.0)
+        self.assertEqual(found, [(1000.0 + i, i) for i in range(90, 100)])
+        found = timeline.subscribers(1, 1010.0, 1013.0)  # end excluded
+        self.assertEqual([sid for t, sid in found], [10, 11, 12])
+        found = timeline.subscribers(1, end=1002.0)
+        self.assertEqual([sid for t, sid in found], [0, 1])
+        self.assertEqual(timeline.subscribers(3), [])
+        self.assertEqual(timeline.items(5), [(500.0, 2), (1005.0, 1)])
+
+    def test_recent(self):
+        found = self.timeline.subscribers(1, newest_first=True, limit=3)
+        self.assertEqual([sid for t, sid in found], [99, 98, 97])
+        found = self.timeline.items(5, newest_first=True, limit=1)
+        self.assertEqual(found, [(1005.0, 1)])
+        found = self.timeline.subscribers(1, 1050.0, 1060.0, True, 2)
+        self.assertEqual([sid for t, sid in found], [59, 58])
+
+
+if __name__ == '__main__':
+    unittest.main()
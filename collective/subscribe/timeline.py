@@ -0,0 +1,100 @@
+from itertools import islice
+
+from persistent import Persistent
+from BTrees.OOBTree import OOTreeSet
+from BTrees.Length import Length
+
+from collective.subscribe.utils import IdMapping, ValueMapping
+
+
+def _between(members, start, end, newest_first, limit):
+    """
+    Given OOTreeSet of (timestamp, id) tuples, return list of those with
+    timestamp in [start, end), oldest (or newest) first, at most limit.
+    """
+    lo = (start,) if start is not None else None
+    hi = (end,) if end is not None else None
+    found = members.keys(lo, hi)  # lazy, walks only range
+    if newest_first:
+        found = reversed(found)
+    if limit is not None:
+        found = islice(found, limit)
+    return list(found)
+
+
+class Timeline(Persistent):
+    """
+    Time-ordered secondary index of associations of a subscription
+    index: for each item (integer uid id), an OOTreeSet of (timestamp,
+    signature id), and for each subscriber, an OOTreeSet of (timestamp,
+    uid id), such that range and recency queries walk only the range of
+    timestamps asked for.  Timestamps are also kept by (uid id, signature
+    id), in a large-bucket tree (written by every index()), to remove
+    entries on unindex.
+    """
+
+    def __init__(self):
+        self._by_item = IdMapping()         # uid id -> OOTreeSet
+        self._by_subscriber = IdMapping()   # signature id -> OOTreeSet
+        self._times = ValueMapping()        # (uid id, sig id) -> timestamp
+        self.size = Length()
+
+    def _members(self, mapping, key):
+        members = mapping.get(key, None)
+        if members is None:
+            members = mapping[key] = OOTreeSet()
+        return members
+
+    def add(self, uid, sid, timestamp):
+        """
+        Add association at timestamp; an association already in the
+        timeline keeps its original timestamp.  Returns True if added.
+        """
+        if (uid, sid) in self._times:
+            return False
+        self._times[(uid, sid)] = timestamp
+        self._members(self._by_item, uid).insert((timestamp, sid))
+        self._members(self._by_subscriber, sid).insert((timestamp, uid))
+        self.size.change(1)
+        return True
+
+    def remove(self, uid, sid):
+        timestamp = self._times.pop((uid, sid), None)
+        if timestamp is None:
+            return False
+        for mapping, key, entry in ((self._by_item, uid, (timestamp, sid)),
+                                    (self._by_subscriber, sid,
+                                     (timestamp, uid))):
+            members = mapping[key]
+            members.remove(entry)
+            if not members:
+                del mapping[key]  # prune empty set
+        self.size.change(-1)
+        return True
+
+    def timestamp(self, uid, sid):
+        return self._times.get((uid, sid), None)
+
+    def subscribers(self, uid, start=None, end=None, newest_first=False,
+                    limit=None):
+        """list of (timestamp, signature id) for item uid id"""
+        members = self._by_item.get(uid, None)
+        if members is None:
+            return []
+        return _between(members, start, end, newest_first, limit)
+
+    def items(self, sid, start=None, end=None, newest_first=False,
+              limit=None):
+        """list of (timestamp, uid id) for subscriber signature id"""
+        members = self._by_subscriber.get(sid, None)
+        if members is None:
+            return []
+        return _between(members, start, end, newest_first, limit)
+
+    def entries(self):
+        """iterate over all (uid id, signature id, timestamp)"""
+        for (uid, sid), timestamp in self._times.items():
+            yield uid, sid, timestamp
+
+    def __len__(self):
+        return self.size()
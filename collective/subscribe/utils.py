@@ -1,13 +1,130 @@
+import transaction
 from zope import schema
 from zope.schema.fieldproperty import FieldProperty
+from BTrees.LLBTree import LLTreeSet
+from BTrees.LOBTree import LOBTree
+from BTrees.OLBTree import OLBTree
+from BTrees.OOBTree import OOBTree
 
+from collective.subscribe.interfaces import IItemSubscriber
 
-def bind_field_properties(cls_locals, iface):
+
+def bind_field_properties(cls_locals, iface, names=None,
+                          factory=FieldProperty):
     for name, field in schema.getFieldsInOrder(iface):
-        cls_locals[name] = FieldProperty(field)
+        if names is None or name in names:
+            cls_locals[name] = factory(field)
 
 valid_signature = lambda v: (isinstance(v, tuple) and
                              len(v) == 2 and
                              isinstance(v[0], str) and
                              isinstance(v[1], str))
 
+
+def prefixed(members, prefix):
+    """
+    Given OOTreeSet of (prefix, key) tuples, iterate over keys for
+    prefix, walking only the range of entries for prefix.
+    """
+    for value, key in members.keys((prefix,)):
+        if value != prefix:
+            break
+        yield key
+
+
+def signature_of(subscriber):
+    """
+    Signature of subscriber: of an IItemSubscriber object (tested first,
+    as SubscriberRecord is itself a tuple), or else of a signature given
+    as a sequence, as a tuple.  Not validated.
+    """
+    if IItemSubscriber.providedBy(subscriber):
+        return subscriber.signature()
+    return tuple(subscriber)
+
+
+def interned_pairs(signature_ids, uid_ids, pairs):
+    """
+    Given (subscriber, uid) pairs, return list of (signature id, uid id)
+    for pairs with both values interned in the given intern tables (any
+    other pair is not indexed), looking ids up in bulk.
+    """
+    pairs = [(signature_of(sub), str(uid)) for sub, uid in pairs]
+    sids = signature_ids.get_ids([sig for sig, uid in pairs])
+    uids = uid_ids.get_ids([uid for sig, uid in pairs])
+    return [(sids[sig], uids[uid]) for sig, uid in pairs
+            if sig in sids and uid in uids]
+
+
+def checkpoint(obj, commit=False):
+    """
+    End of a batch of changes to persistent obj: a savepoint (or if commit
+    is True, a commit) of the transaction of the connection obj is stored
+    in -- which may have its own transaction manager -- or for an object
+    not (yet) stored, of the default (thread-local) transaction manager;
+    then garbage collection of the connection cache.
+    """
+    jar = getattr(obj, '_p_jar', None)
+    manager = transaction.manager
+    if jar is not None:
+        manager = jar.transaction_manager
+    if commit:
+        manager.commit()
+    else:
+        manager.savepoint(optimistic=True)
+    if jar is not None:
+        jar.cacheGC()
+
+
+class TreeAttributesMixin(object):
+    """
+    Mixin for BTree subclasses that keep (non-volatile) attributes
+    alongside the tree state: wraps __getstate__ and __setstate__ such
+    that attributes in __dict__ are saved with the tree.
+    """
+
+    def __getstate__(self):
+        tree_state = super(TreeAttributesMixin, self).__getstate__()
+        attr_state = [(k, v) for k, v in self.__dict__.items()
+                      if not (k.startswith('_v_') or k.startswith('__'))]
+        return (tree_state, attr_state)
+
+    def __setstate__(self, v):
+        if not (isinstance(v, tuple) and len(v) == 2 and
+                isinstance(v[1], list)):
+            v = (v, [])  # plain tree state, pickled without attributes
+        tree_state = v[0]
+        attr_state = v[1]
+        for k, v in attr_state:
+            setattr(self, k, v)
+        super(TreeAttributesMixin, self).__setstate__(tree_state)
+
+
+# BTree classes for integer-id storage written concurrently (index sets and
+# mappings, intern tables).  BTrees resolve concurrent inserts and removals
+# of distinct keys within one bucket, but not bucket splits or removal of a
+# bucket's first key; larger leaf buckets mean fewer splits and first keys,
+# hence fewer conflicts, at the cost of larger bucket pickles.
+
+class IdTreeSet(LLTreeSet):
+    """LLTreeSet of integer ids (members of a small set stay inline)."""
+
+    max_leaf_size = 500
+
+
+class IdMapping(LOBTree):
+    """LOBTree of integer id to (small or persistent) value."""
+
+    max_leaf_size = 250
+
+
+class ValueIdMapping(OLBTree):
+    """OLBTree of (hashable, comparable) value to integer id."""
+
+    max_leaf_size = 250
+
+
+class ValueMapping(OOBTree):
+    """OOBTree of (comparable) key, e.g. tuple of ids, to small value."""
+
+    max_leaf_size = 250